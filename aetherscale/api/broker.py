@@ -1,21 +1,48 @@
+import functools
 import logging
 import json
 from pathlib import Path
 import pika
-from typing import Any, Callable, Dict, Iterator
+import time
+from typing import Any, Callable, Dict, Iterator, Optional
 
+from aetherscale import capacity
 from aetherscale import config
+from aetherscale import metrics
+from aetherscale import networking
 from aetherscale import services
+from aetherscale import tracing
+from aetherscale.concurrency import KeyedExecutor
+from aetherscale.operations import OperationManager, OperationStore
+from aetherscale.qemu import image
 from aetherscale.computing import ComputingHandler, RADVD_SERVICE_NAME
 import aetherscale.vpn.radvd
 
 EXCHANGE_NAME = 'computing'
 COMPETING_QUEUE = 'computing-competing'
+# hosts publish their free resources on this fanout exchange
+CAPACITY_EXCHANGE = 'computing-capacity'
 QUEUE_COMMANDS_MAP = {
-    '': ['list-vms', 'start-vm', 'stop-vm', 'delete-vm'],
-    COMPETING_QUEUE: ['create-vm'],
+    '': ['list-vms', 'start-vm', 'stop-vm', 'delete-vm', 'operation-info'],
+    COMPETING_QUEUE: ['create-vm', 'create-vms'],
 }
 
+# Commands that change VMs are recorded as operations
+TRACKED_COMMANDS = {
+    'create-vm', 'create-vms', 'start-vm', 'stop-vm', 'delete-vm'}
+
+COMMAND_DURATION = metrics.histogram(
+    'aetherscale_command_duration_seconds',
+    'Duration of commands received from the broker', ['command', 'status'])
+COMMANDS_EXECUTING = metrics.gauge(
+    'aetherscale_commands_executing', 'Commands that are being executed')
+COMMANDS_WAITING = metrics.gauge(
+    'aetherscale_commands_waiting',
+    'Received commands that wait for a free worker')
+QUEUE_MESSAGES = metrics.gauge(
+    'aetherscale_queue_messages',
+    'Messages that wait in the broker queues of this host', ['queue'])
+
 
 def noop_responder(_: Dict[str, Any]):
     pass
@@ -34,70 +61,336 @@ def create_rabbitmq_responder(ch, reply_to: str, correlation_id: str):
     return rabbitmq_responder
 
 
-def callback(ch, method, properties, body, handler: ComputingHandler):
+def parse_message(body: bytes) -> Optional[Dict[str, Any]]:
+    message = body.decode('utf-8')
+    logging.debug('Received message: ' + message)
+
+    try:
+        data = json.loads(message)
+    except json.JSONDecodeError:
+        logging.error('Message is not valid JSON')
+        return None
+
+    if 'command' not in data:
+        logging.error('No "command" specified in message')
+        return None
+
+    return data
+
+
+def is_tracked(
+        command: str, options: Any, handler: ComputingHandler) -> bool:
+    """Whether the command is recorded as operation on this host
+
+    Commands for existing VMs are sent to all hosts, but only the host of
+    the VM records them."""
+    if command in QUEUE_COMMANDS_MAP[COMPETING_QUEUE]:
+        # only one host receives commands from the competing queue
+        return True
+    elif command in TRACKED_COMMANDS and isinstance(options, dict):
+        return handler.has_vm(options.get('vm-id', ''))
+    else:
+        return False
+
+
+def operation_info(
+        operations: OperationManager,
+        options: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    try:
+        operation_id = options['operation-id']
+    except KeyError:
+        raise ValueError('Operation ID not specified')
+
+    try:
+        operation = operations.get(operation_id)
+    except KeyError:
+        raise RuntimeError('Operation does not exist')
+
+    yield operation.to_dict()
+
+
+def error_message(reason: str) -> Dict[str, Any]:
+    return {
+        'execution-info': {
+            'status': 'error',
+            'reason': reason,
+        }
+    }
+
+
+class CapacityScheduler:
+    """Places VMs on the host with the most free capacity
+
+    Each host publishes its capacity and keeps the latest capacity of all
+    other hosts. A host that takes a create command from the competing queue
+    forwards it to the best host with the routing key "<command>.<host>".
+    Forwarded commands are published as mandatory messages with publisher
+    confirms, so that commands for a host whose queue is gone (e.g. because
+    it died after its last report) are placed on another host instead of
+    being dropped. Must only be used on the connection thread."""
+
+    def __init__(
+            self, connection: pika.BlockingConnection, channel,
+            handler: ComputingHandler):
+        self.connection = connection
+        self.channel = channel
+        self.handler = handler
+        self.table = capacity.CapacityTable(
+            max_age=3 * config.CAPACITY_INTERVAL)
+        # confirms make each publish wait for the broker, so only forwarded
+        # commands use them and not the responses on the consuming channel
+        self._forward_channel = None
+
+    def start(self, capacity_queue: str):
+        self.channel.basic_consume(
+            queue=capacity_queue, on_message_callback=self.on_capacity,
+            auto_ack=True)
+        self.publish()
+
+    def publish(self):
+        report = capacity.measure(self.handler)
+        self.channel.basic_publish(
+            exchange=CAPACITY_EXCHANGE, routing_key='',
+            body=json.dumps(report.to_dict()))
+
+        self.connection.call_later(config.CAPACITY_INTERVAL, self.publish)
+
+    def on_capacity(self, ch, method, properties, body):
+        try:
+            report = capacity.Capacity.from_dict(json.loads(body))
+        except (ValueError, KeyError, TypeError):
+            logging.error('Received invalid capacity report')
+            return
+
+        self.table.update(report)
+
+    def schedule(
+            self, properties, data: Dict[str, Any],
+            responder: Callable[[Dict[str, Any]], None]) -> bool:
+        """Forward a create command to another host or reject it if no host
+        has enough free capacity. Returns False if the command has to be
+        executed on this host."""
+        command = data['command']
+        if command not in QUEUE_COMMANDS_MAP[COMPETING_QUEUE] \
+                or 'target-host' in data:
+            return False
+
+        try:
+            requirement = capacity.requirement(
+                command, data.get('options', {}))
+        except (ValueError, AttributeError):
+            # the handler answers with the error
+            return False
+
+        capacities = [capacity.measure(self.handler)] + [
+            report for report in self.table.fresh()
+            if report.host != config.HOSTNAME]
+
+        while True:
+            best = capacity.place(capacities, requirement)
+
+            if best is None:
+                logging.warning(f'No host has enough capacity for {command}')
+                responder(error_message('No host has enough free capacity'))
+                return True
+            elif best.host == config.HOSTNAME:
+                return False
+
+            logging.info(f'Forwarding {command} to host {best.host}')
+            if self._forward(properties, data, best.host):
+                self.table.reserve(best.host, requirement)
+                return True
+
+            # try the next best host
+            self.table.remove(best.host)
+            capacities.remove(best)
+
+    def _forward(self, properties, data: Dict[str, Any], host: str) -> bool:
+        """Publish a command to the queue of a host, returns False if the
+        broker could not deliver it"""
+        command = data['command']
+
+        try:
+            if self._forward_channel is None \
+                    or self._forward_channel.is_closed:
+                self._forward_channel = self.connection.channel()
+                self._forward_channel.confirm_delivery()
+
+            self._forward_channel.basic_publish(
+                exchange=EXCHANGE_NAME,
+                routing_key=f'{command}.{host}',
+                properties=pika.BasicProperties(
+                    reply_to=properties.reply_to,
+                    correlation_id=properties.correlation_id),
+                body=json.dumps({**data, 'target-host': host}),
+                mandatory=True)
+        except pika.exceptions.AMQPChannelError as e:
+            # UnroutableError if the queue of the host is gone
+            logging.warning(f'Could not forward {command} to {host}: {e!r}')
+            return False
+
+        return True
+
+
+def execute_command(
+        data: Dict[str, Any], handler: ComputingHandler,
+        responder: Callable[[Dict[str, Any]], None],
+        operations: Optional[OperationManager] = None):
     command_fn: Dict[str, Callable[[Dict[str, Any]], Iterator[Any]]] = {
         'list-vms': handler.list_vms,
         'create-vm': handler.create_vm,
+        'create-vms': handler.create_vms,
         'start-vm': handler.start_vm,
         'stop-vm': handler.stop_vm,
         'delete-vm': handler.delete_vm,
     }
+    if operations:
+        command_fn['operation-info'] = functools.partial(
+            operation_info, operations)
 
-    message = body.decode('utf-8')
-    logging.debug('Received message: ' + message)
-
-    data = json.loads(message)
-
-    try:
-        command = data['command']
-    except KeyError:
-        logging.error('No "command" specified in message')
-        return
-
+    command = data['command']
     try:
         fn = command_fn[command]
     except KeyError:
         logging.error(f'Invalid command "{command}" specified')
         return
 
-    if properties.reply_to:
-        responder = create_rabbitmq_responder(
-            ch, properties.reply_to, properties.correlation_id)
-    else:
-        responder = noop_responder
-
     options = data.get('options', {})
-    try:
-        for response in fn(options):
-            # if a function wants to return a response
-            # set its execution status to success
-            resp_message = {
-                'execution-info': {
-                    'status': 'success'
-                },
-                'response': response,
-            }
+    status = 'success'
+    execution_info: Dict[str, Any] = {}
+    start = time.monotonic()
+    COMMANDS_EXECUTING.inc()
+
+    with tracing.span(f'command {command}') as span:
+        if isinstance(options, dict) and 'vm-id' in options:
+            span.set_attribute('vm.id', options['vm-id'])
+
+        try:
+            results = fn(options)
+            if operations and is_tracked(command, options, handler):
+                operation = operations.create(command, options)
+                results = operations.execute(operation, results)
+                execution_info['operation-id'] = operation.operation_id
+                span.set_attribute('operation.id', operation.operation_id)
+
+            for response in results:
+                # if a function wants to return a response
+                # set its execution status to success
+                resp_message = {
+                    'execution-info': {
+                        'status': 'success',
+                        **execution_info,
+                    },
+                    'response': response,
+                }
+                responder(resp_message)
+        except Exception as e:
+            status = 'error'
+            span.error = str(e)
+            logging.exception('Unhandled exception')
+            # TODO: Only ouput message if it is an exception generated by us
+            resp_message = error_message(str(e))
+            resp_message['execution-info'].update(execution_info)
             responder(resp_message)
-    except Exception as e:
-        logging.exception('Unhandled exception')
-        resp_message = {
-            'execution-info': {
-                'status': 'error',
-                # TODO: Only ouput message if it is an exception generated
-                # by us
-                'reason': str(e),
-            }
-        }
-        responder(resp_message)
+        finally:
+            COMMANDS_EXECUTING.dec()
+            COMMAND_DURATION.observe(
+                time.monotonic() - start, command=command, status=status)
+
+
+def callback(
+        ch, method, properties, body, handler: ComputingHandler,
+        operations: Optional[OperationManager] = None,
+        scheduler: Optional[CapacityScheduler] = None):
+    data = parse_message(body)
+
+    if data:
+        if properties.reply_to:
+            responder = create_rabbitmq_responder(
+                ch, properties.reply_to, properties.correlation_id)
+        else:
+            responder = noop_responder
+
+        if not scheduler \
+                or not scheduler.schedule(properties, data, responder):
+            execute_command(data, handler, responder, operations)
 
     ch.basic_ack(delivery_tag=method.delivery_tag)
 
 
-def run():
-    connection = pika.BlockingConnection(
-        pika.ConnectionParameters(host=config.RABBITMQ_HOST))
-    channel = connection.channel()
+class WorkerPoolConsumer:
+    """Executes commands on a pool of worker threads
+
+    pika connections are not thread-safe, so workers hand responses and
+    acknowledgements back to the connection thread. Commands for the same VM
+    are executed in order, commands for different VMs in parallel."""
+
+    def __init__(
+            self, connection: pika.BlockingConnection,
+            handler: ComputingHandler, workers: int,
+            operations: Optional[OperationManager] = None,
+            scheduler: Optional[CapacityScheduler] = None):
+        self.connection = connection
+        self.handler = handler
+        self.operations = operations
+        self.scheduler = scheduler
+        self.executor = KeyedExecutor(workers)
+
+    def on_message(self, ch, method, properties, body):
+        data = parse_message(body)
+        ack = functools.partial(ch.basic_ack, delivery_tag=method.delivery_tag)
+
+        if not data:
+            ack()
+            return
+
+        if properties.reply_to:
+            rabbitmq_responder = create_rabbitmq_responder(
+                ch, properties.reply_to, properties.correlation_id)
+            responder = self._threadsafe(rabbitmq_responder)
+        else:
+            rabbitmq_responder = responder = noop_responder
+
+        # placement is decided on the connection thread
+        if self.scheduler and self.scheduler.schedule(
+                properties, data, rabbitmq_responder):
+            ack()
+            return
+
+        def work():
+            COMMANDS_WAITING.dec()
+            try:
+                execute_command(
+                    data, self.handler, responder, self.operations)
+            finally:
+                self.connection.add_callback_threadsafe(ack)
+
+        COMMANDS_WAITING.inc()
+        self.executor.submit(ordering_key(data), work)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+    def _threadsafe(self, responder: Callable[[Dict[str, Any]], None]):
+        def threadsafe_responder(message: Dict[str, Any]):
+            self.connection.add_callback_threadsafe(
+                functools.partial(responder, message))
+
+        return threadsafe_responder
 
+
+def ordering_key(data: Dict[str, Any]) -> Optional[str]:
+    """Commands for the same VM must not overtake each other"""
+    options = data.get('options', {})
+    if isinstance(options, dict):
+        return options.get('vm-id')
+    else:
+        return None
+
+
+def declare_queues(channel) -> str:
+    """Declare the exchange and the queues of this host and return the name
+    of the exclusive queue"""
     channel.exchange_declare(exchange=EXCHANGE_NAME, exchange_type='direct')
 
     # let rabbitmq define a name for the exclusive queue
@@ -114,8 +407,103 @@ def run():
             channel.queue_bind(
                 exchange=EXCHANGE_NAME, queue=queue, routing_key=command)
 
+    # create commands that other hosts placed on this host
+    for command in QUEUE_COMMANDS_MAP[COMPETING_QUEUE]:
+        channel.queue_bind(
+            exchange=EXCHANGE_NAME, queue=exclusive_queue_name,
+            routing_key=f'{command}.{config.HOSTNAME}')
+
+    return exclusive_queue_name
+
+
+def declare_capacity_queue(channel) -> str:
+    """Declare the queue that receives the capacity of all hosts"""
+    channel.exchange_declare(
+        exchange=CAPACITY_EXCHANGE, exchange_type='fanout')
+
+    result = channel.queue_declare(queue='', exclusive=True)
+    channel.queue_bind(
+        exchange=CAPACITY_EXCHANGE, queue=result.method.queue,
+        routing_key='')
+
+    return result.method.queue
+
+
+def consume(
+        connection: pika.BlockingConnection, channel,
+        handler: ComputingHandler, exclusive_queue_name: str,
+        operations: Optional[OperationManager] = None,
+        scheduler: Optional[CapacityScheduler] = None
+) -> Optional[WorkerPoolConsumer]:
+    """Execute commands from the exclusive and the competing queue, the
+    returned consumer has to be shut down after consuming stopped
+
+    With a scheduler, create commands are placed on the host with the most
+    free capacity."""
+    consumer = None
+    if config.BROKER_WORKERS > 0:
+        # only take as many messages from the broker as we want to process
+        # in parallel, so that other hosts can take the remaining ones
+        channel.basic_qos(prefetch_count=config.BROKER_PREFETCH)
+
+        consumer = WorkerPoolConsumer(
+            connection, handler, config.BROKER_WORKERS, operations,
+            scheduler)
+        bound_callback = consumer.on_message
+    else:
+        bound_callback = lambda ch, method, properties, body: \
+            callback(
+                ch, method, properties, body, handler, operations, scheduler)
+
+    channel.basic_consume(
+        queue=exclusive_queue_name, on_message_callback=bound_callback)
+    channel.basic_consume(
+        queue=COMPETING_QUEUE, on_message_callback=bound_callback)
+
+    return consumer
+
+
+def watch_queue_messages(
+        connection: pika.BlockingConnection, queues: Dict[str, str]):
+    """Update the queue_messages gauge with the number of messages in each
+    queue (label to queue name) every METRICS_QUEUE_INTERVAL seconds
+
+    The queues are read on a channel of their own, because the broker
+    closes a channel if a queue is missing. A closed channel is opened
+    again, the gauge stops once the connection failed."""
+    channel = connection.channel()
+
+    def update():
+        nonlocal channel
+
+        for label, queue in queues.items():
+            try:
+                if channel.is_closed:
+                    channel = connection.channel()
+                result = channel.queue_declare(queue=queue, passive=True)
+            except pika.exceptions.AMQPConnectionError as e:
+                logging.warning(f'Stopped reading queue sizes: {e!r}')
+                return
+            except pika.exceptions.AMQPError as e:
+                # a gauge is not worth stopping the daemon for
+                logging.warning(f'Could not read size of {queue}: {e!r}')
+                continue
+
+            QUEUE_MESSAGES.set(result.method.message_count, queue=label)
+
+        connection.call_later(config.METRICS_QUEUE_INTERVAL, update)
+
+    update()
+
+
+def run():
+    connection = pika.BlockingConnection(
+        pika.ConnectionParameters(host=config.RABBITMQ_HOST))
+    channel = connection.channel()
+    exclusive_queue_name = declare_queues(channel)
+
     systemd_path = Path.home() / '.config/systemd/user'
-    service_manager = services.SystemdServiceManager(systemd_path)
+    service_manager = services.create_service_manager(systemd_path)
 
     # TODO: Setup or radvd does not belong here, we will remove it
     # Guest VPNs have to handle IPv6 management on their own
@@ -126,16 +514,63 @@ def run():
         description='IPv6 Router Advertisment for VPNs')
     service_manager.start_service(RADVD_SERVICE_NAME)
 
-    handler = ComputingHandler(radvd, service_manager)
+    overlay_pool = None
+    if config.OVERLAY_POOL_SIZE > 0:
+        overlay_pool = image.OverlayPool(
+            config.BASE_IMAGE_FOLDER, config.OVERLAY_POOL_SIZE)
+        overlay_pool.warm()
 
-    bound_callback = lambda ch, method, properties, body: \
-        callback(ch, method, properties, body, handler)
-    channel.basic_consume(
-        queue=exclusive_queue_name, on_message_callback=bound_callback)
-    channel.basic_consume(
-        queue=COMPETING_QUEUE, on_message_callback=bound_callback)
+    # device lookups during VM creation are then answered from memory
+    networking.link_index.start_monitor()
+
+    tap_pool = None
+    if config.TAP_POOL_SIZE > 0:
+        tap_pool = networking.TapPool(config.TAP_POOL_SIZE, config.USER)
+
+    handler = ComputingHandler(
+        radvd, service_manager, watch_qemu_events=True,
+        overlay_pool=overlay_pool, tap_pool=tap_pool)
+
+    # commands are executed by the consumer, so the operation manager only
+    # records them
+    store = OperationStore(config.OPERATIONS_DB, source='broker')
+    operations = OperationManager(
+        workers=1, store=store, history=config.OPERATION_HISTORY)
+    # remove what interrupted operations left behind before new commands
+    # are accepted
+    operations.recover(handler.recover_operation)
+
+    if tap_pool:
+        # only after the handler reserved the devices of existing VMs
+        tap_pool.warm(['br0'] + [
+            vpn.bridge_interface_name
+            for vpn in handler.established_vpns.values()])
+
+    scheduler = None
+    if config.CAPACITY_INTERVAL > 0:
+        scheduler = CapacityScheduler(connection, channel, handler)
+        scheduler.start(declare_capacity_queue(channel))
+
+    consumer = consume(
+        connection, channel, handler, exclusive_queue_name, operations,
+        scheduler)
+
+    if config.METRICS_PORT > 0:
+        metrics.start_http_server(config.METRICS_PORT)
+
+        watch_queue_messages(connection, {
+            'host': exclusive_queue_name, 'competing': COMPETING_QUEUE})
 
     try:
         channel.start_consuming()
     except KeyboardInterrupt:
         print('Keyboard interrupt, stopping service')
+
+    if consumer:
+        consumer.shutdown()
+    operations.shutdown()
+    if overlay_pool:
+        overlay_pool.shutdown()
+    if tap_pool:
+        tap_pool.shutdown()
+    networking.link_index.stop_monitor()
@@ -1,19 +1,97 @@
 import flask
+import json
+import logging
 from pathlib import Path
+import threading
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import werkzeug.serving
 
+from aetherscale import computing
 from aetherscale.computing import ComputingHandler
+from aetherscale import config
+from aetherscale import metrics
+from aetherscale.operations import OperationManager, OperationStore
 from aetherscale import services
 
 
 app = flask.Flask(__name__)
 
+# One handler serves all requests, so that the inventory of VMs and the VPNs
+# are only read once and not for each request
+_handler: Optional[ComputingHandler] = None
+_operations: Optional[OperationManager] = None
+_handler_lock = threading.Lock()
+
+# Long-polling requests for operations wait at most this many seconds
+MAX_OPERATION_WAIT = 30
+
+
+def _initialize() -> Tuple[ComputingHandler, OperationManager]:
+    global _handler, _operations
+
+    with _handler_lock:
+        if _handler is None:
+            systemd_path = Path.home() / '.config/systemd/user'
+            service_manager = services.create_service_manager(systemd_path)
+            # the handler lives as long as the server, so it can learn
+            # about exited VM processes from QEMU events
+            _handler = ComputingHandler(
+                radvd=None, service_manager=service_manager,
+                watch_qemu_events=True)
+
+        if _operations is None:
+            store = OperationStore(config.OPERATIONS_DB, source='rest')
+            _operations = OperationManager(
+                config.REST_WORKERS, store, config.OPERATION_HISTORY)
+            # remove what operations left behind that were interrupted by
+            # a restart of the server
+            _operations.recover(_handler.recover_operation)
+
+        return _handler, _operations
+
+
+def get_handler() -> ComputingHandler:
+    return _initialize()[0]
+
+
+def get_operations() -> OperationManager:
+    return _initialize()[1]
+
+
+def reset_handler():
+    """Create a new handler and forget all operations, e.g. in tests"""
+    global _handler, _operations
+
+    with _handler_lock:
+        if _operations:
+            _operations.shutdown(wait=False)
+
+        _handler = None
+        _operations = None
+
+
+def serve(host: str, port: int):
+    """Serve the API with a thread per request, so that reads are not
+    blocked by slow requests"""
+    server = werkzeug.serving.make_server(host, port, app, threaded=True)
+    logging.info(f'Serving HTTP API on {host}:{port}')
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('Keyboard interrupt, stopping service')
+    finally:
+        server.server_close()
+        if _operations:
+            _operations.shutdown()
+
 
 @app.before_request
 def initialize_handler():
-    systemd_path = Path.home() / '.config/systemd/user'
-    service_manager = services.SystemdServiceManager(systemd_path)
-    handler = ComputingHandler(radvd=None, service_manager=service_manager)
-    flask.g.handler = handler
+    if flask.request.endpoint == 'expose_metrics':
+        return
+
+    flask.g.handler = get_handler()
 
 
 @app.route('/vm', methods=['GET'])
@@ -38,27 +116,105 @@ def vm_info(vm_id):
 
 @app.route('/vm', methods=['POST'])
 def create_vm():
-    options = flask.request.json
+    options = flask.request.get_json(silent=True)
     handler: ComputingHandler = flask.g.handler
-    results = list(handler.create_vm(options))
 
-    # return the final status
-    return flask.jsonify(results[-1])
+    if not isinstance(options, dict) or 'image' not in options:
+        return '"image" field in data missing', 400
+
+    if flask.request.accept_mimetypes.best == 'text/event-stream':
+        # send each status and progress message as soon as it is available
+        options = {**options, 'report-progress': True}
+        messages = stream_events(run_operation_streaming(
+            'create-vm', options, handler.create_vm(options)))
+        return flask.Response(
+            flask.stream_with_context(messages),
+            mimetype='text/event-stream')
+
+    # creating a VM takes long, so it is executed in the background and
+    # the client polls the operation for the result
+    operation = get_operations().submit(
+        'create-vm', options, handler.create_vm(options))
+    location = flask.url_for(
+        'operation_info', operation_id=operation.operation_id)
+
+    return flask.jsonify(operation.to_dict()), 202, {'Location': location}
+
+
+@app.route('/vm/batch', methods=['POST'])
+def create_vms():
+    """Create several VMs at once, see ComputingHandler.create_vms"""
+    options = flask.request.get_json(silent=True)
+    handler: ComputingHandler = flask.g.handler
+
+    if not isinstance(options, dict) \
+            or ('count' not in options and 'vms' not in options):
+        return '"count" or "vms" field in data missing', 400
+
+    try:
+        computing.batch_specs(options)
+    except ValueError as e:
+        return str(e), 400
+
+    if flask.request.accept_mimetypes.best == 'text/event-stream':
+        messages = stream_events(run_operation_streaming(
+            'create-vms', options, handler.create_vms(options)))
+        return flask.Response(
+            flask.stream_with_context(messages),
+            mimetype='text/event-stream')
+
+    operation = get_operations().submit(
+        'create-vms', options, handler.create_vms(options))
+    location = flask.url_for(
+        'operation_info', operation_id=operation.operation_id)
+
+    return flask.jsonify(operation.to_dict()), 202, {'Location': location}
+
+
+def run_operation(
+        command: str, options: Dict[str, Any],
+        results: Iterator[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Execute a short command in the request, but record it as operation
+    so that it can be cleaned up if the server is interrupted"""
+    return list(run_operation_streaming(command, options, results))
+
+
+def run_operation_streaming(
+        command: str, options: Dict[str, Any],
+        results: Iterator[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+    operations = get_operations()
+    operation = operations.create(command, options)
+    return operations.execute(operation, results)
+
+
+def stream_events(results: Iterator[Dict[str, Any]]) -> Iterator[str]:
+    """Format results as server-sent events, an error ends the stream with
+    an error event"""
+    try:
+        for result in results:
+            yield f'data: {json.dumps(result)}\n\n'
+    except Exception as e:
+        logging.exception('Unhandled exception')
+        yield f'event: error\ndata: {json.dumps({"reason": str(e)})}\n\n'
 
 
 @app.route('/vm/<vm_id>', methods=['PATCH'])
 def update_vm_status(vm_id):
-    data = flask.request.json
+    data = flask.request.get_json(silent=True)
 
     if not data or 'status' not in data:
         return '"status" field in data missing', 400
 
     handler: ComputingHandler = flask.g.handler
 
+    options = {'vm-id': vm_id}
+
     if data['status'] == 'started':
-        result = list(handler.start_vm({'vm-id': vm_id}))[0]
+        result = run_operation(
+            'start-vm', options, handler.start_vm(options))[-1]
     elif data['status'] == 'stopped':
-        result = list(handler.stop_vm({'vm-id': vm_id}))[0]
+        result = run_operation(
+            'stop-vm', options, handler.stop_vm(options))[-1]
     else:
         return 'invalid value for "status"', 400
 
@@ -69,7 +225,9 @@ def update_vm_status(vm_id):
 @app.route('/vm/<vm_id>', methods=['DELETE'])
 def delete_vm(vm_id):
     handler: ComputingHandler = flask.g.handler
-    result = list(handler.delete_vm({'vm-id': vm_id}))[0]
+    options = {'vm-id': vm_id}
+    result = run_operation(
+        'delete-vm', options, handler.delete_vm(options))[-1]
 
     return flask.jsonify(result)
 
@@ -91,3 +249,33 @@ def vpn_info(vpn_name):
         return 'VPN does not exist', 404
 
     return flask.jsonify(result)
+
+
+@app.route('/operations', methods=['GET'])
+def list_operations():
+    operations = get_operations().recent()
+    return flask.jsonify([operation.to_dict() for operation in operations])
+
+
+@app.route('/operations/<operation_id>', methods=['GET'])
+def operation_info(operation_id):
+    """State of an operation, with ?wait=<seconds> the request returns as
+    soon as the operation finished (long-polling)"""
+    try:
+        wait = min(
+            float(flask.request.args.get('wait', 0)), MAX_OPERATION_WAIT)
+    except ValueError:
+        return '"wait" must be a number of seconds', 400
+
+    try:
+        operation = get_operations().wait(operation_id, wait)
+    except KeyError:
+        return 'Operation does not exist', 404
+
+    return flask.jsonify(operation.to_dict())
+
+
+@app.route('/metrics', methods=['GET'])
+def expose_metrics():
+    return flask.Response(
+        metrics.REGISTRY.expose(), content_type=metrics.CONTENT_TYPE)
@@ -0,0 +1,149 @@
+from dataclasses import dataclass, field
+import psutil
+import shutil
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from aetherscale import computing
+from aetherscale import config
+
+MIB = 1024 * 1024
+
+
+@dataclass
+class Requirement:
+    """Resources that new VMs need, memory and disk in MiB"""
+    memory: int
+    vcpus: int
+    disk: int
+
+
+@dataclass
+class Capacity:
+    """Free resources of a host, memory and disk in MiB"""
+    host: str
+    memory_free: int
+    vcpus_free: int
+    disk_free: int
+    vms_running: int
+    timestamp: float = field(default_factory=time.time)
+
+    def fits(self, requirement: Requirement) -> bool:
+        return self.memory_free >= requirement.memory \
+            and self.vcpus_free >= requirement.vcpus \
+            and self.disk_free >= requirement.disk
+
+    def reserve(self, requirement: Requirement):
+        self.memory_free -= requirement.memory
+        self.vcpus_free -= requirement.vcpus
+        self.disk_free -= requirement.disk
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'host': self.host,
+            'memory-free': self.memory_free,
+            'vcpus-free': self.vcpus_free,
+            'disk-free': self.disk_free,
+            'vms-running': self.vms_running,
+            'timestamp': self.timestamp,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'Capacity':
+        return cls(
+            host=data['host'], memory_free=int(data['memory-free']),
+            vcpus_free=int(data['vcpus-free']),
+            disk_free=int(data['disk-free']),
+            vms_running=int(data['vms-running']),
+            timestamp=float(data['timestamp']))
+
+
+def requirement(command: str, options: Dict[str, Any]) -> Requirement:
+    """Resources needed by a create-vm or create-vms command, raises
+    ValueError for invalid options"""
+    if command == 'create-vms':
+        specs = computing.batch_specs(options)
+    else:
+        specs = [options]
+
+    resources = [computing.vm_resources(spec) for spec in specs]
+    return Requirement(
+        memory=sum(memory for memory, _ in resources),
+        vcpus=sum(vcpus for _, vcpus in resources),
+        disk=config.VM_DISK * len(specs))
+
+
+def measure(handler: computing.ComputingHandler) -> Capacity:
+    """Capacity of this host
+
+    Memory that running VMs were started with counts as used even if the
+    guest did not touch it yet, so that hosts are not overcommitted."""
+    memory_committed, vcpus_committed, vms_running = \
+        handler.committed_resources()
+
+    memory = psutil.virtual_memory()
+    memory_free = min(
+        memory.available // MIB, memory.total // MIB - memory_committed)
+
+    vcpus = int((psutil.cpu_count() or 1) * config.VCPU_OVERCOMMIT)
+
+    try:
+        disk_free = shutil.disk_usage(config.USER_IMAGE_FOLDER).free // MIB
+    except FileNotFoundError:
+        disk_free = 0
+
+    return Capacity(
+        host=config.HOSTNAME, memory_free=memory_free,
+        vcpus_free=vcpus - vcpus_committed, disk_free=disk_free,
+        vms_running=vms_running)
+
+
+class CapacityTable:
+    """Latest reported capacity of each host, reports older than max_age
+    seconds are ignored (e.g. of hosts that were shut down)"""
+
+    def __init__(self, max_age: float):
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._capacities: Dict[str, Capacity] = {}
+
+    def update(self, capacity: Capacity):
+        with self._lock:
+            self._capacities[capacity.host] = capacity
+
+    def reserve(self, host: str, requirement: Requirement):
+        """Count resources as used until the host reports again, so that
+        not all VMs are sent to the same host in the meantime"""
+        with self._lock:
+            if host in self._capacities:
+                self._capacities[host].reserve(requirement)
+
+    def remove(self, host: str):
+        """Forget a host until it reports again, e.g. because its queue is
+        gone"""
+        with self._lock:
+            self._capacities.pop(host, None)
+
+    def fresh(self) -> List[Capacity]:
+        oldest = time.time() - self.max_age
+
+        with self._lock:
+            return [
+                Capacity(**vars(capacity))
+                for capacity in self._capacities.values()
+                if capacity.timestamp >= oldest]
+
+
+def place(
+        capacities: List[Capacity],
+        requirement: Requirement) -> Optional[Capacity]:
+    """Host for new VMs, the one with the most free memory among the hosts
+    that fit them so that VMs are spread over all hosts"""
+    candidates = [
+        capacity for capacity in capacities if capacity.fits(requirement)]
+    if not candidates:
+        return None
+
+    return max(candidates, key=lambda capacity: (
+        capacity.memory_free, capacity.vcpus_free, -capacity.vms_running))
@@ -1,65 +1,333 @@
 #!/usr/bin/env python
 
 import argparse
+import asyncio
+import concurrent.futures
 import json
+import logging
+import math
 import pika
 import pika.exceptions
 import sys
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+import uuid
 
 from .config import RABBITMQ_HOST
 
 
 EXCHANGE_NAME = 'computing'
+DIRECT_REPLY_TO = 'amq.rabbitmq.reply-to'
+
+# Seconds after which a request returns with the responses received so far
+RESPONSE_TIMEOUT = 5
+# Most commands are sent to all hosts, so we do not know how many responses
+# to expect. Once the last response was a host's final one, we wait this
+# long for responses of other hosts.
+SETTLE_TIME = 0.5
+
+# create-vm and create-vms are executed by exactly one host (from the
+# competing queue)
+SINGLE_HOST_COMMANDS = {'create-vm', 'create-vms'}
+# status of the final response for commands that concern a single VM, only
+# the host that runs the VM answers with this status
+FINAL_STATUS = {
+    'create-vm': {'starting'},
+    'create-vms': {'finished'},
+    'start-vm': {'starting'},
+    'stop-vm': {'stopped', 'killed'},
+    'delete-vm': {'deleted'},
+}
+# reason of the error with which all hosts that do not run a VM answer
+UNKNOWN_VM_REASON = 'VM does not exist'
+
+
+def is_final_response(command: str, message: Dict[str, Any]) -> bool:
+    """Whether a host will not send further responses to a command after
+    this one
+
+    For commands that concern a single VM, the "VM does not exist" errors of
+    the hosts that do not run it are not final, the host of the VM might
+    still be working on the command."""
+    execution_info = message.get('execution-info', {})
+    if execution_info.get('status') != 'success':
+        return command not in FINAL_STATUS \
+            or command in SINGLE_HOST_COMMANDS \
+            or execution_info.get('reason') != UNKNOWN_VM_REASON
+    elif command not in FINAL_STATUS:
+        # e.g. list-vms is answered with a single response per host
+        return True
+
+    response = message.get('response')
+    return isinstance(response, dict) \
+        and response.get('status') in FINAL_STATUS[command]
+
+
+class PendingRequest:
+    """Responses to a request that were received so far"""
+
+    def __init__(
+            self, command: str, correlation_id: str, timeout: float,
+            settle_time: float, expected_replies: Optional[int] = None):
+        self.command = command
+        self.correlation_id = correlation_id
+        self.settle_time = settle_time
+        self.expected_replies = expected_replies
+
+        self.sent_at = time.monotonic()
+        self.deadline = self.sent_at + timeout
+        self.responses: List[Dict[str, Any]] = []
+        # seconds from sending the request until each response arrived
+        self.reply_times: List[float] = []
+        self._finished = False
+        self._final_received = False
+
+    def add_response(self, message: Dict[str, Any]):
+        now = time.monotonic()
+        self.responses.append(message)
+        self.reply_times.append(now - self.sent_at)
+
+        if self.expected_replies is not None:
+            self._finished = len(self.responses) >= self.expected_replies
+        elif is_final_response(self.command, message):
+            self._final_received = True
+            succeeded = message['execution-info']['status'] == 'success'
+            if self.command in SINGLE_HOST_COMMANDS:
+                self._finished = True
+            elif succeeded and self.command in FINAL_STATUS:
+                # the host of the VM answered, all others answer with errors
+                self._finished = True
+
+    def done(self, now: Optional[float] = None) -> bool:
+        if now is None:
+            now = time.monotonic()
+
+        return self._finished or now >= self.deadline \
+            or now >= self._settled_at()
+
+    def seconds_until_check(self, now: float) -> float:
+        """Time after which the request might be done without receiving
+        another response"""
+        return max(min(self.deadline, self._settled_at()) - now, 0)
+
+    def _settled_at(self) -> float:
+        # without a final response (e.g. only "VM does not exist" errors of
+        # other hosts) we wait for the timeout
+        if not self._final_received or self.expected_replies is not None:
+            return math.inf
+
+        return self.sent_at + self.reply_times[-1] + self.settle_time
 
 
 class ServerCommunication:
+    """Sends commands to aetherscale hosts and collects their responses
+
+    Each request carries its own correlation ID, so that several requests
+    can be in flight on one connection with send() and wait(). A request
+    finishes as soon as its final response arrived, at the latest after
+    the timeout."""
+
+    def __init__(
+            self, timeout: float = RESPONSE_TIMEOUT,
+            settle_time: float = SETTLE_TIME):
+        self.timeout = timeout
+        self.settle_time = settle_time
+        self.pending: Dict[str, PendingRequest] = {}
+
     def __enter__(self):
         self.connection = pika.BlockingConnection(
             pika.ConnectionParameters(host=RABBITMQ_HOST))
         self.channel = self.connection.channel()
 
         self.channel.basic_consume(
-            queue='amq.rabbitmq.reply-to',
+            queue=DIRECT_REPLY_TO,
             on_message_callback=self.on_response,
             auto_ack=True)
 
         return self
 
     def on_response(self, ch, method, properties, body):
-        self.responses.append(json.loads(body))
+        request = self.pending.get(properties.correlation_id)
+        if request is None:
+            logging.debug(
+                f'Dropping response to unknown request '
+                f'{properties.correlation_id}')
+            return
 
-    def on_timeout(self):
-        self.channel.stop_consuming()
+        request.add_response(json.loads(body))
 
-    def send_msg(self, data, response_expected=False):
-        self.responses = []
+    def send(
+            self, data: Dict[str, Any], response_expected: bool = True,
+            expected_replies: Optional[int] = None) \
+            -> Optional[PendingRequest]:
+        """Send a request without waiting for its responses"""
+        correlation_id = uuid.uuid4().hex
 
+        request = None
         reply_to = None
         if response_expected:
-            reply_to = 'amq.rabbitmq.reply-to'
+            reply_to = DIRECT_REPLY_TO
+            request = PendingRequest(
+                data['command'], correlation_id, self.timeout,
+                self.settle_time, expected_replies)
+            self.pending[correlation_id] = request
 
         self.channel.basic_publish(
             exchange=EXCHANGE_NAME,
             routing_key=data['command'],
             properties=pika.BasicProperties(
                 reply_to=reply_to,
+                correlation_id=correlation_id,
                 content_type='application/json',
             ),
             body=json.dumps(data).encode('utf-8'))
 
-        if response_expected:
-            self.connection.call_later(5, self.on_timeout)
-            self.channel.start_consuming()
+        return request
+
+    def wait(self, requests: List[PendingRequest]):
+        """Process responses until all requests are done"""
+        unfinished = list(requests)
+        while unfinished:
+            self.process_events(unfinished, RESPONSE_TIMEOUT)
+            unfinished = [r for r in unfinished if not r.done()]
+
+    def process_events(
+            self, requests: List[PendingRequest],
+            max_wait: float) -> List[PendingRequest]:
+        """Wait at most max_wait seconds for responses and return the
+        requests that are done"""
+        now = time.monotonic()
+        time_limit = min(
+            [max_wait] + [r.seconds_until_check(now) for r in requests])
+        self.connection.process_data_events(time_limit=time_limit)
+
+        now = time.monotonic()
+        finished = [r for r in requests if r.done(now)]
+        for request in finished:
+            # late responses are dropped instead of mixed into other requests
+            self.pending.pop(request.correlation_id, None)
 
-        return self.responses
+        return finished
+
+    def send_msg(
+            self, data: Dict[str, Any], response_expected: bool = False,
+            expected_replies: Optional[int] = None) -> List[Dict[str, Any]]:
+        request = self.send(data, response_expected, expected_replies)
+        if request is None:
+            return []
+
+        self.wait([request])
+        return request.responses
+
+    def send_many(
+            self, messages: List[Dict[str, Any]]) \
+            -> List[List[Dict[str, Any]]]:
+        """Send all requests at once and return their responses in the
+        same order"""
+        requests = [self.send(data) for data in messages]
+        self.wait(requests)
+        return [request.responses for request in requests]
 
     def __exit__(self, exc_type, exc_value, traceback):
         self.connection.close()
 
 
+class AsyncServerCommunication:
+    """asyncio interface for ServerCommunication
+
+    pika's BlockingConnection is not thread-safe, so it is served by a
+    background thread. Requests are handed to this thread and their
+    responses are returned as futures of the event loop."""
+
+    def __init__(
+            self, timeout: float = RESPONSE_TIMEOUT,
+            settle_time: float = SETTLE_TIME):
+        self.communication = ServerCommunication(timeout, settle_time)
+
+        self._waiting: List[Tuple[PendingRequest, asyncio.Future]] = []
+        self._closing = False
+        self._thread: Optional[threading.Thread] = None
+
+    async def __aenter__(self):
+        loop = asyncio.get_running_loop()
+        connected: concurrent.futures.Future = concurrent.futures.Future()
+
+        self._thread = threading.Thread(
+            target=self._serve, args=(loop, connected),
+            name='aetherscale-client', daemon=True)
+        self._thread.start()
+        await asyncio.wrap_future(connected)
+
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self._closing = True
+        await asyncio.get_running_loop().run_in_executor(
+            None, self._thread.join)
+
+    async def send_msg(
+            self, data: Dict[str, Any], response_expected: bool = True,
+            expected_replies: Optional[int] = None) -> List[Dict[str, Any]]:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def send():
+            try:
+                request = self.communication.send(
+                    data, response_expected, expected_replies)
+            except Exception as e:
+                loop.call_soon_threadsafe(_set_exception, future, e)
+                return
+
+            if request is None:
+                loop.call_soon_threadsafe(_set_result, future, [])
+            else:
+                self._waiting.append((request, future))
+
+        self.communication.connection.add_callback_threadsafe(send)
+        return await future
+
+    def _serve(self, loop, connected: concurrent.futures.Future):
+        try:
+            self.communication.__enter__()
+        except Exception as e:
+            connected.set_exception(e)
+            return
+
+        connected.set_result(None)
+
+        try:
+            while not self._closing:
+                # wake up regularly to notice when we are closed
+                finished = self.communication.process_events(
+                    [request for request, _ in self._waiting], max_wait=0.1)
+
+                for request, future in list(self._waiting):
+                    if request in finished:
+                        self._waiting.remove((request, future))
+                        loop.call_soon_threadsafe(
+                            _set_result, future, request.responses)
+        finally:
+            self.communication.__exit__(None, None, None)
+
+
+def _set_result(future: asyncio.Future, result: Any):
+    if not future.done():
+        future.set_result(result)
+
+
+def _set_exception(future: asyncio.Future, exception: Exception):
+    if not future.done():
+        future.set_exception(exception)
+
+
 def main():
     parser = argparse.ArgumentParser(
         description='Manage aetherscale instances')
+    parser.add_argument(
+        '--timeout', type=float, default=RESPONSE_TIMEOUT,
+        help='Seconds to wait for responses')
     subparsers = parser.add_subparsers(dest='subparser_name')
 
     create_vm_parser = subparsers.add_parser('create-vm')
@@ -68,11 +336,38 @@ def main():
     create_vm_parser.add_argument(
         '--init-script', dest='init_script_path',
         help='Script to execute at first boot of VM', required=False)
+    create_vm_parser.add_argument(
+        '--init-method', dest='init_method',
+        choices=['guestmount', 'cloud-init'], required=False,
+        help='How to pass the init script to the VM')
     create_vm_parser.add_argument(
         '--vpn', help='Name of the VPN to startup/join', required=False)
+    create_vm_parser.add_argument(
+        '--report-progress', dest='report_progress', action='store_true',
+        default=False, help='Report the duration of each creation phase')
     create_vm_parser.add_argument(
         '--no-public-ip', dest='public_ip', action='store_false', default=True,
         help='Do not assign a public interface to this VM')
+    create_vm_parser.add_argument(
+        '--memory', type=int, help='Memory of the VM in MiB', required=False)
+    create_vm_parser.add_argument(
+        '--vcpus', type=int, help='Number of vCPUs of the VM', required=False)
+    create_vms_parser = subparsers.add_parser('create-vms')
+    create_vms_parser.add_argument(
+        '--image', help='Name of the image to create the VMs from',
+        required=True)
+    create_vms_parser.add_argument(
+        '--count', type=int, help='Number of VMs to create', required=True)
+    create_vms_parser.add_argument(
+        '--vpn', help='Name of the VPN all VMs join', required=False)
+    create_vms_parser.add_argument(
+        '--no-public-ip', dest='public_ip', action='store_false', default=True,
+        help='Do not assign a public interface to the VMs')
+    create_vms_parser.add_argument(
+        '--memory', type=int, help='Memory of each VM in MiB', required=False)
+    create_vms_parser.add_argument(
+        '--vcpus', type=int, help='Number of vCPUs of each VM',
+        required=False)
     start_vm_parser = subparsers.add_parser('start-vm')
     start_vm_parser.add_argument(
         '--vm-id', dest='vm_id', help='ID of the VM to start', required=True)
@@ -86,6 +381,10 @@ def main():
     delete_vm_parser.add_argument(
         '--vm-id', dest='vm_id', help='ID of the VM to delete', required=True)
     subparsers.add_parser('list-vms')
+    operation_info_parser = subparsers.add_parser('operation-info')
+    operation_info_parser.add_argument(
+        '--operation-id', dest='operation_id', required=True,
+        help='ID of the operation from the execution-info of a response')
 
     args = parser.parse_args()
 
@@ -108,9 +407,40 @@ def main():
         if args.vpn:
             data['options']['vpn'] = args.vpn
 
+        if args.memory:
+            data['options']['memory'] = args.memory
+
+        if args.vcpus:
+            data['options']['vcpus'] = args.vcpus
+
+        if args.report_progress:
+            data['options']['report-progress'] = True
+
         if args.init_script_path:
             with open(args.init_script_path, 'rt') as f:
                 data['options']['init-script'] = f.read()
+
+            if args.init_method:
+                data['options']['init-method'] = args.init_method
+    elif args.subparser_name == 'create-vms':
+        response_expected = True
+        data = {
+            'command': 'create-vms',
+            'options': {
+                'image': args.image,
+                'count': args.count,
+                'public-ip': args.public_ip,
+            }
+        }
+
+        if args.vpn:
+            data['options']['vpn'] = args.vpn
+
+        if args.memory:
+            data['options']['memory'] = args.memory
+
+        if args.vcpus:
+            data['options']['vcpus'] = args.vcpus
     elif args.subparser_name == 'stop-vm':
         response_expected = True
         data = {
@@ -128,12 +458,20 @@ def main():
                 'vm-id': args.vm_id,
             }
         }
+    elif args.subparser_name == 'operation-info':
+        response_expected = True
+        data = {
+            'command': 'operation-info',
+            'options': {
+                'operation-id': args.operation_id,
+            }
+        }
     else:
         parser.print_usage()
         sys.exit(1)
 
     try:
-        with ServerCommunication() as c:
+        with ServerCommunication(timeout=args.timeout) as c:
             result = c.send_msg(data, response_expected)
             print(json.dumps(result))
     except pika.exceptions.AMQPConnectionError:
@@ -1,3 +1,6 @@
+import concurrent.futures
+import contextvars
+from dataclasses import dataclass, field
 import logging
 import os
 from pathlib import Path
@@ -7,38 +10,47 @@ import re
 import shlex
 import shutil
 import string
-import subprocess
 import tempfile
-from typing import List, Optional, Dict, Any, Tuple, Iterator
+import threading
+from typing import \
+    List, Optional, Dict, Any, Tuple, Iterator, Callable, Generator
 
 from aetherscale.paths import \
     user_image_path, qemu_socket_monitor, qemu_socket_guest_agent, \
-    resource_config_path, ResourceType
+    qemu_socket_events, resource_config_path, seed_directory_path, \
+    ResourceType
 from . import networking
+from .operations import Operation
 from .qemu import image, runtime
 from .qemu.exceptions import QemuException
 from . import config
+from . import metrics
 from . import services
+from . import timing
 from .vpn.tinc import TincVirtualNetwork
 import aetherscale.vpn.radvd
 
 
 RADVD_SERVICE_NAME = 'aetherscale-radvd.service'
 
+VMS = metrics.gauge('aetherscale_vms', 'VMs on this host by state', ['state'])
+
 logging.basicConfig(level=config.LOG_LEVEL)
 
 
-def create_user_image(vm_id: str, image_name: str) -> Path:
+def create_user_image(
+        vm_id: str, image_name: str,
+        overlay_pool: Optional[image.OverlayPool] = None) -> Path:
     base_image = config.BASE_IMAGE_FOLDER / f'{image_name}.qcow2'
     if not base_image.is_file():
         raise IOError(f'Image "{image_name}" does not exist')
 
     user_image = user_image_path(vm_id)
 
-    create_img_result = subprocess.run([
-        'qemu-img', 'create', '-f', 'qcow2',
-        '-b', str(base_image.absolute()), '-F', 'qcow2', str(user_image)])
-    if create_img_result.returncode != 0:
+    if overlay_pool and overlay_pool.acquire(image_name, user_image):
+        return user_image
+
+    if not image.create_overlay(base_image, user_image):
         raise QemuException(f'Could not create image for VM "{vm_id}"')
 
     return user_image
@@ -54,22 +66,30 @@ def teardown_script_path(resource_folder: Path, tap_name: str) -> Path:
 
 def setup_tap_device(
         resource_type: ResourceType, resource_name: str,
-        tap_name: str, bridge: str) -> Tuple[Path, Path]:
+        tap_name: str, bridge: str) -> Tuple[Path, Optional[Path]]:
+    """Write scripts that create the TAP device before the VM starts and
+    delete it after the VM stopped
+
+    Devices from the TAP pool already exist and are kept when the VM stops.
+    Their setup script only re-creates them if they are missing (e.g. after
+    a reboot), and they have no teardown script."""
     resource_folder = resource_config_path(resource_type, resource_name)
+    pooled = networking.is_pooled_tap(tap_name)
 
-    iproute = networking.Iproute2Network()
-    iproute.tap_device(tap_name, config.USER, bridge)
+    iproute = networking.create_network()
+    iproute.tap_device(tap_name, config.USER, bridge, force=pooled)
 
     setup_script = setup_script_path(resource_folder, tap_name)
-    teardown_script = teardown_script_path(resource_folder, tap_name)
-
     setup_script.parent.mkdir(parents=True, exist_ok=True)
-    teardown_script.parent.mkdir(parents=True, exist_ok=True)
 
     with open(setup_script, 'w') as f:
         f.write(iproute.setup_script())
     os.chmod(setup_script, 0o755)
 
+    if pooled:
+        return setup_script, None
+
+    teardown_script = teardown_script_path(resource_folder, tap_name)
     with open(teardown_script, 'w') as f:
         f.write(iproute.teardown_script())
     os.chmod(teardown_script, 0o755)
@@ -77,62 +97,127 @@ def setup_tap_device(
     return setup_script, teardown_script
 
 
+@dataclass
+class VmRecord:
+    vm_id: str
+    unit_name: str
+    image: Path
+    status: str
+    interfaces: List[str] = field(default_factory=list)
+    pid: Optional[int] = None
+    # memory in MiB, read from the QEMU process of VMs that were started
+    # before aetherscale
+    memory: int = config.VM_MEMORY
+    vcpus: int = config.VM_VCPUS
+    # no process exit notification will arrive for the VM, so its status
+    # has to be checked with the service manager
+    stale: bool = False
+
+
+@dataclass
+class PreparedVm:
+    """A VM whose image and network devices exist, but whose unit is not
+    installed yet"""
+    vm_id: str
+    qemu_config: runtime.QemuStartupConfig
+    tap_devices: List[str]
+    setup_scripts: List[Path]
+    teardown_scripts: List[Path]
+
+    @property
+    def unit_name(self) -> str:
+        return systemd_unit_name_for_vm(self.vm_id)
+
+
 class ComputingHandler:
     def __init__(
             self, radvd: aetherscale.vpn.radvd.Radvd,
-            service_manager: services.ServiceManager):
+            service_manager: services.ServiceManager,
+            watch_qemu_events: bool = False,
+            overlay_pool: Optional[image.OverlayPool] = None,
+            tap_pool: Optional[networking.TapPool] = None):
 
         self.radvd = radvd
         self.service_manager = service_manager
-
-        self.established_vpns = self._load_existing_vpns()
+        self.overlay_pool = overlay_pool
+        self.tap_pool = tap_pool
+
+        # VPNs are read from disk on first use and whenever a VPN folder was
+        # added or removed, see established_vpns
+        self._vpns: Optional[Dict[str, TincVirtualNetwork]] = None
+        self._vpns_mtime: Optional[int] = None
+        self._vpns_lock = threading.Lock()
         self.available_vpn_ports = config.VPN_PORTS
+        # VMs might be created in parallel, but each VPN must only be
+        # established once
+        self._vpn_lock = threading.Lock()
+
+        self.qemu_connections = runtime.QemuConnectionPool()
+
+        # All VMs on this host, so that reading the state of VMs does not
+        # require to ask systemd or to scan all processes
+        self._inventory_lock = threading.Lock()
+        self.inventory = self._load_inventory()
+        VMS.set_function(self._count_vms_by_state)
+
+        if self.tap_pool:
+            self.tap_pool.reserve(
+                interface for record in self._records()
+                for interface in record.interfaces)
+
+        # Without QEMU events we do not get notified when a VM process exits
+        self.qemu_events: Optional[runtime.QemuEventListener] = None
+        if watch_qemu_events:
+            self.qemu_events = runtime.QemuEventListener(
+                on_event=self._on_qemu_event,
+                on_close=self._on_qemu_close,
+                on_connect=self._on_qemu_connect,
+                on_connect_failed=self._mark_stale)
+
+            for record in self._records():
+                if record.status == 'running':
+                    self.qemu_events.watch(
+                        record.vm_id, qemu_socket_events(record.vm_id))
+
+    @property
+    def established_vpns(self) -> Dict[str, TincVirtualNetwork]:
+        """VPNs on this host
+
+        Reading the VPNs requires to parse the configuration of each VPN, so
+        they are only read again if the modification time of the VPN folder
+        changed."""
+        vpn_folder = config.AETHERSCALE_CONFIG_DIR / 'vpn'
+        try:
+            mtime: Optional[int] = vpn_folder.stat().st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
 
-    def list_vms(self, _: Dict[str, Any]) -> Iterator[List[Dict[str, Any]]]:
-        all_vms = []
-        for service in self.service_manager.list_services():
-            try:
-                all_vms.append(vm_id_from_systemd_unit(service))
-            except ValueError:
-                # Not a VM systemd unit
-                pass
+        with self._vpns_lock:
+            if self._vpns is None or mtime != self._vpns_mtime:
+                self._vpns = self._load_existing_vpns()
+                self._vpns_mtime = mtime
 
-        running_vms = []
-        for proc in psutil.process_iter(['pid', 'name']):
-            if proc.name().startswith('vm-'):
-                vm_id = proc.name()[3:]
-                running_vms.append(vm_id)
+            return self._vpns
 
-        orphaned_vms = set(running_vms).difference(all_vms)
-        for orphaned_vm in orphaned_vms:
-            logging.warning(f'VM "{orphaned_vm} is orphaned')
+    def list_vms(self, _: Dict[str, Any]) -> Iterator[List[Dict[str, Any]]]:
+        records = self._records()
+        self._refresh_stale(records)
+        ip_infos = self._fetch_ip_addresses(
+            [record.vm_id for record in records
+             if record.status == 'running'])
 
         vms = []
-        for vm_id in all_vms:
-            if vm_id not in running_vms:
+        for record in records:
+            if record.vm_id not in ip_infos:
                 vms.append({
-                    'vm-id': vm_id,
+                    'vm-id': record.vm_id,
                 })
             else:
-                # Fetch IP info for running VMs
                 # TODO: IP info should be moved to a details request
-                socket_file = qemu_socket_guest_agent(vm_id)
-                hint = None
-                ip_addresses = []
-                try:
-                    fetcher = runtime.GuestAgentIpAddress(socket_file)
-                    ip_addresses = fetcher.fetch_ip_addresses()
-                except QemuException:
-                    hint = 'Could not retrieve IP address for guest'
-
-                msg = {
-                    'vm-id': vm_id,
-                    'ip-addresses': ip_addresses,
-                }
-                if hint:
-                    msg['hint'] = hint
-
-                vms.append(msg)
+                vms.append({
+                    'vm-id': record.vm_id,
+                    **ip_infos[record.vm_id],
+                })
 
         yield vms
 
@@ -142,24 +227,20 @@ class ComputingHandler:
         except KeyError:
             raise ValueError('VM ID not specified')
 
-        unit_name = systemd_unit_name_for_vm(vm_id)
-        if not self.service_manager.service_exists(unit_name):
-            raise RuntimeError('VM does not exist')
-
-        # TODO: Distinguish better between status, define good lifecycle
-        if self.service_manager.service_is_running(unit_name):
-            status = 'running'
-        else:
-            status = 'stopped'
+        record = self._get_record(vm_id)
 
         yield {
             'vm-id': vm_id,
-            'status': status,
+            'status': self._vm_status(record),
         }
 
-    def create_vm(self, options: Dict[str, Any]) -> Iterator[Dict[str, str]]:
-        vm_id = ''.join(
-            random.choice(string.ascii_lowercase) for _ in range(8))
+    def create_vm(self, options: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+        """Create and start a VM
+
+        With the option "report-progress" a progress message with the
+        duration of each finished phase is yielded. The final message always
+        contains the durations of all phases."""
+        vm_id = new_vm_id()
         logging.info(f'Starting VM "{vm_id}"')
 
         yield {
@@ -167,79 +248,130 @@ class ComputingHandler:
             'vm-id': vm_id,
         }
 
-        try:
-            image_name = os.path.basename(options['image'])
-        except KeyError:
-            raise ValueError('Image not specified')
+        timer = timing.PhaseTimer()
+        report_progress = bool(options.get('report-progress', False))
+
+        def progress(phase: str) -> Iterator[Dict[str, Any]]:
+            if report_progress and phase in timer.durations:
+                yield {
+                    'status': 'progress',
+                    'vm-id': vm_id,
+                    'phase': phase,
+                    'duration': round(timer.durations[phase], 3),
+                }
 
         try:
-            user_image = create_user_image(vm_id, image_name)
-        except (OSError, QemuException):
+            vm = yield from self._prepare_vm(vm_id, options, timer, progress)
+        except Exception:
+            # remove the image and network devices that were already created
+            self.discard_vm(vm_id)
             raise
 
-        if 'init-script' in options:
-            with image.guestmount(user_image) as guest_fs:
-                image.install_startup_script(options['init-script'], guest_fs)
+        with timer.phase('unit-install'):
+            self._install_qemu_units([vm])
+        yield from progress('unit-install')
 
-        qemu_interfaces = []
+        with timer.phase('start'):
+            self.service_manager.start_service(vm.unit_name)
+            self.service_manager.enable_service(vm.unit_name)
+        yield from progress('start')
 
-        network_setup_scripts = []
-        network_teardown_scripts = []
+        self._add_to_inventory(vm)
 
-        if 'vpn' in options:
-            # TODO: Do we have to assign the VPN mac addr to the macvtap?
-            vpn_tap_device = self._establish_vpn(options['vpn'], vm_id)
-
-            resource_folder = resource_config_path(ResourceType.VM, vm_id)
-            network_setup_scripts.append(setup_script_path(
-                resource_folder, vpn_tap_device))
-            network_teardown_scripts.append(
-                teardown_script_path(resource_folder, vpn_tap_device))
-
-            mac_addr_vpn = networking.create_mac_address()
-            logging.debug(
-                f'Assigning MAC address "{mac_addr_vpn}" to '
-                f'VM "{vm_id}" for VPN')
-
-            privnet = runtime.QemuInterfaceConfig(
-                mac_address=mac_addr_vpn,
-                type=runtime.QemuInterfaceType.TAP,
-                tap_device=vpn_tap_device)
-            qemu_interfaces.append(privnet)
+        phases = timer.summary()
+        logging.info(f'Started VM "{vm_id}", phase durations: {phases}')
+        yield {
+            'status': 'starting',
+            'vm-id': vm_id,
+            'phases': phases,
+        }
 
-        if 'public-ip' in options and options['public-ip']:
-            mac_addr = networking.create_mac_address()
-            logging.debug(
-                f'Assigning MAC address "{mac_addr}" to VM "{vm_id}"')
-
-            pub_tap_device = f'pub-{vm_id}'
-            pubnet = runtime.QemuInterfaceConfig(
-                mac_address=mac_addr,
-                type=runtime.QemuInterfaceType.TAP,
-                tap_device=pub_tap_device)
-            qemu_interfaces.append(pubnet)
-
-            setup_script, teardown_script = setup_tap_device(
-                ResourceType.VM, vm_id, pub_tap_device, 'br0')
-            network_setup_scripts.append(setup_script)
-            network_teardown_scripts.append(teardown_script)
+    def create_vms(
+            self, options: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+        """Create and start several VMs
+
+        Either "count" VMs with the same options are created, or one VM for
+        each entry of "vms" whose options override the shared ones. Work
+        that all VMs need is only done once: each VPN is established before
+        the VMs are prepared in parallel, and all units are installed with a
+        single reload of systemd and started together.
+
+        The messages of each VM are yielded as for create_vm, VMs that could
+        not be prepared are removed again and reported as "failed". The
+        final message lists the started and the failed VMs."""
+        specs = batch_specs(options)
+        vm_ids = [new_vm_id() for _ in specs]
+        logging.info(f'Starting VMs {", ".join(vm_ids)}')
+
+        for vm_id in vm_ids:
+            yield {
+                'status': 'allocating',
+                'vm-id': vm_id,
+            }
 
-        qemu_config = runtime.QemuStartupConfig(
-            vm_id=vm_id,
-            hda_image=user_image,
-            interfaces=qemu_interfaces)
+        for vpn_name in sorted(set(spec['vpn'] for spec in specs
+                                   if 'vpn' in spec)):
+            with self._vpn_lock:
+                self._get_or_create_vpn(vpn_name, vm_ids[0])
+
+        def no_progress(phase: str) -> Iterator[Dict[str, Any]]:
+            return iter(())
+
+        timers = {vm_id: timing.PhaseTimer() for vm_id in vm_ids}
+        prepared: List[PreparedVm] = []
+        failed: List[str] = []
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(config.BATCH_WORKERS, len(specs))) \
+                as executor:
+            futures = {
+                executor.submit(
+                    contextvars.copy_context().run, generator_result,
+                    self._prepare_vm(
+                        vm_id, spec, timers[vm_id], no_progress)): vm_id
+                for vm_id, spec in zip(vm_ids, specs)
+            }
 
-        unit_name = systemd_unit_name_for_vm(vm_id)
-        self._create_qemu_systemd_unit(
-            unit_name, qemu_config,
-            network_setup_scripts, network_teardown_scripts)
-        self.service_manager.start_service(unit_name)
-        self.service_manager.enable_service(unit_name)
+            for future in concurrent.futures.as_completed(futures):
+                vm_id = futures[future]
+                try:
+                    prepared.append(future.result())
+                except Exception as e:
+                    logging.exception(f'Could not prepare VM "{vm_id}"')
+                    self.discard_vm(vm_id)
+                    failed.append(vm_id)
+
+                    yield {
+                        'status': 'failed',
+                        'vm-id': vm_id,
+                        'reason': str(e),
+                    }
+
+        batch_timer = timing.PhaseTimer()
+        if prepared:
+            unit_names = [vm.unit_name for vm in prepared]
+
+            with batch_timer.phase('unit-install'):
+                self._install_qemu_units(prepared)
+
+            with batch_timer.phase('start'):
+                self.service_manager.start_services(unit_names)
+                self.service_manager.enable_services(unit_names)
+
+        for vm in prepared:
+            self._add_to_inventory(vm)
+
+            yield {
+                'status': 'starting',
+                'vm-id': vm.vm_id,
+                'phases': {
+                    **timers[vm.vm_id].summary(), **batch_timer.summary()},
+            }
 
-        logging.info(f'Started VM "{vm_id}"')
         yield {
-            'status': 'starting',
-            'vm-id': vm_id,
+            'status': 'finished',
+            'vm-ids': [vm.vm_id for vm in prepared],
+            'failed': failed,
         }
 
     def start_vm(self, options: Dict[str, Any]) -> Iterator[Dict[str, str]]:
@@ -248,11 +380,10 @@ class ComputingHandler:
         except KeyError:
             raise ValueError('VM ID not specified')
 
-        unit_name = systemd_unit_name_for_vm(vm_id)
+        record = self._get_record(vm_id)
+        unit_name = record.unit_name
 
-        if not self.service_manager.service_exists(unit_name):
-            raise RuntimeError('VM does not exist')
-        elif self.service_manager.service_is_running(unit_name):
+        if self._vm_status(record) != 'stopped':
             response = {
                 'status': 'starting',
                 'vm-id': vm_id,
@@ -261,6 +392,8 @@ class ComputingHandler:
         else:
             self.service_manager.start_service(unit_name)
             self.service_manager.enable_service(unit_name)
+            self._set_status(vm_id, 'running')
+            self._watch_qemu_events(vm_id)
 
             response = {
                 'status': 'starting',
@@ -278,11 +411,10 @@ class ComputingHandler:
         kill_flag = bool(options.get('kill', False))
         stop_status = 'killed' if kill_flag else 'stopped'
 
-        unit_name = systemd_unit_name_for_vm(vm_id)
+        record = self._get_record(vm_id)
+        unit_name = record.unit_name
 
-        if not self.service_manager.service_exists(unit_name):
-            raise RuntimeError('VM does not exist')
-        elif not self.service_manager.service_is_running(unit_name):
+        if self._vm_status(record) == 'stopped':
             response = {
                 'status': stop_status,
                 'vm-id': vm_id,
@@ -293,11 +425,17 @@ class ComputingHandler:
 
             if kill_flag:
                 self.service_manager.stop_service(unit_name)
+                self._close_qemu_connections(vm_id)
+                self._set_status(vm_id, 'stopped')
             else:
-                qemu_socket = qemu_socket_monitor(vm_id)
-                qm = runtime.QemuMonitor(
-                    qemu_socket, protocol=runtime.QemuProtocol.QMP)
-                qm.execute('system_powerdown')
+                self.qemu_connections.execute(
+                    qemu_socket_monitor(vm_id), runtime.QemuProtocol.QMP,
+                    'system_powerdown')
+                # the VM is stopped once its process exits
+                self._set_status(vm_id, 'stopping')
+                if not self.qemu_events \
+                        or not self.qemu_events.is_watching(vm_id):
+                    self._mark_stale(vm_id)
 
             response = {
                 'status': stop_status,
@@ -318,25 +456,68 @@ class ComputingHandler:
         # force kill stop when a VM is deleted
         options['kill'] = True
         self._exhaust(self.stop_vm(options))
-
-        unit_name = systemd_unit_name_for_vm(vm_id)
-        user_image = user_image_path(vm_id)
-
-        self.service_manager.uninstall_service(unit_name)
-        user_image.unlink()
-
-        # once we delete the VM, we don't need its setup scripts anymore
-        resource_folder = resource_config_path(ResourceType.VM, vm_id)
-        try:
-            shutil.rmtree(resource_folder)
-        except FileNotFoundError:
-            pass
+        self._remove_vm(vm_id)
 
         yield {
             'status': 'deleted',
             'vm-id': vm_id,
         }
 
+    def discard_vm(self, vm_id: str):
+        """Remove everything that belongs to a VM, also if the VM was only
+        partially created or deleted, e.g. before a restart of aetherscale"""
+        logging.info(f'Discarding VM "{vm_id}"')
+
+        unit_name = systemd_unit_name_for_vm(vm_id)
+        if self.service_manager.service_exists(unit_name):
+            self.service_manager.disable_service(unit_name)
+            self.service_manager.stop_service(unit_name)
+
+        self._remove_vm(vm_id)
+
+    def recover_operation(self, operation: Operation) -> bool:
+        """Clean up after an operation that was interrupted by a restart and
+        return whether its work was complete anyway"""
+        if operation.command in ('create-vm', 'create-vms'):
+            vm_ids: List[str] = []
+            # VMs that were started or already removed after a failure
+            finished = set()
+            for message in operation.messages:
+                if isinstance(message, dict) and 'vm-id' in message:
+                    if message['vm-id'] not in vm_ids:
+                        vm_ids.append(message['vm-id'])
+                    if message.get('status') in ('starting', 'failed'):
+                        finished.add(message['vm-id'])
+
+            for vm_id in vm_ids:
+                if vm_id not in finished:
+                    self.discard_vm(vm_id)
+
+            return len(vm_ids) > 0 and finished.issuperset(vm_ids)
+        elif operation.command == 'delete-vm':
+            vm_id = operation.options.get('vm-id')
+            if vm_id:
+                self.discard_vm(vm_id)
+                return True
+
+        return False
+
+    def committed_resources(self) -> Tuple[int, int, int]:
+        """Memory in MiB and vCPUs of all VMs that are not stopped and the
+        number of these VMs"""
+        active = [
+            record for record in self._records()
+            if record.status != 'stopped']
+
+        return (
+            sum(record.memory for record in active),
+            sum(record.vcpus for record in active),
+            len(active))
+
+    def has_vm(self, vm_id: str) -> bool:
+        with self._inventory_lock:
+            return vm_id in self.inventory
+
     def list_vpns(self, _: Dict[str, Any]) -> Iterator[List[str]]:
         yield [vpn.netname for vpn in self.established_vpns.values()]
 
@@ -355,12 +536,137 @@ class ComputingHandler:
             'vpn-name': vpn.netname,
         }
 
-    def _create_qemu_systemd_unit(
-            self, unit_name: str, qemu_config: runtime.QemuStartupConfig,
-            setup_scripts: List[Path], teardown_scripts: List[Path]):
+    def _prepare_vm(
+            self, vm_id: str, options: Dict[str, Any],
+            timer: timing.PhaseTimer,
+            progress: Callable[[str], Iterator[Dict[str, Any]]]
+    ) -> Generator[Dict[str, Any], None, 'PreparedVm']:
+        """Create the image and network devices of a VM, yields the progress
+        messages of each phase and returns the prepared VM"""
+        try:
+            image_name = os.path.basename(options['image'])
+        except KeyError:
+            raise ValueError('Image not specified')
+
+        memory, vcpus = vm_resources(options)
+
+        with timer.phase('image'):
+            user_image = create_user_image(
+                vm_id, image_name, self.overlay_pool)
+        yield from progress('image')
+
+        seed_directory = None
+        if 'init-script' in options:
+            init_method = options.get('init-method', config.INIT_SCRIPT_METHOD)
+
+            with timer.phase('init-script'):
+                if init_method == 'cloud-init':
+                    seed_directory = seed_directory_path(vm_id)
+                    image.create_seed_directory(
+                        vm_id, options['init-script'], seed_directory)
+                elif init_method == 'guestmount':
+                    with image.guestmount(user_image) as guest_fs:
+                        image.install_startup_script(
+                            options['init-script'], guest_fs)
+                else:
+                    raise ValueError(f'Unknown init-method "{init_method}"')
+            yield from progress('init-script')
+
+        qemu_interfaces = []
+        tap_devices = []
+
+        network_setup_scripts = []
+        network_teardown_scripts = []
+
+        if 'vpn' in options:
+            with timer.phase('vpn'):
+                # TODO: Do we have to assign the VPN mac addr to the macvtap?
+                vpn_tap_device, setup_script, teardown_script = \
+                    self._establish_vpn(options['vpn'], vm_id)
+
+                network_setup_scripts.append(setup_script)
+                if teardown_script:
+                    network_teardown_scripts.append(teardown_script)
+
+                mac_addr_vpn = networking.create_mac_address()
+                logging.debug(
+                    f'Assigning MAC address "{mac_addr_vpn}" to '
+                    f'VM "{vm_id}" for VPN')
+
+                privnet = runtime.QemuInterfaceConfig(
+                    mac_address=mac_addr_vpn,
+                    type=runtime.QemuInterfaceType.TAP,
+                    tap_device=vpn_tap_device)
+                qemu_interfaces.append(privnet)
+                tap_devices.append(vpn_tap_device)
+            yield from progress('vpn')
+
+        if 'public-ip' in options and options['public-ip']:
+            with timer.phase('public-ip'):
+                mac_addr = networking.create_mac_address()
+                logging.debug(
+                    f'Assigning MAC address "{mac_addr}" to VM "{vm_id}"')
+
+                pub_tap_device = self._acquire_tap_device(
+                    'br0', f'pub-{vm_id}')
+                pubnet = runtime.QemuInterfaceConfig(
+                    mac_address=mac_addr,
+                    type=runtime.QemuInterfaceType.TAP,
+                    tap_device=pub_tap_device)
+                qemu_interfaces.append(pubnet)
+                tap_devices.append(pub_tap_device)
+
+                setup_script, teardown_script = setup_tap_device(
+                    ResourceType.VM, vm_id, pub_tap_device, 'br0')
+                network_setup_scripts.append(setup_script)
+                if teardown_script:
+                    network_teardown_scripts.append(teardown_script)
+            yield from progress('public-ip')
+
+        qemu_config = runtime.QemuStartupConfig(
+            vm_id=vm_id,
+            hda_image=user_image,
+            interfaces=qemu_interfaces,
+            seed_directory=seed_directory,
+            memory=memory, vcpus=vcpus)
+
+        return PreparedVm(
+            vm_id=vm_id, qemu_config=qemu_config, tap_devices=tap_devices,
+            setup_scripts=network_setup_scripts,
+            teardown_scripts=network_teardown_scripts)
+
+    def _install_qemu_units(self, vms: List['PreparedVm']):
+        """Install the units of all VMs with a single reload of systemd"""
+        unit_files = [
+            (self._write_qemu_unit_file(
+                vm.qemu_config, vm.setup_scripts, vm.teardown_scripts),
+             vm.unit_name)
+            for vm in vms
+        ]
+
+        try:
+            self.service_manager.install_services(unit_files)
+        finally:
+            for unit_file, _ in unit_files:
+                os.remove(unit_file)
+
+    def _add_to_inventory(self, vm: 'PreparedVm'):
+        with self._inventory_lock:
+            self.inventory[vm.vm_id] = VmRecord(
+                vm_id=vm.vm_id, unit_name=vm.unit_name,
+                image=vm.qemu_config.hda_image, status='running',
+                interfaces=vm.tap_devices, memory=vm.qemu_config.memory,
+                vcpus=vm.qemu_config.vcpus)
+        self._watch_qemu_events(vm.vm_id)
+
+    def _write_qemu_unit_file(
+            self, qemu_config: runtime.QemuStartupConfig,
+            setup_scripts: List[Path], teardown_scripts: List[Path]) -> Path:
+        """Write the unit of a VM to a temporary file"""
         qemu_name = \
             f'qemu-vm-{qemu_config.vm_id},process=vm-{qemu_config.vm_id}'
         qemu_monitor_path = qemu_socket_monitor(qemu_config.vm_id)
+        qemu_events_path = qemu_socket_events(qemu_config.vm_id)
         qga_monitor_path = qemu_socket_guest_agent(qemu_config.vm_id)
         qga_chardev = f'socket,path={qga_monitor_path},server,nowait,id=qga0'
 
@@ -368,17 +674,30 @@ class ComputingHandler:
             'qemu-system-x86_64',
             '-nographic',
             '-cpu', 'host',
-            '-m', '4096',
+            '-m', str(qemu_config.memory),
+            '-smp', str(qemu_config.vcpus),
             '-accel', 'kvm',
             '-hda', str(qemu_config.hda_image.absolute()),
             '-name', qemu_name,
             '-qmp', f'unix:{qemu_monitor_path},server,nowait',
+            # QMP only serves one client per socket, so asynchronous events
+            # are received on a separate monitor
+            '-qmp', f'unix:{qemu_events_path},server,nowait',
             '-chardev', qga_chardev,
             '-device', 'virtio-serial',
             '-device',
             'virtserialport,chardev=qga0,name=org.qemu.guest_agent.0',
         ]
 
+        if qemu_config.seed_directory:
+            # cloud-init finds its NoCloud seed by the label cidata
+            command += [
+                '-drive',
+                'if=virtio,format=raw,readonly=on,file.driver=vvfat,'
+                f'file.dir={qemu_config.seed_directory.absolute()},'
+                'file.label=cidata',
+            ]
+
         for i, interface in enumerate(qemu_config.interfaces):
             device = \
                 f'virtio-net-pci,netdev=net{i},mac={interface.mac_address}'
@@ -412,10 +731,38 @@ class ComputingHandler:
             f.write('[Install]\n')
             f.write('WantedBy=default.target\n')
 
-        self.service_manager.install_service(Path(f.name), unit_name)
-        os.remove(f.name)
+        return Path(f.name)
+
+    def _establish_vpn(
+            self, vpn_name: str,
+            vm_id: str) -> Tuple[str, Path, Optional[Path]]:
+        with self._vpn_lock:
+            vpn = self._get_or_create_vpn(vpn_name, vm_id)
 
-    def _establish_vpn(self, vpn_name: str, vm_id: str) -> str:
+        # Create a new tap device for the VM to use
+        associated_tap_device = self._acquire_tap_device(
+            vpn.bridge_interface_name, 'vpn-' + vm_id)
+        setup_script, teardown_script = setup_tap_device(
+            ResourceType.VM, vm_id,
+            associated_tap_device, vpn.bridge_interface_name)
+
+        logging.debug(
+            f'Created TAP device {associated_tap_device} for VM {vm_id}')
+
+        return associated_tap_device, setup_script, teardown_script
+
+    def _acquire_tap_device(self, bridge: str, fallback_name: str) -> str:
+        """Name of a TAP device for a new VM, a spare device of the bridge
+        if available"""
+        if self.tap_pool:
+            device = self.tap_pool.acquire(bridge)
+            if device:
+                return device
+
+        return fallback_name
+
+    def _get_or_create_vpn(
+            self, vpn_name: str, vm_id: str) -> TincVirtualNetwork:
         if self.radvd:
             vpn_network_prefix = self.radvd.generate_prefix()
         else:
@@ -439,7 +786,7 @@ class ComputingHandler:
             # this is only because I want to proxy IP traffic from the host to
             # the guest
             host_vpn_ip = vpn_network_prefix.replace('/64', '1')
-            iproute = networking.Iproute2Network()
+            iproute = networking.create_network()
             iproute.tap_device(vpn.interface_name, aetherscale.config.USER)
             iproute.bridged_network(
                 vpn.bridge_interface_name, vpn.interface_name,
@@ -460,24 +807,218 @@ class ComputingHandler:
                     f'Added device {vpn.bridge_interface_name} to radvd '
                     f'with IPv6 address range {vpn_network_prefix}')
 
-        # Create a new tap device for the VM to use
-        associated_tap_device = 'vpn-' + vm_id
-        setup_tap_device(
-            ResourceType.VM, vm_id,
-            associated_tap_device, vpn.bridge_interface_name)
+        return vpn
 
-        logging.debug(
-            f'Created TAP device {associated_tap_device} for VM {vm_id}')
+    def _fetch_ip_addresses(
+            self, vm_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Query the guest agents of all given VMs concurrently
+
+        Guests that do not answer before the overall deadline are reported
+        with a hint instead of delaying the response for all other VMs."""
+        if len(vm_ids) == 0:
+            return {}
+
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(config.QGA_MAX_WORKERS, len(vm_ids)))
+        futures = {
+            executor.submit(
+                fetch_guest_ip_addresses, vm_id, self.qemu_connections): vm_id
+            for vm_id in vm_ids
+        }
+        done, _ = concurrent.futures.wait(
+            futures,
+            timeout=timing.remaining_timeout(config.QGA_LIST_DEADLINE))
+        # do not wait for hung guest agents, their queries time out on their
+        # own in the background
+        executor.shutdown(wait=False, cancel_futures=True)
+
+        infos = {}
+        for future, vm_id in futures.items():
+            if future in done and future.exception() is None:
+                infos[vm_id] = {'ip-addresses': future.result()}
+            else:
+                if future not in done:
+                    logging.warning(
+                        f'Guest agent of VM "{vm_id}" did not answer in time')
+
+                infos[vm_id] = {
+                    'ip-addresses': [],
+                    'hint': 'Could not retrieve IP address for guest',
+                }
+
+        return infos
+
+    def _load_inventory(self) -> Dict[str, VmRecord]:
+        vm_ids = []
+        for service in self.service_manager.list_services():
+            try:
+                vm_ids.append(vm_id_from_systemd_unit(service))
+            except ValueError:
+                # Not a VM systemd unit
+                pass
+
+        pids = {}
+        resources = {}
+        for proc in psutil.process_iter(['pid', 'name', 'cmdline']):
+            name = proc.info['name'] or ''
+            if name.startswith('vm-'):
+                pids[name[3:]] = proc.info['pid']
+                resources[name[3:]] = qemu_resources(proc.info['cmdline'])
+
+        orphaned_vms = set(pids.keys()).difference(vm_ids)
+        for orphaned_vm in orphaned_vms:
+            logging.warning(f'VM "{orphaned_vm} is orphaned')
+
+        inventory = {}
+        for vm_id in vm_ids:
+            inventory[vm_id] = VmRecord(
+                vm_id=vm_id,
+                unit_name=systemd_unit_name_for_vm(vm_id),
+                image=user_image_path(vm_id),
+                status='running' if vm_id in pids else 'stopped',
+                interfaces=tap_devices_for_vm(vm_id),
+                pid=pids.get(vm_id),
+                **resources.get(vm_id, {}))
+
+        return inventory
+
+    def _count_vms_by_state(self) -> Dict[Tuple[str], int]:
+        counts = {}
+        for record in self._records():
+            counts[(record.status,)] = counts.get((record.status,), 0) + 1
+
+        return counts
 
-        return associated_tap_device
+    def _records(self) -> List[VmRecord]:
+        with self._inventory_lock:
+            return list(self.inventory.values())
+
+    def _get_record(self, vm_id: str) -> VmRecord:
+        with self._inventory_lock:
+            try:
+                return self.inventory[vm_id]
+            except KeyError:
+                raise RuntimeError('VM does not exist')
+
+    def _set_status(self, vm_id: str, status: str):
+        with self._inventory_lock:
+            if vm_id in self.inventory:
+                self.inventory[vm_id].status = status
+
+                if status == 'stopped':
+                    self.inventory[vm_id].pid = None
+                    self.inventory[vm_id].stale = False
+
+    def _mark_stale(self, vm_id: str):
+        with self._inventory_lock:
+            if vm_id in self.inventory:
+                self.inventory[vm_id].stale = True
+
+    def _vm_status(self, record: VmRecord) -> str:
+        self._refresh_stale([record])
+        return record.status
+
+    def _refresh_stale(self, records: List[VmRecord]):
+        """Ask the service manager whether the processes of stale VMs (e.g.
+        VMs whose unit has no events socket) are still running
+
+        All VMs are checked at once, so that listing VMs does not require
+        a call for each VM."""
+        stale = [
+            record for record in records
+            if record.stale and record.status in ('running', 'stopping')]
+        if len(stale) == 0:
+            return
+
+        try:
+            running = self.service_manager.running_services(
+                [record.unit_name for record in stale])
+        except services.ServiceException as e:
+            # keep the recorded status if systemd does not answer
+            logging.warning(str(e))
+            return
+
+        for record in stale:
+            if record.unit_name not in running:
+                self._set_status(record.vm_id, 'stopped')
+
+    def _watch_qemu_events(self, vm_id: str):
+        if self.qemu_events:
+            self.qemu_events.watch(vm_id, qemu_socket_events(vm_id))
+
+    def _on_qemu_connect(self, vm_id: str, pid: Optional[int]):
+        # the unit of a VM that was created before a restart of aetherscale
+        # determines its resources
+        resources = {}
+        if pid:
+            try:
+                resources = qemu_resources(psutil.Process(pid).cmdline())
+            except psutil.Error:
+                pass
+
+        with self._inventory_lock:
+            if vm_id in self.inventory:
+                self.inventory[vm_id].pid = pid
+                self.inventory[vm_id].stale = False
+                for key, value in resources.items():
+                    setattr(self.inventory[vm_id], key, value)
+
+    def _on_qemu_event(self, vm_id: str, event: Dict[str, Any]):
+        logging.debug(f'Received event {event["event"]} for VM "{vm_id}"')
+
+        if event['event'] == 'STOP':
+            self._set_status(vm_id, 'paused')
+        elif event['event'] == 'RESUME':
+            self._set_status(vm_id, 'running')
+
+    def _on_qemu_close(self, vm_id: str):
+        logging.info(f'Process of VM "{vm_id}" exited')
+        self._set_status(vm_id, 'stopped')
+        self._close_qemu_connections(vm_id)
+
+    def _close_qemu_connections(self, vm_id: str):
+        self.qemu_connections.close(qemu_socket_monitor(vm_id))
+        self.qemu_connections.close(qemu_socket_guest_agent(vm_id))
+
+    def _remove_vm(self, vm_id: str):
+        """Remove the unit, image, TAP devices and configuration of a
+        stopped VM, missing parts are skipped"""
+        unit_name = systemd_unit_name_for_vm(vm_id)
+        user_image = user_image_path(vm_id)
+
+        self.service_manager.uninstall_service(unit_name)
+        self._close_qemu_connections(vm_id)
+        with self._inventory_lock:
+            record = self.inventory.pop(vm_id, None)
+        user_image.unlink(missing_ok=True)
+
+        # pooled TAP devices are not deleted when the VM stops
+        interfaces = record.interfaces if record else tap_devices_for_vm(vm_id)
+        for interface in filter(networking.is_pooled_tap, interfaces):
+            if self.tap_pool:
+                self.tap_pool.release(interface)
+            else:
+                networking.delete_device(interface)
+
+        # once we delete the VM, we don't need its setup scripts anymore
+        resource_folder = resource_config_path(ResourceType.VM, vm_id)
+        try:
+            shutil.rmtree(resource_folder)
+        except FileNotFoundError:
+            pass
 
     def _exhaust(self, generator):
         all(generator)
 
     def _load_existing_vpns(self) -> Dict[str, TincVirtualNetwork]:
-        vpns = {}
+        vpns: Dict[str, TincVirtualNetwork] = {}
 
-        for folder in (config.AETHERSCALE_CONFIG_DIR / 'vpn').iterdir():
+        vpns_folder = config.AETHERSCALE_CONFIG_DIR / 'vpn'
+        if not vpns_folder.is_dir():
+            # no VPN was created on this host yet
+            return vpns
+
+        for folder in vpns_folder.iterdir():
             logging.debug(f'Loading existing VPN "{folder.name}"')
 
             netname = folder.name
@@ -485,11 +1026,16 @@ class ComputingHandler:
             port = 0
             vpn_folder = config.AETHERSCALE_CONFIG_DIR / 'vpn' / netname
             tinc_conf = vpn_folder / 'tinc/tinc.conf'
-            with open(tinc_conf) as f:
-                for line in f:
-                    m = re.match(r'Port\s*=\s*(\d+)', line)
-                    if m:
-                        port = int(m.group(1))
+            try:
+                with open(tinc_conf) as f:
+                    for line in f:
+                        m = re.match(r'Port\s*=\s*(\d+)', line)
+                        if m:
+                            port = int(m.group(1))
+            except FileNotFoundError:
+                # VPN is still being created
+                logging.debug(f'VPN "{netname}" has no tinc.conf')
+                continue
 
             if port > 0:
                 vpns[netname] = TincVirtualNetwork(
@@ -498,6 +1044,110 @@ class ComputingHandler:
         return vpns
 
 
+def fetch_guest_ip_addresses(
+        vm_id: str,
+        pool: Optional[runtime.QemuConnectionPool] = None) -> List[str]:
+    socket_file = qemu_socket_guest_agent(vm_id)
+
+    try:
+        fetcher = runtime.GuestAgentIpAddress(socket_file, pool=pool)
+        return fetcher.fetch_ip_addresses()
+    except OSError as e:
+        # e.g. socket file does not exist or guest agent refused connection
+        raise QemuException(f'Could not connect to guest agent: {e}')
+
+
+def tap_devices_for_vm(vm_id: str) -> List[str]:
+    resource_folder = resource_config_path(ResourceType.VM, vm_id)
+    if not resource_folder.is_dir():
+        return []
+
+    suffix = '-setup.sh'
+    return sorted(
+        script.name[:-len(suffix)]
+        for script in resource_folder.glob(f'*{suffix}'))
+
+
+def vm_resources(options: Dict[str, Any]) -> Tuple[int, int]:
+    """Memory in MiB and number of vCPUs a VM is created with"""
+    try:
+        memory = int(options.get('memory', config.VM_MEMORY))
+        vcpus = int(options.get('vcpus', config.VM_VCPUS))
+    except (TypeError, ValueError):
+        raise ValueError('"memory" and "vcpus" must be numbers')
+
+    if memory <= 0 or vcpus <= 0:
+        raise ValueError('"memory" and "vcpus" must be positive')
+
+    return memory, vcpus
+
+
+def qemu_resources(cmdline: Optional[List[str]]) -> Dict[str, int]:
+    """Memory in MiB and vCPUs from the command line of a QEMU process"""
+    resources = {}
+    arguments = cmdline or []
+
+    for option, value in zip(arguments, arguments[1:]):
+        # e.g. "-m 4096", "-m 4G" or "-smp 2" and "-smp cpus=2,sockets=1"
+        value = value.split(',')[0].split('=')[-1]
+        if option == '-m':
+            m = re.fullmatch(r'(\d+)([MG]?)', value)
+            if m:
+                factor = 1024 if m.group(2) == 'G' else 1
+                resources['memory'] = int(m.group(1)) * factor
+        elif option == '-smp' and value.isdigit():
+            resources['vcpus'] = int(value)
+
+    return resources
+
+
+def new_vm_id() -> str:
+    return ''.join(random.choice(string.ascii_lowercase) for _ in range(8))
+
+
+def batch_specs(options: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Options of each VM of a create-vms command"""
+    shared = {
+        key: value for key, value in options.items()
+        if key not in ('count', 'vms')}
+
+    if 'vms' in options:
+        vms = options['vms']
+        if not isinstance(vms, list) \
+                or not all(isinstance(vm, dict) for vm in vms):
+            raise ValueError('"vms" must be a list of VM options')
+
+        specs = [{**shared, **vm} for vm in vms]
+    elif 'count' in options:
+        try:
+            count = int(options['count'])
+        except (TypeError, ValueError):
+            raise ValueError('"count" must be a number')
+
+        specs = [dict(shared) for _ in range(count)]
+    else:
+        raise ValueError('Neither "count" nor "vms" specified')
+
+    if not 0 < len(specs) <= config.MAX_BATCH_SIZE:
+        raise ValueError(
+            f'Number of VMs must be between 1 and {config.MAX_BATCH_SIZE}')
+    if not all('image' in spec for spec in specs):
+        raise ValueError('Image not specified')
+    for spec in specs:
+        vm_resources(spec)
+
+    return specs
+
+
+def generator_result(generator: Generator[Any, None, Any]) -> Any:
+    """Exhaust a generator and return its return value"""
+    while True:
+        try:
+            next(generator)
+        except StopIteration as e:
+            return e.value
+
+
 def get_process_for_vm(vm_id: str) -> Optional[psutil.Process]:
     for proc in psutil.process_iter(['name']):
         if proc.name() == vm_id:
@@ -0,0 +1,72 @@
+from collections import deque
+import concurrent.futures
+import logging
+import threading
+from typing import Callable, Deque, Dict, Hashable, Optional
+
+
+class KeyedExecutor:
+    """Run tasks on a thread pool
+
+    Tasks that share a key are run one after another in the order in which
+    they were submitted, tasks with different keys (or without a key) run
+    in parallel."""
+
+    def __init__(self, max_workers: int, thread_name_prefix: str = 'worker'):
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        # waiting tasks per key, a key is present while one of its tasks runs
+        self._queues: Dict[Hashable, Deque[Callable[[], None]]] = {}
+        self._in_flight = 0
+
+    @property
+    def in_flight(self) -> int:
+        """Number of tasks that were submitted but have not finished yet"""
+        with self._lock:
+            return self._in_flight
+
+    def submit(self, key: Optional[Hashable], fn: Callable[[], None]):
+        with self._lock:
+            self._in_flight += 1
+
+            if key is not None:
+                if key in self._queues:
+                    self._queues[key].append(fn)
+                    return
+
+                self._queues[key] = deque()
+
+        self._executor.submit(self._run, key, fn)
+
+    def shutdown(self, wait: bool = True):
+        if wait:
+            # queued tasks of a key are only submitted to the pool once their
+            # predecessor finished, so wait for them explicitly
+            with self._idle:
+                self._idle.wait_for(lambda: self._in_flight == 0)
+
+        self._executor.shutdown(wait=wait)
+
+    def _run(self, key: Optional[Hashable], fn: Callable[[], None]):
+        try:
+            fn()
+        except Exception:
+            logging.exception('Unhandled exception in worker')
+
+        with self._lock:
+            self._in_flight -= 1
+            self._idle.notify_all()
+
+            if key is None:
+                return
+
+            queue = self._queues[key]
+            if len(queue) == 0:
+                del self._queues[key]
+                return
+
+            next_fn = queue.popleft()
+
+        self._executor.submit(self._run, key, next_fn)
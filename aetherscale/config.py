@@ -22,4 +22,80 @@ VPN_NUM_PREPARED_INTERFACES = 2
 VPN_48_PREFIX = 'fde7:2361:234a'
 VPN_PORTS = set(range(50000, 51000))
 
+# "systemctl" forks systemctl for each operation, "dbus" talks to systemd
+# over a single D-Bus connection (requires jeepney)
+SERVICE_MANAGER = os.getenv('SERVICE_MANAGER', default='systemctl')
+
+# "iproute2" runs an ip process for each network change and device lookup,
+# "netlink" reads and changes network devices over rtnetlink
+NETWORK_BACKEND = os.getenv('NETWORK_BACKEND', default='iproute2')
+
+# Number of spare TAP devices that are kept attached to br0 and each VPN
+# bridge, 0 creates TAP devices when a VM is created
+TAP_POOL_SIZE = int(
+    os.getenv('TAP_POOL_SIZE', default=VPN_NUM_PREPARED_INTERFACES))
+
+# External commands are killed after this many seconds
+COMMAND_TIMEOUT = float(os.getenv('COMMAND_TIMEOUT', default=300))
+
+# File to which traces of commands are appended in OTLP/JSON format, one
+# line per trace. Tracing is disabled if not set.
+TRACE_FILE = os.getenv('TRACE_FILE')
+
+# Port on which the broker daemon serves Prometheus metrics, 0 disables it.
+# The HTTP API always serves them at /metrics.
+METRICS_PORT = int(os.getenv('METRICS_PORT', default=0))
+METRICS_QUEUE_INTERVAL = float(os.getenv('METRICS_QUEUE_INTERVAL', default=15))
+
+# Address of the HTTP API. Each request is served by its own thread, VM
+# creations are executed by REST_WORKERS threads in the background.
+REST_HOST = os.getenv('REST_HOST', default='127.0.0.1')
+REST_PORT = int(os.getenv('REST_PORT', default=5000))
+REST_WORKERS = int(os.getenv('REST_WORKERS', default=4))
+
+# Operations (e.g. the creation of a VM) are recorded in this SQLite
+# database, so that operations interrupted by a restart can be cleaned up.
+# Only the most recent OPERATION_HISTORY finished operations are kept.
+OPERATIONS_DB = os.getenv(
+    'OPERATIONS_DB', default=str(AETHERSCALE_CONFIG_DIR / 'operations.sqlite'))
+OPERATION_HISTORY = int(os.getenv('OPERATION_HISTORY', default=1000))
+
+# Memory in MiB and vCPUs of a VM unless the VM is created with the options
+# "memory" and "vcpus"
+VM_MEMORY = int(os.getenv('VM_MEMORY', default=4096))
+VM_VCPUS = int(os.getenv('VM_VCPUS', default=1))
+
+# Hosts report their free memory, vCPUs and disk space every
+# CAPACITY_INTERVAL seconds. A host that takes a create command from the
+# competing queue forwards it to the host with the most free memory that
+# fits the VMs. 0 disables placement, then the host that takes the command
+# creates the VMs. Hosts can run VCPU_OVERCOMMIT vCPUs per CPU and need
+# VM_DISK MiB of free disk space for each new VM.
+CAPACITY_INTERVAL = float(os.getenv('CAPACITY_INTERVAL', default=5))
+VCPU_OVERCOMMIT = float(os.getenv('VCPU_OVERCOMMIT', default=4))
+VM_DISK = int(os.getenv('VM_DISK', default=1024))
+
+# create-vms prepares the images and network devices of up to BATCH_WORKERS
+# VMs at the same time and accepts at most MAX_BATCH_SIZE VMs
+BATCH_WORKERS = int(os.getenv('BATCH_WORKERS', default=8))
+MAX_BATCH_SIZE = int(os.getenv('MAX_BATCH_SIZE', default=100))
+
+# Number of threads that execute broker commands, 0 executes them on the
+# connection thread one after another
+BROKER_WORKERS = int(os.getenv('BROKER_WORKERS', default=4))
+BROKER_PREFETCH = int(os.getenv('BROKER_PREFETCH', default=BROKER_WORKERS))
+
+# Number of prepared copy-on-write overlays per base image, 0 disables the
+# pool and overlays are created when a VM is created
+OVERLAY_POOL_SIZE = int(os.getenv('OVERLAY_POOL_SIZE', default=2))
+
+# How init-scripts are passed to a VM: "guestmount" installs them into the
+# user image, "cloud-init" attaches a NoCloud seed drive
+INIT_SCRIPT_METHOD = os.getenv('INIT_SCRIPT_METHOD', default='guestmount')
+
+# Guest agents of running VMs are queried concurrently when listing VMs. A
+# listing never waits longer than the deadline for slow or hung guest agents.
+QGA_MAX_WORKERS = int(os.getenv('QGA_MAX_WORKERS', default=16))
+QGA_LIST_DEADLINE = float(os.getenv('QGA_LIST_DEADLINE', default=2))
+
 USER = pwd.getpwuid(os.getuid()).pw_name
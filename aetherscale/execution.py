@@ -1,16 +1,99 @@
 import logging
+import os
 import subprocess
-from typing import List, Iterator
+from typing import Any, List, Iterator, Optional
+
+from aetherscale import config
+from aetherscale import metrics
+from aetherscale import timing
+from aetherscale import tracing
+
+SUBPROCESS_DURATION = metrics.histogram(
+    'aetherscale_subprocess_duration_seconds',
+    'Duration of external commands', ['program'])
+SUBPROCESS_TIMEOUTS = metrics.counter(
+    'aetherscale_subprocess_timeouts',
+    'External commands that were killed after their timeout', ['program'])
+
+# number of characters of stderr that are kept for logs and traces
+STDERR_TAIL_LENGTH = 1000
+
+
+def program_name(command: List[str]) -> str:
+    """Name of the executed program, also for commands run with sudo"""
+    if len(command) > 1 and command[0] == 'sudo':
+        command = command[1:]
+
+    return os.path.basename(command[0])
+
+
+def _tail(output: Any) -> Optional[str]:
+    if isinstance(output, bytes):
+        output = output.decode('utf-8', errors='replace')
+    if not isinstance(output, str):
+        return None
+
+    return output[-STDERR_TAIL_LENGTH:]
+
+
+def run_command(
+        command: List[str], check_exit: bool = True,
+        **kwargs: Any) -> subprocess.CompletedProcess:
+    """Run an external command, record its duration and a tracing span
+
+    Accepts the same arguments as subprocess.run. The timeout defaults to
+    the remaining time of the current deadline, but at most
+    COMMAND_TIMEOUT seconds. Unless the caller handles stderr, it is
+    captured so that failures can be logged with their error output.
+    Probes that fail by design (e.g. systemctl is-active) should pass
+    check_exit=False, then a non-zero exit code is not logged as failure."""
+    if 'timeout' not in kwargs:
+        kwargs['timeout'] = timing.remaining_timeout(config.COMMAND_TIMEOUT)
+    if 'stderr' not in kwargs and not kwargs.get('capture_output'):
+        kwargs['stderr'] = subprocess.PIPE
+
+    program = program_name(command)
+    with tracing.span(f'exec {program}', **{
+                'process.executable.name': program,
+                'process.command_args': list(command),
+            }) as span:
+        try:
+            with SUBPROCESS_DURATION.time(program=program):
+                result = subprocess.run(command, **kwargs)
+        except subprocess.TimeoutExpired as e:
+            SUBPROCESS_TIMEOUTS.inc(program=program)
+            span.set_attribute('process.timeout', kwargs['timeout'])
+            stderr_tail = _tail(e.stderr)
+            if stderr_tail:
+                span.set_attribute('process.stderr_tail', stderr_tail)
+            raise
+
+        span.set_attribute('process.exit_code', result.returncode)
+        stderr_tail = _tail(result.stderr)
+        if stderr_tail:
+            span.set_attribute('process.stderr_tail', stderr_tail)
+
+        if result.returncode != 0 and check_exit:
+            span.error = f'exit code {result.returncode}'
+            logging.warning(
+                f'Command {" ".join(command)} failed with exit code '
+                f'{result.returncode}: {stderr_tail or ""}')
+
+    return result
 
 
 def run_command_chain(commands: Iterator[List[str]]) -> bool:
     for command in commands:
         logging.debug(f'Running command: {" ".join(command)}')
-        result = subprocess.run(command)
+
+        try:
+            result = run_command(command)
+        except subprocess.TimeoutExpired:
+            logging.error(f'Command timed out: {" ".join(command)}')
+            return False
 
         if result.returncode != 0:
             return False
 
     return True
 
-
@@ -0,0 +1,283 @@
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+import http.server
+import math
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    elif float(value).is_integer():
+        return str(int(value))
+    else:
+        return repr(float(value))
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if len(names) == 0:
+        return ''
+
+    escaped = (
+        str(value).replace('\\', '\\\\').replace('"', '\\"')
+        .replace('\n', '\\n')
+        for value in values)
+    pairs = ','.join(
+        f'{name}="{value}"' for name, value in zip(names, escaped))
+    return '{' + pairs + '}'
+
+
+class Metric(ABC):
+    metric_type = 'untyped'
+
+    def __init__(
+            self, name: str, description: str,
+            labels: Sequence[str] = ()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(labels)
+
+        self._lock = threading.Lock()
+
+    def _label_values(self, labels: Dict[str, str]) -> LabelValues:
+        if set(labels.keys()) != set(self.label_names):
+            raise ValueError(
+                f'Metric {self.name} expects labels {self.label_names}')
+
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def expose(self) -> List[str]:
+        lines = [
+            f'# HELP {self.name} {self.description}',
+            f'# TYPE {self.name} {self.metric_type}',
+        ]
+
+        for suffix, names, values, value in self.samples():
+            labels = _format_labels(names, values)
+            lines.append(f'{self.name}{suffix}{labels} {_format_value(value)}')
+
+        return lines
+
+    @abstractmethod
+    def samples(self) -> Iterator[
+            Tuple[str, Sequence[str], Sequence[str], float]]:
+        """Suffix, label names, label values and value of each sample"""
+
+
+class Counter(Metric):
+    """Value that only increases, e.g. number of requests"""
+    metric_type = 'counter'
+
+    def __init__(
+            self, name: str, description: str,
+            labels: Sequence[str] = ()):
+        super().__init__(name, description, labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        with self._lock:
+            return self._values.get(self._label_values(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+
+        for key, value in sorted(values.items()):
+            yield '_total', self.label_names, key, value
+
+
+class Gauge(Metric):
+    """Value that can go up and down, e.g. number of running VMs
+
+    Instead of setting values, a gauge can also read its values from a
+    function whenever the metrics are exposed."""
+    metric_type = 'gauge'
+
+    def __init__(
+            self, name: str, description: str,
+            labels: Sequence[str] = ()):
+        super().__init__(name, description, labels)
+        self._values: Dict[LabelValues, float] = {}
+        self._function: Optional[
+            Callable[[], Dict[LabelValues, float]]] = None
+
+    def set(self, value: float, **labels: str):
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels: str):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function: Callable[[], Dict[LabelValues, float]]):
+        """Read the values from a function that returns a value for each
+        combination of label values"""
+        with self._lock:
+            self._function = function
+
+    def value(self, **labels: str) -> float:
+        key = self._label_values(labels)
+        return self._current_values().get(key, 0)
+
+    def samples(self):
+        for key, value in sorted(self._current_values().items()):
+            yield '', self.label_names, key, value
+
+    def _current_values(self) -> Dict[LabelValues, float]:
+        with self._lock:
+            function = self._function
+            values = dict(self._values)
+
+        if function:
+            values.update(function())
+
+        return values
+
+
+class Histogram(Metric):
+    """Distribution of observed values, e.g. request durations"""
+    metric_type = 'histogram'
+
+    def __init__(
+            self, name: str, description: str,
+            labels: Sequence[str] = (),
+            buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # bucket counts, sum and count for each combination of label values
+        self._values: Dict[LabelValues, Tuple[List[int], float, int]] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = self._label_values(labels)
+
+        with self._lock:
+            counts, total, count = self._values.get(
+                key, ([0] * len(self.buckets), 0.0, 0))
+
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+
+            self._values[key] = (counts, total + value, count + 1)
+
+    @contextmanager
+    def time(self, **labels: str):
+        """Observe the duration of a block of code"""
+        start = time.monotonic()
+        try:
+            yield None
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def count(self, **labels: str) -> int:
+        with self._lock:
+            values = self._values.get(self._label_values(labels))
+
+        return values[2] if values else 0
+
+    def samples(self):
+        with self._lock:
+            values = {
+                key: (list(counts), total, count)
+                for key, (counts, total, count) in self._values.items()
+            }
+
+        bucket_labels = self.label_names + ('le',)
+        for key, (counts, total, count) in sorted(values.items()):
+            for bound, bucket_count in zip(self.buckets, counts):
+                yield '_bucket', bucket_labels, \
+                    key + (_format_value(bound),), bucket_count
+
+            yield '_sum', self.label_names, key, total
+            yield '_count', self.label_names, key, count
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f'Metric {metric.name} already registered')
+
+            self._metrics[metric.name] = metric
+
+        return metric
+
+    def expose(self) -> str:
+        """All metrics in the Prometheus text exposition format"""
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+
+        lines = []
+        for metric in metrics:
+            lines += metric.expose()
+
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, description: str, labels: Sequence[str] = ()) \
+        -> Counter:
+    return REGISTRY.register(Counter(name, description, labels))
+
+
+def gauge(name: str, description: str, labels: Sequence[str] = ()) -> Gauge:
+    return REGISTRY.register(Gauge(name, description, labels))
+
+
+def histogram(
+        name: str, description: str, labels: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+    return REGISTRY.register(Histogram(name, description, labels, buckets))
+
+
+def start_http_server(
+        port: int, host: str = '',
+        registry: Registry = REGISTRY) -> http.server.ThreadingHTTPServer:
+    """Serve the metrics on a separate port in a background thread"""
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+
+            body = registry.expose().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(
+        target=server.serve_forever, name='metrics-server', daemon=True)
+    thread.start()
+
+    return server
@@ -0,0 +1,349 @@
+import errno
+import fcntl
+import ipaddress
+import itertools
+import os
+import socket
+import struct
+from typing import Dict, List, Optional, Tuple, Union
+
+# Constants from linux/netlink.h, linux/rtnetlink.h, linux/if_link.h,
+# linux/if_addr.h and linux/if_tun.h
+NETLINK_ROUTE = 0
+
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+
+NLM_F_REQUEST = 0x1
+NLM_F_MULTI = 0x2
+NLM_F_ACK = 0x4
+NLM_F_DUMP = 0x300
+NLM_F_REPLACE = 0x100
+NLM_F_EXCL = 0x200
+NLM_F_CREATE = 0x400
+
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_GETLINK = 18
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+RTM_GETADDR = 22
+RTM_NEWROUTE = 24
+RTM_DELROUTE = 25
+
+RTMGRP_LINK = 0x1
+
+IFLA_IFNAME = 3
+IFLA_MASTER = 10
+IFLA_LINKINFO = 18
+IFLA_INFO_KIND = 1
+
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+
+RTA_OIF = 4
+RTA_GATEWAY = 5
+
+RT_TABLE_MAIN = 254
+RTPROT_BOOT = 3
+RT_SCOPE_UNIVERSE = 0
+RT_SCOPE_NOWHERE = 255
+RTN_UNICAST = 1
+
+IFF_UP = 0x1
+
+TUNSETIFF = 0x400454ca
+TUNSETPERSIST = 0x400454cb
+TUNSETOWNER = 0x400454cc
+IFF_TAP = 0x0002
+IFF_NO_PI = 0x1000
+
+NLMSGHDR = struct.Struct('=LHHLL')
+IFINFOMSG = struct.Struct('=BxHiII')
+IFADDRMSG = struct.Struct('=BBBBi')
+RTMSG = struct.Struct('=BBBBBBBBI')
+RTATTR = struct.Struct('=HH')
+
+IpAddress = Union[ipaddress.IPv4Address, ipaddress.IPv6Address]
+
+
+class NetlinkException(Exception):
+    def __init__(self, error_code: int, message: str):
+        super().__init__(f'{message}: {os.strerror(error_code)}')
+        self.errno = error_code
+
+
+def _align(length: int) -> int:
+    return (length + 3) & ~3
+
+
+def pack_attr(attr_type: int, data: bytes) -> bytes:
+    attr = RTATTR.pack(RTATTR.size + len(data), attr_type) + data
+    return attr + b'\0' * (_align(len(attr)) - len(attr))
+
+
+def unpack_attrs(data: bytes) -> Dict[int, bytes]:
+    attrs = {}
+    offset = 0
+
+    while offset + RTATTR.size <= len(data):
+        length, attr_type = RTATTR.unpack_from(data, offset)
+        if length < RTATTR.size:
+            break
+
+        attrs[attr_type] = data[offset + RTATTR.size:offset + length]
+        offset += _align(length)
+
+    return attrs
+
+
+def _name_attr(name: str) -> bytes:
+    return pack_attr(IFLA_IFNAME, name.encode('ascii') + b'\0')
+
+
+def _family(address: IpAddress) -> int:
+    return socket.AF_INET if address.version == 4 else socket.AF_INET6
+
+
+class Message:
+    """A netlink request that has not been sent yet"""
+
+    def __init__(self, msg_type: int, flags: int, payload: bytes):
+        self.msg_type = msg_type
+        self.flags = flags
+        self.payload = payload
+
+    def pack(self, seq: int) -> bytes:
+        header = NLMSGHDR.pack(
+            NLMSGHDR.size + len(self.payload), self.msg_type,
+            self.flags | NLM_F_REQUEST, seq, 0)
+        return header + self.payload
+
+
+def new_bridge(name: str) -> Message:
+    linkinfo = pack_attr(IFLA_INFO_KIND, b'bridge')
+    payload = IFINFOMSG.pack(0, 0, 0, 0, 0) \
+        + _name_attr(name) + pack_attr(IFLA_LINKINFO, linkinfo)
+    return Message(
+        RTM_NEWLINK, NLM_F_ACK | NLM_F_CREATE | NLM_F_EXCL, payload)
+
+
+def set_link(
+        name: str, up: Optional[bool] = None,
+        master_index: Optional[int] = None) -> Message:
+    """Change a link identified by its name, master_index 0 removes the
+    link from its master"""
+    flags, change = 0, 0
+    if up is not None:
+        flags = IFF_UP if up else 0
+        change = IFF_UP
+
+    payload = IFINFOMSG.pack(0, 0, 0, flags, change) + _name_attr(name)
+    if master_index is not None:
+        payload += pack_attr(IFLA_MASTER, struct.pack('=I', master_index))
+
+    return Message(RTM_NEWLINK, NLM_F_ACK, payload)
+
+
+def delete_link(name: str) -> Message:
+    payload = IFINFOMSG.pack(0, 0, 0, 0, 0) + _name_attr(name)
+    return Message(RTM_DELLINK, NLM_F_ACK, payload)
+
+
+def _address_message(
+        msg_type: int, flags: int, index: int,
+        interface: Union[ipaddress.IPv4Interface, ipaddress.IPv6Interface]) \
+        -> Message:
+    address = interface.ip
+    payload = IFADDRMSG.pack(
+        _family(address), interface.network.prefixlen, 0, RT_SCOPE_UNIVERSE,
+        index)
+    payload += pack_attr(IFA_ADDRESS, address.packed)
+    if address.version == 4:
+        payload += pack_attr(IFA_LOCAL, address.packed)
+
+    return Message(msg_type, flags, payload)
+
+
+def _create_flags(replace: bool) -> int:
+    return NLM_F_ACK | NLM_F_CREATE | (NLM_F_REPLACE if replace else NLM_F_EXCL)
+
+
+def add_address(index: int, address: str, replace: bool = False) -> Message:
+    return _address_message(
+        RTM_NEWADDR, _create_flags(replace), index,
+        ipaddress.ip_interface(address))
+
+
+def delete_address(
+        index: int,
+        interface: Union[ipaddress.IPv4Interface, ipaddress.IPv6Interface]) \
+        -> Message:
+    return _address_message(RTM_DELADDR, NLM_F_ACK, index, interface)
+
+
+def add_default_route(
+        gateway: str, index: int, replace: bool = False) -> Message:
+    gateway_address = ipaddress.ip_address(gateway)
+    payload = RTMSG.pack(
+        _family(gateway_address), 0, 0, 0, RT_TABLE_MAIN, RTPROT_BOOT,
+        RT_SCOPE_UNIVERSE, RTN_UNICAST, 0)
+    payload += pack_attr(RTA_GATEWAY, gateway_address.packed)
+    payload += pack_attr(RTA_OIF, struct.pack('=I', index))
+
+    return Message(RTM_NEWROUTE, _create_flags(replace), payload)
+
+
+def delete_default_route(family: int = socket.AF_INET) -> Message:
+    payload = RTMSG.pack(
+        family, 0, 0, 0, RT_TABLE_MAIN, 0, RT_SCOPE_NOWHERE, 0, 0)
+    return Message(RTM_DELROUTE, NLM_F_ACK, payload)
+
+
+def create_tap(name: str, uid: int):
+    """Create a persistent TAP device owned by a user
+
+    The kernel does not support creating TAP devices over rtnetlink, so this
+    uses the ioctl interface of /dev/net/tun."""
+    fd = os.open('/dev/net/tun', os.O_RDWR)
+    try:
+        ifreq = struct.pack(
+            '16sH', name.encode('ascii'), IFF_TAP | IFF_NO_PI)
+        fcntl.ioctl(fd, TUNSETIFF, ifreq)
+        fcntl.ioctl(fd, TUNSETOWNER, uid)
+        fcntl.ioctl(fd, TUNSETPERSIST, 1)
+    finally:
+        os.close(fd)
+
+
+class RtnlSocket:
+    """rtnetlink socket that sends queued requests as one batch"""
+
+    def __init__(self, groups: int = 0):
+        self.sock = socket.socket(
+            socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+        self.sock.bind((0, groups))
+
+        self._seq = itertools.count(1)
+        self._pending: List[Tuple[int, Message]] = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.sock.close()
+
+    def queue(self, message: Message):
+        self._pending.append((next(self._seq), message))
+
+    def commit(self):
+        """Send all queued requests at once and wait for their
+        acknowledgements. Raise an exception for the first failed request."""
+        if len(self._pending) == 0:
+            return
+
+        pending = self._pending
+        self._pending = []
+
+        self.sock.sendall(
+            b''.join(message.pack(seq) for seq, message in pending))
+
+        waiting = set(seq for seq, _ in pending)
+        first_error = None
+        while waiting:
+            for msg_type, seq, payload in self._receive():
+                if msg_type != NLMSG_ERROR:
+                    continue
+
+                waiting.discard(seq)
+                error_code, = struct.unpack_from('=i', payload)
+                if error_code != 0 and first_error is None:
+                    first_error = NetlinkException(
+                        -error_code, f'Netlink request {seq} failed')
+
+        if first_error:
+            raise first_error
+
+    def links(self) -> Dict[str, int]:
+        """Return the index of each network device by name"""
+        links = {}
+        request = IFINFOMSG.pack(0, 0, 0, 0, 0)
+
+        for payload in self._dump(RTM_GETLINK, request):
+            _, _, index, _, _ = IFINFOMSG.unpack_from(payload)
+            attrs = unpack_attrs(payload[IFINFOMSG.size:])
+            if IFLA_IFNAME in attrs:
+                links[attrs[IFLA_IFNAME].rstrip(b'\0').decode()] = index
+
+        return links
+
+    def addresses(self, index: int) -> List[
+            Union[ipaddress.IPv4Interface, ipaddress.IPv6Interface]]:
+        addresses = []
+        request = IFADDRMSG.pack(0, 0, 0, 0, 0)
+
+        for payload in self._dump(RTM_GETADDR, request):
+            _, prefixlen, _, _, addr_index = IFADDRMSG.unpack_from(payload)
+            if addr_index != index:
+                continue
+
+            attrs = unpack_attrs(payload[IFADDRMSG.size:])
+            raw_address = attrs.get(IFA_LOCAL, attrs.get(IFA_ADDRESS))
+            if raw_address:
+                address = ipaddress.ip_address(raw_address)
+                addresses.append(
+                    ipaddress.ip_interface(f'{address}/{prefixlen}'))
+
+        return addresses
+
+    def link_changes(self) -> List[Tuple[int, str]]:
+        """Wait for link notifications (requires a socket bound to
+        RTMGRP_LINK) and return their message type and device name"""
+        changes = []
+
+        for msg_type, _, payload in self._receive():
+            if msg_type not in (RTM_NEWLINK, RTM_DELLINK):
+                continue
+
+            attrs = unpack_attrs(payload[IFINFOMSG.size:])
+            if IFLA_IFNAME in attrs:
+                name = attrs[IFLA_IFNAME].rstrip(b'\0').decode()
+                changes.append((msg_type, name))
+
+        return changes
+
+    def _dump(self, msg_type: int, request: bytes) -> List[bytes]:
+        seq = next(self._seq)
+        self.sock.sendall(Message(msg_type, NLM_F_DUMP, request).pack(seq))
+
+        payloads = []
+        while True:
+            for reply_type, reply_seq, payload in self._receive():
+                if reply_seq != seq:
+                    continue
+                elif reply_type == NLMSG_DONE:
+                    return payloads
+                elif reply_type == NLMSG_ERROR:
+                    error_code, = struct.unpack_from('=i', payload)
+                    raise NetlinkException(-error_code, 'Netlink dump failed')
+                else:
+                    payloads.append(payload)
+
+    def _receive(self) -> List[Tuple[int, int, bytes]]:
+        data = self.sock.recv(65536)
+        messages = []
+        offset = 0
+
+        while offset + NLMSGHDR.size <= len(data):
+            length, msg_type, _, seq, _ = NLMSGHDR.unpack_from(data, offset)
+            if length < NLMSGHDR.size:
+                raise NetlinkException(errno.EBADMSG, 'Invalid netlink reply')
+
+            payload = data[offset + NLMSGHDR.size:offset + length]
+            messages.append((msg_type, seq, payload))
+            offset += _align(length)
+
+        return messages
@@ -1,11 +1,20 @@
+import concurrent.futures
+import errno
 import logging
+import os
+from pathlib import Path
+import pwd
 import random
 import re
 import shlex
-import subprocess
-from typing import Optional
+import socket
+import string
+import threading
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 
+from aetherscale import config
 from aetherscale import execution
+from aetherscale import netlink
 
 
 def create_mac_address() -> str:
@@ -23,6 +32,108 @@ class NetworkingException(Exception):
     pass
 
 
+SYSFS_NET = Path('/sys/class/net')
+
+
+class LinkIndex:
+    """Names of the network devices that exist on this host
+
+    While the monitor is running, the index is read once from
+    /sys/class/net and afterwards kept up-to-date with rtnetlink
+    notifications. Without monitor each lookup is a single stat() in
+    /sys/class/net. Changes made by aetherscale itself invalidate the index,
+    so that they are visible immediately and not only once their
+    notification arrives."""
+
+    def __init__(self, sysfs_path: Path = SYSFS_NET):
+        self.sysfs_path = sysfs_path
+
+        self._lock = threading.Lock()
+        self._links: Optional[Set[str]] = None
+        self._monitor: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def exists(self, device: str) -> bool:
+        with self._lock:
+            if self._monitor is None:
+                return os.path.exists(self.sysfs_path / device)
+
+            if self._links is None:
+                self._links = self._scan()
+            return device in self._links
+
+    def invalidate(self):
+        with self._lock:
+            self._links = None
+
+    def start_monitor(self):
+        if self._monitor is not None:
+            return
+
+        # subscribe before the first scan so that no change gets lost
+        rtnl = netlink.RtnlSocket(groups=netlink.RTMGRP_LINK)
+        rtnl.sock.settimeout(1)
+
+        self._stop.clear()
+        with self._lock:
+            self._links = None
+            self._monitor = threading.Thread(
+                target=self._watch, args=(rtnl,), name='link-monitor',
+                daemon=True)
+            self._monitor.start()
+
+    def stop_monitor(self):
+        if self._monitor is None:
+            return
+
+        self._stop.set()
+        self._monitor.join()
+
+        with self._lock:
+            self._monitor = None
+            self._links = None
+
+    def _scan(self) -> Set[str]:
+        return set(os.listdir(self.sysfs_path))
+
+    def _watch(self, rtnl: netlink.RtnlSocket):
+        with rtnl:
+            while not self._stop.is_set():
+                try:
+                    changes = rtnl.link_changes()
+                except socket.timeout:
+                    continue
+                except OSError as e:
+                    if e.errno != errno.ENOBUFS:
+                        logging.error(
+                            f'Stopped monitoring network devices: {e}')
+                        # fall back to lookups in /sys/class/net
+                        with self._lock:
+                            self._monitor = None
+                            self._links = None
+                        return
+
+                    # notifications were dropped, re-read the whole table
+                    self.invalidate()
+                    continue
+
+                self._apply_changes(changes)
+
+    def _apply_changes(self, changes: List[Tuple[int, str]]):
+        with self._lock:
+            if self._links is None:
+                return
+
+            for msg_type, name in changes:
+                if msg_type == netlink.RTM_NEWLINK:
+                    self._links.add(name)
+                elif msg_type == netlink.RTM_DELLINK:
+                    self._links.discard(name)
+
+
+link_index = LinkIndex()
+
+
 class Iproute2Network:
     def __init__(self):
         self.creation_commands = []
@@ -53,33 +164,37 @@ class Iproute2Network:
                     ['sudo', 'ip', 'addr', 'flush', 'dev', bridge_device])
 
             self.creation_commands.append(
-                ['sudo', 'ip', 'addr', 'add', ip, 'dev', bridge_device])
+                ['sudo', 'ip', 'addr', 'replace', ip, 'dev', bridge_device])
 
         if gateway:
             self.creation_commands.append(
-                ['sudo', 'ip', 'route', 'add', 'default',
+                ['sudo', 'ip', 'route', 'replace', 'default',
                  'via', gateway, 'dev', bridge_device])
             self.deletion_commands.append(
-                ['sudo', 'ip', 'route', 'add', 'default',
+                ['sudo', 'ip', 'route', 'replace', 'default',
                  'via', gateway, 'dev', phys_device])
-            self.deletion_commands.append(
-                ['sudo', 'ip', 'route', 'del', 'default'])
 
         if ip:
             self.deletion_commands.append(
-                ['sudo', 'ip', 'addr', 'add', ip, 'dev', phys_device])
+                ['sudo', 'ip', 'addr', 'replace', ip, 'dev', phys_device])
 
         self.deletion_commands.append([
             'sudo', 'ip', 'link', 'set', phys_device, 'nomaster'])
 
     def tap_device(
             self, tap_device_name: str, user: str,
-            bridge_device: Optional[str] = None):
+            bridge_device: Optional[str] = None, force: bool = False):
+        """Create a TAP device, optionally attached to a bridge
+
+        Existing devices are not re-created, unless force is given. This is
+        meant for scripts, which only create the device if it is missing
+        when they are run."""
         Iproute2Network.validate_device_name(tap_device_name)
         if bridge_device:
             Iproute2Network.validate_device_name(bridge_device)
 
-        if Iproute2Network.check_device_existence(tap_device_name):
+        if not force \
+                and Iproute2Network.check_device_existence(tap_device_name):
             logging.debug(
                 f'Device {tap_device_name} already exists, will not re-create')
         else:
@@ -108,17 +223,44 @@ class Iproute2Network:
         return Iproute2Network._to_script(reversed(self.deletion_commands))
 
     def setup(self):
-        return execution.run_command_chain(self.creation_commands)
+        try:
+            return execution.run_command_chain(self.creation_commands)
+        finally:
+            link_index.invalidate()
 
     def teardown(self):
-        return execution.run_command_chain(reversed(self.deletion_commands))
+        try:
+            return execution.run_command_chain(
+                reversed(self.deletion_commands))
+        finally:
+            link_index.invalidate()
 
     @staticmethod
     def _to_script(commands):
-        script_lines = ['#!/usr/bin/env bash']
+        """Create a bash script that passes all commands to a single ip
+        process, so that only one sudo call is needed
+
+        The script can be run repeatedly: devices are only created if they
+        do not exist and only deleted if they still exist when the script
+        starts, all other commands are idempotent. ip continues with the
+        remaining commands if one of them fails."""
+        script_lines = ['#!/usr/bin/env bash', '{']
 
         for command in commands:
-            script_lines.append(shlex.join(command))
+            args = _ip_arguments(command)
+            line = 'echo ' + shlex.quote(shlex.join(args))
+
+            device = _created_device(args)
+            if device:
+                line = f'[ -e {SYSFS_NET / device} ] || {line}'
+
+            device = _removed_device(args)
+            if device:
+                line = f'[ ! -e {SYSFS_NET / device} ] || {line}'
+
+            script_lines.append(f'    {line}')
+
+        script_lines.append('} | sudo ip -force -batch -')
 
         return '\n'.join(script_lines)
 
@@ -141,17 +283,7 @@ class Iproute2Network:
     @staticmethod
     def check_device_existence(device: str) -> bool:
         Iproute2Network.validate_device_name(device)
-
-        # if ip link show dev [devicename] does not find [devicename], it will
-        # write a message to stderr, but none to stdout
-        result = subprocess.run(
-            ['ip', 'link', 'show', 'dev', device], stdout=subprocess.PIPE,
-            stderr=subprocess.DEVNULL)
-
-        if result.stdout:
-            return True
-        else:
-            return False
+        return link_index.exists(device)
 
     @staticmethod
     def validate_device_name(name: str):
@@ -168,3 +300,253 @@ class Iproute2Network:
         if not re.match(r'^[0-9.:a-f]+(/\d+)?$', ip_addr):
             raise NetworkingException(
                 f'Invalid IP address provided ({ip_addr})')
+
+
+class NetlinkNetwork(Iproute2Network):
+    """Network setup that talks to the kernel over rtnetlink instead of
+    running one ip process per change
+
+    The same ip commands as in Iproute2Network are recorded, so that
+    setup_script() and teardown_script() still work for systemd units.
+    setup() and teardown() send them as netlink requests, which requires
+    CAP_NET_ADMIN instead of sudo."""
+
+    def setup(self):
+        return self._apply(self.creation_commands)
+
+    def teardown(self):
+        return self._apply(reversed(self.deletion_commands))
+
+    def _apply(self, commands: Iterable[List[str]]) -> bool:
+        try:
+            with netlink.RtnlSocket() as rtnl:
+                links = rtnl.links()
+                for command in commands:
+                    self._apply_command(rtnl, links, _ip_arguments(command))
+                rtnl.commit()
+        except (netlink.NetlinkException, NetworkingException, OSError) as e:
+            logging.error(f'Could not apply network configuration: {e}')
+            return False
+        finally:
+            link_index.invalidate()
+
+        return True
+
+    @staticmethod
+    def _apply_command(
+            rtnl: netlink.RtnlSocket, links: Dict[str, int],
+            args: List[str]):
+        def index(device: str) -> int:
+            if device not in links:
+                # device was created by a request that is still queued
+                rtnl.commit()
+                links.update(rtnl.links())
+
+            if device not in links:
+                raise NetworkingException(f'Device {device} does not exist')
+            return links[device]
+
+        if args[:2] == ['link', 'add'] and args[3:] == ['type', 'bridge']:
+            rtnl.queue(netlink.new_bridge(args[2]))
+        elif args[:2] == ['link', 'set']:
+            device_args = args[3:] if args[2] == 'dev' else args[2:]
+            device, action = device_args[0], device_args[1:]
+
+            if action == ['up']:
+                rtnl.queue(netlink.set_link(device, up=True))
+            elif action == ['nomaster']:
+                rtnl.queue(netlink.set_link(device, master_index=0))
+            elif action[:1] == ['master']:
+                rtnl.queue(netlink.set_link(
+                    device, master_index=index(action[1])))
+            else:
+                raise NetworkingException(f'Unsupported command {args}')
+        elif args[:2] == ['link', 'del']:
+            rtnl.queue(netlink.delete_link(args[2]))
+            links.pop(args[2], None)
+        elif args[:3] == ['addr', 'flush', 'dev']:
+            device_index = index(args[3])
+            rtnl.commit()
+            for address in rtnl.addresses(device_index):
+                rtnl.queue(netlink.delete_address(device_index, address))
+        elif args[0] == 'addr' and args[1] in ('add', 'replace') \
+                and args[3] == 'dev':
+            rtnl.queue(netlink.add_address(
+                index(args[4]), args[2], replace=args[1] == 'replace'))
+        elif args[0] == 'route' and args[1] in ('add', 'replace') \
+                and args[2:4] == ['default', 'via']:
+            gateway, device = args[4], args[6]
+            rtnl.queue(netlink.add_default_route(
+                gateway, index(device), replace=args[1] == 'replace'))
+        elif args == ['route', 'del', 'default']:
+            rtnl.queue(netlink.delete_default_route())
+        elif args[:3] == ['tuntap', 'add', 'dev']:
+            # TAP devices cannot be created over rtnetlink
+            device, user = args[3], args[args.index('user') + 1]
+            netlink.create_tap(device, pwd.getpwnam(user).pw_uid)
+            links.pop(device, None)
+        else:
+            raise NetworkingException(f'Unsupported command {args}')
+
+
+POOLED_TAP_PREFIX = 'aetap-'
+
+
+def is_pooled_tap(device: str) -> bool:
+    return device.startswith(POOLED_TAP_PREFIX)
+
+
+def device_master(device: str, sysfs_path: Path = SYSFS_NET) -> Optional[str]:
+    """Name of the bridge a device is attached to"""
+    try:
+        return Path(os.readlink(sysfs_path / device / 'master')).name
+    except FileNotFoundError:
+        return None
+
+
+def delete_device(device: str) -> bool:
+    network = create_network()
+    network.deletion_commands.append(['sudo', 'ip', 'link', 'del', device])
+    return network.teardown()
+
+
+class TapPool:
+    """Keeps spare TAP devices that are already attached to a bridge
+
+    Spare devices are recognized by their name prefix and the bridge they
+    are attached to, so the pool survives restarts of aetherscale. Devices
+    that are assigned to VMs have to be reserved. Each handed out device is
+    replaced in the background."""
+
+    def __init__(self, size: int, user: str, sysfs_path: Path = SYSFS_NET):
+        self.size = size
+        self.user = user
+        self.sysfs_path = sysfs_path
+
+        self._lock = threading.Lock()
+        self._in_use: Set[str] = set()
+        self._scheduled: Set[str] = set()
+        self._closed = False
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='tap-pool')
+
+    def reserve(self, devices: Iterable[str]):
+        """Mark devices as assigned, e.g. devices of existing VMs"""
+        with self._lock:
+            self._in_use.update(devices)
+
+    def acquire(self, bridge: str) -> Optional[str]:
+        """Take a spare device of the bridge. Returns None if no device is
+        ready, then the caller has to create one itself."""
+        with self._lock:
+            spares = self._spare_devices(bridge)
+            device = spares[0] if spares else None
+            if device:
+                self._in_use.add(device)
+                logging.debug(f'Took TAP device {device} from pool')
+
+        self.refill(bridge)
+        return device
+
+    def release(self, device: str):
+        """Return a device that is no longer used by a VM"""
+        bridge = device_master(device, self.sysfs_path)
+
+        with self._lock:
+            self._in_use.discard(device)
+
+            if not (self.sysfs_path / device).exists():
+                return
+            elif bridge and not self._closed \
+                    and len(self._spare_devices(bridge)) <= self.size:
+                logging.debug(f'Returned TAP device {device} to pool')
+                return
+
+        delete_device(device)
+
+    def refill(self, bridge: str):
+        with self._lock:
+            if self._closed or bridge in self._scheduled:
+                return
+
+            self._scheduled.add(bridge)
+
+        self._executor.submit(self._refill, bridge)
+
+    def warm(self, bridges: Iterable[str]):
+        for bridge in bridges:
+            self.refill(bridge)
+
+    def shutdown(self):
+        with self._lock:
+            self._closed = True
+
+        self._executor.shutdown(wait=True)
+
+    def _spare_devices(self, bridge: str) -> List[str]:
+        return sorted(
+            device for device in os.listdir(self.sysfs_path)
+            if is_pooled_tap(device) and device not in self._in_use
+            and device_master(device, self.sysfs_path) == bridge)
+
+    def _refill(self, bridge: str):
+        try:
+            # a new bridge might not have been set up yet
+            while (self.sysfs_path / bridge).exists():
+                with self._lock:
+                    if len(self._spare_devices(bridge)) >= self.size:
+                        break
+
+                suffix = ''.join(
+                    random.choice(string.ascii_lowercase) for _ in range(8))
+                device = POOLED_TAP_PREFIX + suffix
+
+                network = create_network()
+                network.tap_device(device, self.user, bridge)
+                if not network.setup():
+                    logging.error(f'Could not prepare TAP device for {bridge}')
+                    break
+        except Exception:
+            logging.exception(f'Could not refill TAP devices for {bridge}')
+        finally:
+            with self._lock:
+                self._scheduled.discard(bridge)
+
+
+def _created_device(args: List[str]) -> Optional[str]:
+    if args[:2] == ['link', 'add']:
+        return args[2]
+    elif args[:3] == ['tuntap', 'add', 'dev']:
+        return args[3]
+    else:
+        return None
+
+
+def _removed_device(args: List[str]) -> Optional[str]:
+    if args[:2] == ['link', 'del']:
+        return args[2]
+    elif args[:2] == ['link', 'set'] and args[-1] == 'nomaster':
+        # only run during teardown, the device might already be gone
+        return args[-2]
+    else:
+        return None
+
+
+def _ip_arguments(command: List[str]) -> List[str]:
+    """Strip sudo and ip from a command recorded by Iproute2Network"""
+    if command[:1] == ['sudo']:
+        command = command[1:]
+    if command[:1] != ['ip']:
+        raise NetworkingException(f'Not an ip command: {command}')
+
+    return command[1:]
+
+
+def create_network() -> Iproute2Network:
+    if config.NETWORK_BACKEND == 'netlink':
+        return NetlinkNetwork()
+    elif config.NETWORK_BACKEND == 'iproute2':
+        return Iproute2Network()
+    else:
+        raise NetworkingException(
+            f'Unknown network backend "{config.NETWORK_BACKEND}"')
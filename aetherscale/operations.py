@@ -0,0 +1,276 @@
+import copy
+from dataclasses import dataclass, field
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, Hashable, Iterator, List, Optional
+import uuid
+
+from aetherscale.concurrency import KeyedExecutor
+
+INTERRUPTED_ERROR = 'Interrupted by a restart of aetherscale'
+
+
+@dataclass
+class Operation:
+    """A command that changes a VM, e.g. the creation of a VM"""
+    operation_id: str
+    command: str
+    options: Dict[str, Any] = field(default_factory=dict)
+    # queued, running, succeeded or failed
+    status: str = 'queued'
+    # all messages the command yielded so far
+    messages: List[Dict[str, Any]] = field(default_factory=list)
+    error: Optional[str] = None
+    created: float = field(default_factory=time.time)
+    finished: Optional[float] = None
+
+    @property
+    def done(self) -> bool:
+        return self.status in ('succeeded', 'failed')
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'operation-id': self.operation_id,
+            'command': self.command,
+            'status': self.status,
+            'messages': self.messages,
+            # the last message is the result of a finished command
+            'result': self.messages[-1] if self.done and self.messages
+            else None,
+            'error': self.error,
+        }
+
+
+class OperationStore:
+    """Keeps operations in a SQLite database, so that operations that were
+    interrupted by a restart can be found and cleaned up
+
+    The broker and the HTTP API can share a database, each only recovers the
+    operations of its own source."""
+
+    def __init__(self, path: str, source: str = ''):
+        self.source = source
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('''
+            CREATE TABLE IF NOT EXISTS operations (
+                operation_id TEXT PRIMARY KEY,
+                source TEXT NOT NULL,
+                command TEXT NOT NULL,
+                options TEXT NOT NULL,
+                status TEXT NOT NULL,
+                messages TEXT NOT NULL,
+                error TEXT,
+                created REAL NOT NULL,
+                finished REAL
+            )''')
+        self._db.commit()
+
+    def save(self, operation: Operation):
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO operations VALUES '
+                '(?, ?, ?, ?, ?, ?, ?, ?, ?)', (
+                    operation.operation_id, self.source, operation.command,
+                    json.dumps(operation.options), operation.status,
+                    json.dumps(operation.messages), operation.error,
+                    operation.created, operation.finished))
+            self._db.commit()
+
+    def get(self, operation_id: str) -> Operation:
+        operations = self._query(
+            'WHERE operation_id = ?', (operation_id,))
+        if not operations:
+            raise KeyError(operation_id)
+
+        return operations[0]
+
+    def recent(self, limit: int) -> List[Operation]:
+        return self._query('ORDER BY created DESC LIMIT ?', (limit,))
+
+    def unfinished(self) -> List[Operation]:
+        return self._query(
+            "WHERE source = ? AND status NOT IN ('succeeded', 'failed') "
+            'ORDER BY created', (self.source,))
+
+    def prune(self, keep: int):
+        """Delete all but the most recent finished operations"""
+        with self._lock:
+            self._db.execute('''
+                DELETE FROM operations WHERE operation_id IN (
+                    SELECT operation_id FROM operations
+                    WHERE status IN ('succeeded', 'failed')
+                    ORDER BY created DESC LIMIT -1 OFFSET ?)''', (keep,))
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _query(self, condition: str, parameters=()) -> List[Operation]:
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT operation_id, command, options, status, messages, '
+                f'error, created, finished FROM operations {condition}',
+                parameters).fetchall()
+
+        return [
+            Operation(
+                operation_id=row[0], command=row[1],
+                options=json.loads(row[2]), status=row[3],
+                messages=json.loads(row[4]), error=row[5], created=row[6],
+                finished=row[7])
+            for row in rows
+        ]
+
+
+class OperationManager:
+    """Records the progress of operations and runs them on a bounded pool
+    of threads, so that clients can poll for the result instead of waiting
+    for it
+
+    Operations with the same key (e.g. the VM ID) run one after another.
+    Only the most recent finished operations are kept."""
+
+    def __init__(
+            self, workers: int, store: Optional[OperationStore] = None,
+            history: int = 1000):
+        self.store = store or OperationStore(':memory:')
+        self.history = history
+
+        self._executor = KeyedExecutor(workers, thread_name_prefix='operation')
+        self._condition = threading.Condition()
+        # operations that have not finished yet, so that waiting clients can
+        # be notified
+        self._active: Dict[str, Operation] = {}
+
+    def create(self, command: str, options: Dict[str, Any]) -> Operation:
+        """Record a new operation that is executed with execute()"""
+        operation = Operation(
+            operation_id=uuid.uuid4().hex, command=command,
+            options=dict(options))
+
+        with self._condition:
+            self._active[operation.operation_id] = operation
+            self.store.save(operation)
+            return copy.deepcopy(operation)
+
+    def execute(
+            self, operation: Operation,
+            results: Iterator[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+        """Run an operation on the current thread and record each message
+        of the command before passing it on. Exceptions are recorded and
+        re-raised."""
+        self._update(operation.operation_id, status='running')
+
+        try:
+            for message in results:
+                with self._condition:
+                    active = self._active[operation.operation_id]
+                    active.messages.append(message)
+                    self.store.save(active)
+                    self._condition.notify_all()
+
+                yield message
+        except Exception as e:
+            self._update(operation.operation_id, status='failed', error=str(e))
+            raise
+        except GeneratorExit:
+            # the caller stopped reading, e.g. a client disconnected
+            self._update(
+                operation.operation_id, status='failed', error='Cancelled')
+            raise
+        else:
+            self._update(operation.operation_id, status='succeeded')
+
+    def submit(
+            self, command: str, options: Dict[str, Any],
+            results: Iterator[Dict[str, Any]],
+            key: Optional[Hashable] = None) -> Operation:
+        """Execute an operation in the background, results is the generator
+        of the command's messages"""
+        operation = self.create(command, options)
+
+        def run():
+            try:
+                for _ in self.execute(operation, results):
+                    pass
+            except Exception:
+                logging.exception(f'Operation {command} failed')
+
+        self._executor.submit(key, run)
+        return operation
+
+    def get(self, operation_id: str) -> Operation:
+        """Return the current state of an operation, raise KeyError for
+        unknown operations"""
+        with self._condition:
+            if operation_id in self._active:
+                return copy.deepcopy(self._active[operation_id])
+
+        return self.store.get(operation_id)
+
+    def recent(self, limit: int = 100) -> List[Operation]:
+        return self.store.recent(limit)
+
+    def wait(self, operation_id: str, timeout: float) -> Operation:
+        """Wait at most timeout seconds for an operation to finish and
+        return its state"""
+        deadline = time.monotonic() + timeout
+
+        with self._condition:
+            while operation_id in self._active:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+
+                self._condition.wait(remaining)
+
+        return self.get(operation_id)
+
+    def recover(self, recover_operation: Callable[[Operation], bool]):
+        """Finish operations that were interrupted by a restart
+
+        recover_operation has to clean up after the operation and return
+        whether the operation's work was complete anyway."""
+        for operation in self.store.unfinished():
+            logging.warning(
+                f'Recovering {operation.status} operation '
+                f'{operation.operation_id} ({operation.command})')
+
+            try:
+                complete = recover_operation(operation)
+            except Exception:
+                logging.exception(
+                    f'Could not recover operation {operation.operation_id}')
+                complete = False
+
+            if complete:
+                operation.status = 'succeeded'
+            else:
+                operation.status = 'failed'
+                operation.error = INTERRUPTED_ERROR
+            operation.finished = time.time()
+            self.store.save(operation)
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
+
+    def _update(self, operation_id: str, **changes: Any):
+        with self._condition:
+            operation = self._active[operation_id]
+            for key, value in changes.items():
+                setattr(operation, key, value)
+
+            if operation.done:
+                operation.finished = time.time()
+                del self._active[operation_id]
+
+            self.store.save(operation)
+            if operation.done:
+                self.store.prune(self.history)
+
+            self._condition.notify_all()
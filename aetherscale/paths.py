@@ -17,6 +17,10 @@ def qemu_socket_monitor(vm_id: str) -> Path:
     return Path(f'/tmp/aetherscale-qmp-{vm_id}.sock')
 
 
+def qemu_socket_events(vm_id: str) -> Path:
+    return Path(f'/tmp/aetherscale-qmp-events-{vm_id}.sock')
+
+
 def qemu_socket_guest_agent(vm_id: str) -> Path:
     return Path(f'/tmp/aetherscale-qga-{vm_id}.sock')
 
@@ -31,3 +35,7 @@ def resource_config_path(
         raise ValueError(f'Unknown resource type {resource_type}')
 
     return config.AETHERSCALE_CONFIG_DIR / resource_folder / resource_name
+
+
+def seed_directory_path(vm_id: str) -> Path:
+    return resource_config_path(ResourceType.VM, vm_id) / 'seed'
@@ -1,2 +1,6 @@
 class QemuException(Exception):
     pass
+
+
+class QemuConnectionClosed(QemuException):
+    pass
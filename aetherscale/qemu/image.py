@@ -1,18 +1,135 @@
+import concurrent.futures
 from contextlib import contextmanager
+import errno
+import fcntl
 import logging
 import os
 from pathlib import Path
 import shutil
+import struct
 import subprocess
 import tempfile
-from typing import TextIO, Iterator
+import threading
+from typing import List, Set, TextIO, Iterator
+import uuid
 
-from aetherscale.execution import run_command_chain
+from aetherscale.execution import run_command, run_command_chain
 from aetherscale.qemu.exceptions import QemuException
-import aetherscale.timing
+from aetherscale import timing
 
 
 STARTUP_FILENAME = 'aetherscale-init'
+OVERLAY_POOL_FOLDER = '.overlays'
+
+
+def create_overlay(base_image: Path, target: Path) -> bool:
+    """Create a copy-on-write image on top of a base image"""
+    try:
+        result = run_command([
+            'qemu-img', 'create', '-f', 'qcow2',
+            '-b', str(base_image.absolute()), '-F', 'qcow2', str(target)])
+    except subprocess.TimeoutExpired:
+        logging.error(f'Creating overlay {target} timed out')
+        return False
+
+    return result.returncode == 0
+
+
+class OverlayPool:
+    """Keeps prepared copy-on-write overlays for each base image
+
+    Overlays are stored next to the base images, so that they can be moved
+    to the user image folder with an atomic rename. Each handed out overlay
+    is replaced in the background."""
+
+    def __init__(self, base_image_folder: Path, size: int):
+        self.base_image_folder = base_image_folder
+        self.pool_folder = base_image_folder / OVERLAY_POOL_FOLDER
+        self.size = size
+
+        self._lock = threading.Lock()
+        self._scheduled: Set[str] = set()
+        self._closed = False
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='overlay-pool')
+
+    def acquire(self, image_name: str, target: Path) -> bool:
+        """Move a prepared overlay of the image to target. Returns False if
+        no overlay is ready, then the caller has to create one itself."""
+        base_image = self.base_image_folder / f'{image_name}.qcow2'
+        acquired = False
+
+        with self._lock:
+            for overlay in self._ready_overlays(image_name):
+                # overlays of an outdated base image must not be used
+                if overlay.stat().st_mtime < base_image.stat().st_mtime:
+                    logging.debug(f'Discarding outdated overlay {overlay}')
+                    overlay.unlink()
+                    continue
+
+                try:
+                    os.rename(overlay, target)
+                except OSError as e:
+                    if e.errno != errno.EXDEV:
+                        raise
+
+                    # pool and user images are on different filesystems,
+                    # overlays are small so we can copy them
+                    shutil.move(str(overlay), str(target))
+
+                logging.debug(f'Took overlay {overlay} from pool')
+                acquired = True
+                break
+
+        self.refill(image_name)
+        return acquired
+
+    def refill(self, image_name: str):
+        with self._lock:
+            if self._closed or image_name in self._scheduled:
+                return
+
+            self._scheduled.add(image_name)
+
+        self._executor.submit(self._refill, image_name)
+
+    def warm(self):
+        """Fill the pool for all available base images"""
+        for base_image in self.base_image_folder.glob('*.qcow2'):
+            self.refill(base_image.stem)
+
+    def shutdown(self):
+        with self._lock:
+            self._closed = True
+
+        self._executor.shutdown(wait=True)
+
+    def _ready_overlays(self, image_name: str) -> List[Path]:
+        return sorted((self.pool_folder / image_name).glob('*.qcow2'))
+
+    def _refill(self, image_name: str):
+        try:
+            base_image = self.base_image_folder / f'{image_name}.qcow2'
+            image_pool_folder = self.pool_folder / image_name
+            image_pool_folder.mkdir(parents=True, exist_ok=True)
+
+            while base_image.is_file() \
+                    and len(self._ready_overlays(image_name)) < self.size:
+                name = str(uuid.uuid4())
+                tmp_overlay = image_pool_folder / f'{name}.tmp'
+                # only complete overlays must be visible to acquire()
+                if not create_overlay(base_image, tmp_overlay):
+                    logging.error(
+                        f'Could not prepare overlay for {image_name}')
+                    tmp_overlay.unlink(missing_ok=True)
+                    break
+
+                os.rename(tmp_overlay, image_pool_folder / f'{name}.qcow2')
+        except Exception:
+            logging.exception(f'Could not refill overlays for {image_name}')
+        finally:
+            with self._lock:
+                self._scheduled.discard(image_name)
 
 
 @contextmanager
@@ -36,14 +153,47 @@ def guestmount(image_path: Path) -> Iterator[Path]:
         # It seems image is not released immediately after guestunmount returns
         # thus we have to wait until write-lock is released, but at most k
         # seconds
-        with aetherscale.timing.timeout(seconds=5):
-            logging.debug(f'Waiting for write lock to get released')
+        wait_for_write_lock(image_path, timeout=5)
+
+
+def wait_for_write_lock(image_path: Path, timeout: float):
+    logging.debug(f'Waiting for write lock on {image_path} to get released')
+
+    delay = 0.005
+
+    with timing.deadline(timeout) as deadline:
+        while image_is_locked(image_path):
+            deadline.sleep(delay)
+            delay = min(delay * 2, 0.25)
+
+
+# struct flock on Linux: l_type, l_whence, l_start, l_len, l_pid
+FLOCK_FORMAT = 'hhqqi4x'
 
-            access_ok = False
-            while not access_ok:
-                # qemu-img info fails if write lock cannot be retrieved
-                result = subprocess.run(['qemu-img', 'info', str(image_path)])
-                access_ok = result.returncode == 0
+
+def image_is_locked(image_path: Path) -> bool:
+    """Check whether another process (e.g. the QEMU of the libguestfs
+    appliance) holds a lock on the image
+
+    QEMU locks images with open file description locks, which we can probe
+    without forking a process and without taking the lock ourselves."""
+    if not hasattr(fcntl, 'F_OFD_GETLK'):
+        # qemu-img info fails if write lock cannot be retrieved
+        result = run_command(
+            ['qemu-img', 'info', str(image_path)], check_exit=False,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return result.returncode != 0
+
+    fd = os.open(image_path, os.O_RDONLY)
+    try:
+        # a write lock over the whole file conflicts with any existing lock
+        probe = struct.pack(
+            FLOCK_FORMAT, fcntl.F_WRLCK, os.SEEK_SET, 0, 0, 0)
+        result = fcntl.fcntl(fd, fcntl.F_OFD_GETLK, probe)
+        lock_type = struct.unpack(FLOCK_FORMAT, result)[0]
+        return lock_type != fcntl.F_UNLCK
+    finally:
+        os.close(fd)
 
 
 def install_startup_script(script_source: str, mount_dir: Path):
@@ -69,6 +219,23 @@ def install_startup_script(script_source: str, mount_dir: Path):
         os.chmod(executable_target, 0o755)
 
 
+def create_seed_directory(vm_id: str, script_source: str, seed_dir: Path):
+    """Prepare a cloud-init NoCloud seed that runs the init-script once
+
+    The directory is attached to the VM as a FAT drive with the label cidata,
+    so the user image never has to be mounted. cloud-init has to be installed
+    in the base image. The script must start with a shebang, otherwise
+    cloud-init will not execute it."""
+    seed_dir.mkdir(parents=True, exist_ok=True)
+
+    with open(seed_dir / 'meta-data', 'wt') as f:
+        f.write(f'instance-id: {vm_id}\n')
+        f.write(f'local-hostname: {vm_id}\n')
+
+    with open(seed_dir / 'user-data', 'wt') as f:
+        f.write(script_source)
+
+
 def create_systemd_startup_unit(
         f: TextIO, startup_script: Path):
     logging.debug(f'Creating systemd init-script service at {startup_script}')
@@ -1,13 +1,28 @@
+import asyncio
 from dataclasses import dataclass
 import enum
+import itertools
 import logging
 import json
 from pathlib import Path
 import random
 import socket
-from typing import Any, Dict, Optional, List
+import struct
+import threading
+from typing import Any, Callable, Dict, Optional, List, Tuple
 
-from aetherscale.qemu.exceptions import QemuException
+from aetherscale.qemu.exceptions import QemuException, QemuConnectionClosed
+from aetherscale import metrics
+from aetherscale import timing
+from aetherscale import tracing
+
+QEMU_ROUNDTRIP = metrics.histogram(
+    'aetherscale_qemu_roundtrip_seconds',
+    'Duration of QMP and guest agent commands', ['protocol', 'command'])
+QEMU_TIMEOUTS = metrics.counter(
+    'aetherscale_qemu_timeouts',
+    'QMP and guest agent commands that did not receive an answer in time',
+    ['protocol'])
 
 
 class QemuInterfaceType(enum.Enum):
@@ -28,6 +43,10 @@ class QemuStartupConfig:
     vm_id: str
     hda_image: Path
     interfaces: List[QemuInterfaceConfig]
+    seed_directory: Optional[Path] = None
+    # memory in MiB
+    memory: int = 4096
+    vcpus: int = 1
 
 
 class QemuProtocol(enum.Enum):
@@ -46,6 +65,7 @@ class QemuMonitor:
         self.f = self.sock.makefile('rw')
         self.protocol = protocol
 
+        timeout = timing.remaining_timeout(timeout)
         if timeout:
             self.sock.settimeout(timeout)
 
@@ -55,6 +75,48 @@ class QemuMonitor:
     def execute(
             self, command: str,
             arguments: Optional[Dict[str, Any]] = None) -> Any:
+        protocol = self.protocol.name.lower()
+
+        with tracing.span(f'{protocol} {command}'), \
+                QEMU_ROUNDTRIP.time(protocol=protocol, command=command):
+            self._send(command, arguments)
+
+            while True:
+                message = json.loads(self.readline())
+
+                # QMP sends asynchronous events on the same channel, these
+                # are not the answer to our command
+                if 'event' in message:
+                    logging.debug(f'Skipping QEMU event {message["event"]}')
+                    continue
+
+                return message
+
+    def is_alive(self) -> bool:
+        """Check without blocking whether the server closed the connection"""
+        # with a timeout python would wait for data before peeking
+        timeout = self.sock.gettimeout()
+        self.sock.settimeout(0)
+
+        try:
+            data = self.sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+            # an empty read means that the server closed the connection,
+            # pending data (e.g. QMP events) is fine
+            return len(data) > 0
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+        finally:
+            self.sock.settimeout(timeout)
+
+    def close(self):
+        self.f.close()
+        self.sock.close()
+
+    def _send(
+            self, command: str,
+            arguments: Optional[Dict[str, Any]] = None):
         message = {'execute': command}
         if arguments:
             message['arguments'] = arguments
@@ -62,7 +124,6 @@ class QemuMonitor:
         json_line = json.dumps(message) + '\r\n'
         logging.debug(f'Sending message to QEMU: {json_line}')
         self.sock.sendall(json_line.encode('utf-8'))
-        return json.loads(self.readline())
 
     def _initialize(self):
         if self.protocol == QemuProtocol.QMP:
@@ -85,27 +146,389 @@ class QemuMonitor:
         self.sock.sendall(prepend_byte)
 
         rand_int = random.randint(100000, 1000000)
-        self.execute('guest-sync', {'id': rand_int})
+        self._send('guest-sync', {'id': rand_int})
 
-        return json.loads(self.readline())
+        # The guest agent might still send answers to commands of previous
+        # connections or an error for the flush byte, so we have to skip
+        # everything until our sync response arrives
+        while True:
+            message = json.loads(self.readline())
+            if message.get('return') == rand_int:
+                return message
 
     def readline(self) -> Any:
         try:
             logging.debug('Waiting for message from QEMU')
             data = self.f.readline()
             logging.debug(f'Received message from QEMU: {data}')
-            return data
         except socket.timeout:
+            QEMU_TIMEOUTS.inc(protocol=self.protocol.name.lower())
             raise QemuException(
                 'Could not communicate with QEMU, is QMP server or GA running?')
 
+        if data == '':
+            raise QemuConnectionClosed('QEMU closed the connection')
+
+        return data
+
+
+class QemuConnectionPool:
+    """Keeps negotiated QMP and QGA connections open between requests
+
+    Each socket has at most one connection which is protected by a lock, so
+    that commands to different VMs can run in parallel while commands to the
+    same VM are serialized."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._connections: Dict[Tuple[Path, QemuProtocol], QemuMonitor] = {}
+        self._connection_locks: \
+            Dict[Tuple[Path, QemuProtocol], threading.Lock] = {}
+
+    def execute(
+            self, socket_file: Path, protocol: QemuProtocol, command: str,
+            arguments: Optional[Dict[str, Any]] = None,
+            timeout: Optional[float] = None) -> Any:
+        key = (socket_file, protocol)
+
+        with self._connection_lock(key):
+            # A pooled connection might have been closed by QEMU (e.g. after
+            # a restart of the VM) without us noticing, so retry once with a
+            # fresh connection
+            for attempt in range(2):
+                monitor = self._get_connection(key, timeout)
+
+                try:
+                    return monitor.execute(command, arguments)
+                except QemuConnectionClosed:
+                    self._discard(key)
+
+                    if attempt > 0:
+                        raise
+                except Exception:
+                    # after a timeout the answer might arrive later and get
+                    # mixed up with the next answer, so never re-use
+                    self._discard(key)
+                    raise
+
+    def close(self, socket_file: Path):
+        for protocol in QemuProtocol:
+            key = (socket_file, protocol)
+            with self._connection_lock(key):
+                self._discard(key)
+
+            with self._lock:
+                self._connection_locks.pop(key, None)
+
+    def close_all(self):
+        with self._lock:
+            socket_files = set(
+                socket_file for socket_file, _ in self._connections.keys())
+
+        for socket_file in socket_files:
+            self.close(socket_file)
+
+    def _connection_lock(
+            self, key: Tuple[Path, QemuProtocol]) -> threading.Lock:
+        with self._lock:
+            return self._connection_locks.setdefault(key, threading.Lock())
+
+    def _get_connection(
+            self, key: Tuple[Path, QemuProtocol],
+            timeout: Optional[float]) -> QemuMonitor:
+        with self._lock:
+            monitor = self._connections.get(key)
+
+        if monitor and not monitor.is_alive():
+            logging.debug(f'Pooled connection to {key[0]} is closed')
+            self._discard(key)
+            monitor = None
+
+        if monitor:
+            monitor.sock.settimeout(timing.remaining_timeout(timeout))
+        else:
+            socket_file, protocol = key
+            logging.debug(f'Opening pooled connection to {socket_file}')
+            monitor = QemuMonitor(socket_file, protocol, timeout)
+
+            with self._lock:
+                self._connections[key] = monitor
+
+        return monitor
+
+    def _discard(self, key: Tuple[Path, QemuProtocol]):
+        with self._lock:
+            monitor = self._connections.pop(key, None)
+
+        if monitor:
+            monitor.close()
+
+
+QemuEventCallback = Callable[[Dict[str, Any]], None]
+
+
+class AsyncQemuMonitor:
+    """asyncio QMP client
+
+    Unlike QemuMonitor this client tags each command with an id and matches
+    replies by that id, so that asynchronous events (e.g. SHUTDOWN, STOP or
+    BLOCK_JOB_COMPLETED) can arrive on the same socket at any time. Events
+    are passed to all subscribers."""
+
+    def __init__(self, socket_file: Path):
+        self.socket_file = socket_file
+
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._read_task: Optional[asyncio.Task] = None
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._ids = itertools.count()
+        self._subscribers: List[QemuEventCallback] = []
+
+    async def connect(self):
+        self._reader, self._writer = \
+            await asyncio.open_unix_connection(str(self.socket_file))
+
+        greeting = json.loads(await self._reader.readline())
+        if 'QMP' not in greeting:
+            self._writer.close()
+            raise QemuException(f'No QMP server at {self.socket_file}')
+
+        self._read_task = asyncio.create_task(self._read_messages())
+        await self.execute('qmp_capabilities')
+
+    def subscribe(self, callback: QemuEventCallback):
+        self._subscribers.append(callback)
+
+    def peer_pid(self) -> Optional[int]:
+        """PID of the connected QEMU process"""
+        if not self._writer:
+            return None
+
+        sock = self._writer.get_extra_info('socket')
+        creds = sock.getsockopt(
+            socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+        pid, _, _ = struct.unpack('3i', creds)
+        return pid
+
+    async def execute(
+            self, command: str,
+            arguments: Optional[Dict[str, Any]] = None) -> Any:
+        if not self._writer or self._read_task.done():
+            raise QemuConnectionClosed('Not connected to QEMU')
+
+        command_id = f'aetherscale-{next(self._ids)}'
+        message = {'execute': command, 'id': command_id}
+        if arguments:
+            message['arguments'] = arguments
+
+        reply = asyncio.get_running_loop().create_future()
+        self._pending[command_id] = reply
+
+        json_line = json.dumps(message) + '\r\n'
+        logging.debug(f'Sending message to QEMU: {json_line}')
+        self._writer.write(json_line.encode('utf-8'))
+        await self._writer.drain()
+
+        return await reply
+
+    async def wait_closed(self):
+        """Wait until QEMU closes the connection, e.g. because it exited"""
+        if self._read_task:
+            await asyncio.shield(self._read_task)
+
+    async def close(self):
+        if self._writer:
+            self._writer.close()
+
+        if self._read_task:
+            await self._read_task
+
+    async def _read_messages(self):
+        try:
+            while True:
+                line = await self._reader.readline()
+                if not line:
+                    break
+
+                logging.debug(f'Received message from QEMU: {line}')
+                message = json.loads(line)
+
+                if 'event' in message:
+                    self._publish(message)
+                elif 'id' in message:
+                    reply = self._pending.pop(message['id'], None)
+                    if reply and not reply.done():
+                        reply.set_result(message)
+        except (OSError, json.JSONDecodeError) as e:
+            logging.warning(f'Error reading from {self.socket_file}: {e}')
+        finally:
+            for reply in self._pending.values():
+                if not reply.done():
+                    reply.set_exception(
+                        QemuConnectionClosed('QEMU closed the connection'))
+            self._pending.clear()
+
+    def _publish(self, event: Dict[str, Any]):
+        for callback in self._subscribers:
+            try:
+                callback(event)
+            except Exception:
+                logging.exception('Error in QEMU event subscriber')
+
+
+class QemuEventListener:
+    """Receives QMP events of many VMs on one event loop
+
+    The event loop runs in a background thread, so that the listener can be
+    used from synchronous code. on_connect is called with the VM ID and the
+    PID of the QEMU process, on_event with the VM ID and the event and
+    on_close once QEMU closes the connection (e.g. because the VM process
+    exited). on_connect_failed is called with the VM ID if the events
+    socket could not be connected within connect_timeout. All callbacks
+    run on the event loop thread."""
+
+    def __init__(
+            self, on_event: Callable[[str, Dict[str, Any]], None],
+            on_close: Optional[Callable[[str], None]] = None,
+            on_connect: Optional[Callable[[str, Optional[int]], None]] = None,
+            on_connect_failed: Optional[Callable[[str], None]] = None,
+            connect_timeout: float = 10):
+        self.on_event = on_event
+        self.on_close = on_close
+        self.on_connect = on_connect
+        self.on_connect_failed = on_connect_failed
+        self.connect_timeout = connect_timeout
+
+        self._loop = asyncio.new_event_loop()
+        self._monitors: Dict[str, AsyncQemuMonitor] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+        self._thread = threading.Thread(
+            target=self._loop.run_forever, name='qemu-events', daemon=True)
+        self._thread.start()
+
+    def watch(self, vm_id: str, socket_file: Path):
+        self._loop.call_soon_threadsafe(
+            self._start_watching, vm_id, socket_file)
+
+    def unwatch(self, vm_id: str):
+        self._loop.call_soon_threadsafe(self._stop_watching, vm_id)
+
+    def is_watching(self, vm_id: str) -> bool:
+        """Whether the listener is connected to the events socket of a VM,
+        i.e. whether on_close will be called once the VM process exits"""
+        return vm_id in self._monitors
+
+    def execute(
+            self, vm_id: str, command: str,
+            arguments: Optional[Dict[str, Any]] = None,
+            timeout: Optional[float] = None) -> Any:
+        async def execute():
+            try:
+                monitor = self._monitors[vm_id]
+            except KeyError:
+                raise QemuException(f'VM "{vm_id}" is not watched')
+
+            return await monitor.execute(command, arguments)
+
+        future = asyncio.run_coroutine_threadsafe(execute(), self._loop)
+        return future.result(timeout)
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(
+            self._stop_all(), self._loop).result()
+
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    def _start_watching(self, vm_id: str, socket_file: Path):
+        if vm_id in self._tasks:
+            return
+
+        task = self._loop.create_task(self._watch(vm_id, socket_file))
+        self._tasks[vm_id] = task
+
+    def _stop_watching(self, vm_id: str):
+        task = self._tasks.pop(vm_id, None)
+        if task:
+            task.cancel()
+
+    async def _stop_all(self):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _watch(self, vm_id: str, socket_file: Path):
+        monitor = AsyncQemuMonitor(socket_file)
+
+        try:
+            # QEMU creates the socket shortly after the VM was started
+            loop_time = self._loop.time
+            deadline = loop_time() + self.connect_timeout
+            backoff = 0.05
+            while True:
+                try:
+                    await monitor.connect()
+                    break
+                except (OSError, QemuException, ValueError) as e:
+                    # a socket of a starting QEMU might not answer properly
+                    # yet, close the connection before trying again
+                    await monitor.close()
+                    monitor = AsyncQemuMonitor(socket_file)
+
+                    if loop_time() + backoff > deadline:
+                        logging.warning(
+                            f'Could not connect to event socket of VM '
+                            f'"{vm_id}": {e}')
+                        if self.on_connect_failed:
+                            self.on_connect_failed(vm_id)
+                        return
+
+                    await asyncio.sleep(backoff)
+                    backoff = min(backoff * 2, 1)
+
+            monitor.subscribe(lambda event: self.on_event(vm_id, event))
+            self._monitors[vm_id] = monitor
+            logging.debug(f'Listening for QEMU events of VM "{vm_id}"')
+
+            if self.on_connect:
+                self.on_connect(vm_id, monitor.peer_pid())
+
+            await monitor.wait_closed()
+
+            if self.on_close:
+                self.on_close(vm_id)
+        finally:
+            self._monitors.pop(vm_id, None)
+            self._tasks.pop(vm_id, None)
+            await monitor.close()
+
 
 class GuestAgentIpAddress:
-    def __init__(self, socket_file: Path, timeout: float = 1):
-        self.comm_channel = QemuMonitor(socket_file, QemuProtocol.QGA, timeout)
+    def __init__(
+            self, socket_file: Path, timeout: float = 1,
+            pool: Optional[QemuConnectionPool] = None):
+        self.socket_file = socket_file
+        self.timeout = timeout
+        self.pool = pool
+
+        if not pool:
+            self.comm_channel = QemuMonitor(
+                socket_file, QemuProtocol.QGA, timeout)
 
     def fetch_ip_addresses(self):
-        resp = self.comm_channel.execute('guest-network-get-interfaces')
+        command = 'guest-network-get-interfaces'
+        if self.pool:
+            resp = self.pool.execute(
+                self.socket_file, QemuProtocol.QGA, command,
+                timeout=self.timeout)
+        else:
+            resp = self.comm_channel.execute(command)
+
         return self._parse_ips_from_response(resp)
 
     def _parse_ips_from_response(self, response):
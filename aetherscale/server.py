@@ -1,8 +1,11 @@
+from pathlib import Path
 import sys
 
 from aetherscale import __version__
+from aetherscale import config
 from aetherscale import dependencies
 from aetherscale import networking
+from aetherscale import tracing
 import aetherscale.api.broker
 import aetherscale.api.rest
 
@@ -18,11 +21,14 @@ def main():
         print(help_text, file=sys.stderr)
         sys.exit(1)
 
+    if config.TRACE_FILE:
+        tracing.set_exporter(tracing.FileExporter(Path(config.TRACE_FILE)))
+
     if not networking.Iproute2Network.check_device_existence('br0'):
         print('aetherscale expects a device br0 to exist', file=sys.stderr)
         sys.exit(1)
 
     elif len(sys.argv) >= 2 and sys.argv[1] == 'http':
-        aetherscale.api.rest.app.run()
+        aetherscale.api.rest.serve(config.REST_HOST, config.REST_PORT)
     else:
         aetherscale.api.broker.run()
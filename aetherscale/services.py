@@ -1,10 +1,18 @@
 from abc import ABC, abstractmethod
+import logging
 from pathlib import Path
 import shutil
 import subprocess
-from typing import Optional, List
+import threading
+from typing import Any, Optional, List, Set, Tuple
 
-from aetherscale.execution import run_command_chain
+from aetherscale import config
+from aetherscale import timing
+from aetherscale.execution import run_command, run_command_chain
+
+
+class ServiceException(Exception):
+    pass
 
 
 class ServiceManager(ABC):
@@ -46,7 +54,14 @@ class ServiceManager(ABC):
 
     @abstractmethod
     def service_is_running(self, service_name: str) -> bool:
-        """Check whether a service is currently running"""
+        """Check whether a service is currently running. Raise
+        ServiceException if the state cannot be determined."""
+
+    def running_services(self, service_names: List[str]) -> Set[str]:
+        """Names of the given services that are currently running. Raise
+        ServiceException if the state cannot be determined."""
+        return {
+            name for name in service_names if self.service_is_running(name)}
 
     @abstractmethod
     def service_exists(self, service_name: str) -> bool:
@@ -56,26 +71,47 @@ class ServiceManager(ABC):
     def list_services(self) -> List[str]:
         """List all available services"""
 
+    def install_services(self, services: List[Tuple[Path, str]]) -> bool:
+        """Install several services given as pairs of configuration file and
+        service name. Service managers can override this to reload their
+        configuration only once for the whole batch."""
+        results = [
+            self.install_service(config_file, service_name)
+            for config_file, service_name in services]
+        return all(results)
+
+    def start_services(self, service_names: List[str]) -> bool:
+        """Start several services"""
+        return all([self.start_service(name) for name in service_names])
+
+    def enable_services(self, service_names: List[str]) -> bool:
+        """Enable several services"""
+        return all([self.enable_service(name) for name in service_names])
+
 
 class SystemdServiceManager(ServiceManager):
     def __init__(self, unit_folder: Path):
         self.unit_folder = unit_folder
 
     def install_service(self, config_file: Path, service_name: str) -> bool:
-        if '.' not in service_name:
-            raise ValueError('Unit name must contain the suffix, e.g. .service')
+        return self.install_services([(config_file, service_name)])
 
-        target_unit_path = self._systemd_unit_path(service_name)
-        target_unit_path.parent.mkdir(parents=True, exist_ok=True)
+    def install_services(self, services: List[Tuple[Path, str]]) -> bool:
+        for config_file, service_name in services:
+            if '.' not in service_name:
+                raise ValueError(
+                    'Unit name must contain the suffix, e.g. .service')
 
-        try:
-            shutil.copyfile(config_file, target_unit_path)
-        except OSError:
-            return False
+        for config_file, service_name in services:
+            target_unit_path = self._systemd_unit_path(service_name)
+            target_unit_path.parent.mkdir(parents=True, exist_ok=True)
 
-        # Reload systemd
-        r = subprocess.run(['systemctl', '--user', 'daemon-reload'])
-        return r.returncode == 0
+            try:
+                shutil.copyfile(config_file, target_unit_path)
+            except OSError:
+                return False
+
+        return self._reload()
 
     def install_simple_service(
             self, command: str, service_name: str,
@@ -99,9 +135,7 @@ class SystemdServiceManager(ServiceManager):
             f.write('[Install]\n')
             f.write('WantedBy=default.target\n')
 
-        # Reload systemd
-        r = subprocess.run(['systemctl', '--user', 'daemon-reload'])
-        return r.returncode == 0
+        return self._reload()
 
     def uninstall_service(self, service_name: str) -> bool:
         if '.' not in service_name:
@@ -118,6 +152,12 @@ class SystemdServiceManager(ServiceManager):
             ['systemctl', '--user', 'start', service_name],
         ])
 
+    def start_services(self, service_names: List[str]) -> bool:
+        # systemd starts the units of a single call in parallel
+        return run_command_chain([
+            ['systemctl', '--user', 'start', *service_names],
+        ])
+
     def stop_service(self, service_name: str) -> bool:
         return run_command_chain([
             ['systemctl', '--user', 'stop', service_name],
@@ -133,16 +173,47 @@ class SystemdServiceManager(ServiceManager):
             ['systemctl', '--user', 'enable', service_name],
         ])
 
+    def enable_services(self, service_names: List[str]) -> bool:
+        # one systemctl call and one reload of systemd for all units
+        return run_command_chain([
+            ['systemctl', '--user', 'enable', *service_names],
+        ])
+
     def disable_service(self, service_name: str) -> bool:
         return run_command_chain([
             ['systemctl', '--user', 'disable', service_name],
         ])
 
     def service_is_running(self, service_name: str) -> bool:
-        result = subprocess.run([
-            'systemctl', '--user', 'is-active', '--quiet', service_name])
+        try:
+            result = run_command(
+                ['systemctl', '--user', 'is-active', '--quiet', service_name],
+                check_exit=False)
+        except subprocess.TimeoutExpired:
+            # not knowing the state is different from a stopped service
+            raise ServiceException(
+                f'Checking the state of {service_name} timed out')
+
         return result.returncode == 0
 
+    def running_services(self, service_names: List[str]) -> Set[str]:
+        # is-active prints the state of each unit on a line of its own
+        try:
+            result = run_command(
+                ['systemctl', '--user', 'is-active', *service_names],
+                check_exit=False, stdout=subprocess.PIPE, text=True)
+        except subprocess.TimeoutExpired:
+            raise ServiceException('Checking the state of services timed out')
+
+        states = result.stdout.splitlines()
+        if len(states) != len(service_names):
+            raise ServiceException(
+                f'Could not check the state of services: {result.stderr}')
+
+        return {
+            name for name, state in zip(service_names, states)
+            if state == 'active'}
+
     def service_exists(self, service_name: str) -> bool:
         return self._systemd_unit_path(service_name).is_file()
 
@@ -155,5 +226,197 @@ class SystemdServiceManager(ServiceManager):
 
         return services
 
+    def _reload(self) -> bool:
+        try:
+            r = run_command(['systemctl', '--user', 'daemon-reload'])
+        except subprocess.TimeoutExpired:
+            return False
+
+        return r.returncode == 0
+
     def _systemd_unit_path(self, service_name: str) -> Path:
         return self.unit_folder / service_name
+
+
+class DbusException(Exception):
+    pass
+
+
+class SystemdBus(ABC):
+    """Connection to the systemd manager on D-Bus"""
+
+    @abstractmethod
+    def call(
+            self, path: str, interface: str, method: str,
+            signature: str = '', args: Tuple = ()) -> Tuple:
+        """Call a method on an object of systemd and return the reply body.
+        Raise DbusException if systemd returns an error."""
+
+
+class JeepneySystemdBus(SystemdBus):
+    def __init__(self, bus: str = 'SESSION'):
+        # jeepney is only required when the D-Bus service manager is used
+        from jeepney.io.blocking import open_dbus_connection
+
+        self.connection = open_dbus_connection(bus=bus)
+        # jeepney connections must not be used by several threads at once
+        self._lock = threading.Lock()
+
+    def call(
+            self, path: str, interface: str, method: str,
+            signature: str = '', args: Tuple = ()) -> Tuple:
+        from jeepney import DBusAddress, MessageType, new_method_call
+
+        address = DBusAddress(
+            path, bus_name='org.freedesktop.systemd1', interface=interface)
+        message = new_method_call(address, method, signature or None, args)
+
+        with self._lock:
+            reply = self.connection.send_and_get_reply(message)
+
+        if reply.header.message_type == MessageType.error:
+            raise DbusException(f'{method} failed: {reply.body}')
+
+        return reply.body
+
+
+class DbusServiceManager(SystemdServiceManager):
+    """Control systemd through one D-Bus connection instead of forking a
+    systemctl process for each operation. Unit files are managed in the
+    unit folder exactly like SystemdServiceManager does it."""
+
+    SYSTEMD_PATH = '/org/freedesktop/systemd1'
+    MANAGER_INTERFACE = 'org.freedesktop.systemd1.Manager'
+    UNIT_INTERFACE = 'org.freedesktop.systemd1.Unit'
+    JOB_INTERFACE = 'org.freedesktop.systemd1.Job'
+    PROPERTIES_INTERFACE = 'org.freedesktop.DBus.Properties'
+    # systemd's default timeout for starting and stopping a unit
+    JOB_TIMEOUT = 90
+
+    def __init__(self, unit_folder: Path, bus: Optional[SystemdBus] = None):
+        super().__init__(unit_folder)
+        self.bus = bus if bus else JeepneySystemdBus()
+
+    def start_service(self, service_name: str) -> bool:
+        return self.start_services([service_name])
+
+    def start_services(self, service_names: List[str]) -> bool:
+        if not self._run_jobs('StartUnit', service_names):
+            return False
+
+        return all(self.service_is_running(name) for name in service_names)
+
+    def stop_service(self, service_name: str) -> bool:
+        return self._run_jobs('StopUnit', [service_name])
+
+    def restart_service(self, service_name: str) -> bool:
+        if not self._run_jobs('RestartUnit', [service_name]):
+            return False
+
+        return self.service_is_running(service_name)
+
+    def enable_service(self, service_name: str) -> bool:
+        return self.enable_services([service_name])
+
+    def enable_services(self, service_names: List[str]) -> bool:
+        # runtime=False: enable persistently, force=True: replace symlinks
+        if not self._call_all(
+                'EnableUnitFiles', 'asbb', [(service_names, False, True)]):
+            return False
+
+        # systemctl enable reloads systemd after changing the symlinks, too
+        return self._reload()
+
+    def disable_service(self, service_name: str) -> bool:
+        if not self._call_all(
+                'DisableUnitFiles', 'asb', [([service_name], False)]):
+            return False
+
+        return self._reload()
+
+    def service_is_running(self, service_name: str) -> bool:
+        try:
+            unit_path, = self._manager_call('GetUnit', 's', (service_name,))
+            _, state = self.bus.call(
+                unit_path, self.PROPERTIES_INTERFACE, 'Get', 'ss',
+                (self.UNIT_INTERFACE, 'ActiveState'))[0]
+        except DbusException:
+            # systemd does not know units that are not loaded
+            return False
+
+        return state == 'active'
+
+    def running_services(self, service_names: List[str]) -> Set[str]:
+        # D-Bus calls do not fork a process, one call per unit is cheap
+        return ServiceManager.running_services(self, service_names)
+
+    def _reload(self) -> bool:
+        return self._call_all('Reload', '', [()])
+
+    def _run_jobs(self, method: str, service_names: List[str]) -> bool:
+        """Queue a job for each unit and wait until all jobs are finished
+
+        Unlike systemctl, systemd's D-Bus methods return as soon as the job
+        was queued, e.g. before the process of a stopped unit exited."""
+        success = True
+        job_paths = []
+
+        for name in service_names:
+            try:
+                job_path, = self._manager_call(
+                    method, 'ss', (name, 'replace'))
+                job_paths.append(job_path)
+            except DbusException as e:
+                logging.error(str(e))
+                success = False
+
+        try:
+            with timing.deadline(self.JOB_TIMEOUT) as deadline:
+                for job_path in job_paths:
+                    backoff = 0.01
+                    while self._job_exists(job_path):
+                        deadline.sleep(backoff)
+                        backoff = min(backoff * 2, 0.5)
+        except TimeoutError:
+            logging.error(f'systemd job {method} did not finish in time')
+            return False
+
+        return success
+
+    def _job_exists(self, job_path: str) -> bool:
+        try:
+            self.bus.call(
+                job_path, self.PROPERTIES_INTERFACE, 'Get', 'ss',
+                (self.JOB_INTERFACE, 'State'))
+        except DbusException:
+            # systemd removes jobs once they are finished
+            return False
+
+        return True
+
+    def _call_all(
+            self, method: str, signature: str, all_args: List[Tuple]) -> bool:
+        success = True
+
+        for args in all_args:
+            try:
+                self._manager_call(method, signature, args)
+            except DbusException as e:
+                logging.error(str(e))
+                success = False
+
+        return success
+
+    def _manager_call(
+            self, method: str, signature: str, args: Tuple) -> Tuple[Any]:
+        logging.debug(f'Calling systemd {method}{args} on D-Bus')
+        return self.bus.call(
+            self.SYSTEMD_PATH, self.MANAGER_INTERFACE, method, signature,
+            args)
+
+
+def create_service_manager(unit_folder: Path) -> ServiceManager:
+    if config.SERVICE_MANAGER == 'dbus':
+        return DbusServiceManager(unit_folder)
+    else:
+        return SystemdServiceManager(unit_folder)
@@ -1,17 +1,183 @@
 from contextlib import contextmanager
+import contextvars
 import signal
+import threading
+import time
+from typing import Dict, Iterator, Optional
+
+from aetherscale import tracing
+
+
+class OperationCancelled(Exception):
+    pass
+
+
+class Deadline:
+    """Point in time after which an operation should be given up
+
+    Deadlines can be nested, a nested deadline never ends later than its
+    parent. They do not rely on signals and can thus be used in any thread
+    and in asyncio tasks. Blocking calls should use remaining() as their
+    timeout, waiting loops should use sleep() so that they can be
+    cancelled."""
+
+    def __init__(
+            self, seconds: Optional[float],
+            parent: Optional['Deadline'] = None):
+        self.expires_at = None
+        if seconds is not None:
+            self.expires_at = time.monotonic() + seconds
+
+        self.parent = parent
+        self._cancelled = threading.Event()
+
+    def remaining(self) -> Optional[float]:
+        """Seconds until the deadline is reached, None if unlimited"""
+        remaining = None
+        if self.expires_at is not None:
+            remaining = max(self.expires_at - time.monotonic(), 0)
+
+        if self.parent:
+            parent_remaining = self.parent.remaining()
+            if remaining is None:
+                remaining = parent_remaining
+            elif parent_remaining is not None:
+                remaining = min(remaining, parent_remaining)
+
+        return remaining
+
+    def timeout(self, default: Optional[float] = None) -> Optional[float]:
+        """Timeout for a single blocking call, at most default seconds"""
+        remaining = self.remaining()
+        if remaining is None:
+            return default
+        elif default is None:
+            return remaining
+        else:
+            return min(remaining, default)
+
+    @property
+    def cancelled(self) -> bool:
+        if self._cancelled.is_set():
+            return True
+
+        return self.parent is not None and self.parent.cancelled
+
+    def expired(self) -> bool:
+        return self.remaining() == 0
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def check(self):
+        """Raise an exception if the operation should be given up"""
+        if self.cancelled:
+            raise OperationCancelled
+        if self.expired():
+            raise TimeoutError
+
+    def sleep(self, seconds: float):
+        """Sleep, but wake up early if the deadline is reached or cancelled"""
+        self.check()
+
+        timeout = self.timeout(seconds)
+        # cancellation of a parent is only noticed after the sleep
+        self._cancelled.wait(timeout)
+
+        if self.cancelled or timeout < seconds:
+            self.check()
+
+
+# timeout for blocking calls once a deadline expired
+MIN_TIMEOUT = 0.001
+
+_current_deadline: contextvars.ContextVar[Optional[Deadline]] = \
+    contextvars.ContextVar('aetherscale_deadline', default=None)
 
 
 @contextmanager
-def timeout(seconds: int):
+def deadline(seconds: Optional[float]) -> Iterator[Deadline]:
+    """Run a block of code with a deadline that applies to all blocking
+    calls made in this context (use remaining_timeout() for them)
+
+    The deadline is stored in a context variable, so it is visible in the
+    current thread and in asyncio tasks created inside the block. Work
+    handed to other threads has to be run with contextvars.copy_context()
+    to see it."""
+    current = Deadline(seconds, parent=_current_deadline.get())
+    token = _current_deadline.set(current)
+
+    try:
+        yield current
+    finally:
+        _current_deadline.reset(token)
+
+
+def current_deadline() -> Optional[Deadline]:
+    return _current_deadline.get()
+
+
+def remaining_timeout(default: Optional[float] = None) -> Optional[float]:
+    """Timeout for a blocking call (e.g. subprocess or socket): the remaining
+    time of the current deadline, but at most default seconds
+
+    This never raises, an expired or cancelled deadline results in a minimal
+    timeout so that the blocking call fails the way it always does when it
+    times out."""
+    current = _current_deadline.get()
+    if current is None:
+        return default
+
+    if current.cancelled:
+        return MIN_TIMEOUT
+
+    timeout = current.timeout(default)
+    if timeout is None:
+        return None
+
+    # 0 would make sockets non-blocking instead of timing out immediately
+    return max(timeout, MIN_TIMEOUT)
+
+
+@contextmanager
+def timeout(seconds: float):
+    """Run a block of code with a specified timeout. If the block is not
+    finished after the defined time, raise an exception.
+
+    This interrupts blocking calls with SIGALRM and thus only works in the
+    main thread, deadline() should be preferred."""
     def raise_exception(signum, frame):
         raise TimeoutError
 
-    """Run a block of code with a specified timeout. If the block is not
-    finished after the defined time, raise an exception."""
+    previous_handler = signal.signal(signal.SIGALRM, raise_exception)
     try:
-        signal.signal(signal.SIGALRM, raise_exception)
-        signal.alarm(seconds)
+        signal.setitimer(signal.ITIMER_REAL, seconds)
         yield None
     finally:
-        signal.signal(signal.SIGALRM, signal.SIG_IGN)
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
+
+
+class PhaseTimer:
+    """Measures the wall-clock duration of the phases of an operation, each
+    phase is also recorded as a tracing span"""
+
+    def __init__(self):
+        self.durations: Dict[str, float] = {}
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.monotonic()
+        try:
+            with tracing.span(name):
+                yield None
+        finally:
+            duration = time.monotonic() - start
+            self.durations[name] = self.durations.get(name, 0) + duration
+
+    def summary(self) -> Dict[str, float]:
+        """Durations of all phases in seconds, rounded to milliseconds"""
+        return {
+            name: round(duration, 3)
+            for name, duration in self.durations.items()
+        }
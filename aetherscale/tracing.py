@@ -0,0 +1,194 @@
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+import contextvars
+from dataclasses import dataclass, field
+import json
+import os
+from pathlib import Path
+import socket
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional
+
+
+@dataclass
+class Span:
+    name: str
+    trace_id: str
+    span_id: str
+    parent_span_id: Optional[str]
+    start_ns: int
+    end_ns: Optional[int] = None
+    attributes: Dict[str, Any] = field(default_factory=dict)
+    error: Optional[str] = None
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    @property
+    def duration(self) -> Optional[float]:
+        if self.end_ns is None:
+            return None
+
+        return (self.end_ns - self.start_ns) / 1e9
+
+
+class SpanExporter(ABC):
+    @abstractmethod
+    def export(self, spans: List[Span]):
+        """Export finished spans, called with all spans of a trace once none
+        of them is running anymore"""
+
+
+class FileExporter(SpanExporter):
+    """Appends one OTLP/JSON document per trace to a file (the format of
+    the OpenTelemetry collector's file exporter)"""
+
+    def __init__(self, path: Path, service_name: str = 'aetherscale'):
+        self.path = path
+        self.service_name = service_name
+        self._lock = threading.Lock()
+
+    def export(self, spans: List[Span]):
+        document = json.dumps(self.to_otlp(spans))
+
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(document + '\n')
+
+    def to_otlp(self, spans: List[Span]) -> Dict[str, Any]:
+        resource = {
+            'service.name': self.service_name,
+            'host.name': socket.gethostname(),
+        }
+
+        return {
+            'resourceSpans': [{
+                'resource': {'attributes': _otlp_attributes(resource)},
+                'scopeSpans': [{
+                    'scope': {'name': 'aetherscale'},
+                    'spans': [_otlp_span(span) for span in spans],
+                }],
+            }],
+        }
+
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    elif isinstance(value, int):
+        # 64-bit integers are encoded as strings in OTLP/JSON
+        return {'intValue': str(value)}
+    elif isinstance(value, float):
+        return {'doubleValue': value}
+    elif isinstance(value, (list, tuple)):
+        return {'arrayValue': {'values': [_otlp_value(v) for v in value]}}
+    else:
+        return {'stringValue': str(value)}
+
+
+def _otlp_attributes(attributes: Dict[str, Any]) -> List[Dict[str, Any]]:
+    return [
+        {'key': key, 'value': _otlp_value(value)}
+        for key, value in attributes.items()
+    ]
+
+
+def _otlp_span(span: Span) -> Dict[str, Any]:
+    otlp_span = {
+        'traceId': span.trace_id,
+        'spanId': span.span_id,
+        'name': span.name,
+        # SPAN_KIND_INTERNAL
+        'kind': 1,
+        'startTimeUnixNano': str(span.start_ns),
+        'endTimeUnixNano': str(span.end_ns),
+        'attributes': _otlp_attributes(span.attributes),
+    }
+
+    if span.parent_span_id:
+        otlp_span['parentSpanId'] = span.parent_span_id
+
+    if span.error is None:
+        # STATUS_CODE_OK
+        otlp_span['status'] = {'code': 1}
+    else:
+        # STATUS_CODE_ERROR
+        otlp_span['status'] = {'code': 2, 'message': span.error}
+
+    return otlp_span
+
+
+_current_span: contextvars.ContextVar[Optional[Span]] = \
+    contextvars.ContextVar('aetherscale_span', default=None)
+
+_lock = threading.Lock()
+_exporter: Optional[SpanExporter] = None
+# finished spans of traces that still have running spans
+_pending: Dict[str, List[Span]] = {}
+# number of running spans per trace
+_open_traces: Dict[str, int] = {}
+
+
+def set_exporter(exporter: Optional[SpanExporter]):
+    global _exporter
+
+    with _lock:
+        _exporter = exporter
+        _pending.clear()
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Span]:
+    """Record a span for a block of code
+
+    Spans inside the block become children of this span. Like deadlines,
+    the current span is stored in a context variable, work handed to other
+    threads has to be run with contextvars.copy_context()."""
+    parent = _current_span.get()
+    trace_id = parent.trace_id if parent else os.urandom(16).hex()
+
+    current = Span(
+        name=name, trace_id=trace_id, span_id=os.urandom(8).hex(),
+        parent_span_id=parent.span_id if parent else None,
+        start_ns=time.time_ns(), attributes=attributes)
+
+    with _lock:
+        _open_traces[trace_id] = _open_traces.get(trace_id, 0) + 1
+
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = str(e) or type(e).__name__
+        raise
+    finally:
+        _current_span.reset(token)
+        current.end_ns = time.time_ns()
+        _finish(current)
+
+
+def _finish(finished: Span):
+    with _lock:
+        exporter = _exporter
+        trace_id = finished.trace_id
+
+        _open_traces[trace_id] -= 1
+        if exporter is None:
+            if _open_traces[trace_id] == 0:
+                del _open_traces[trace_id]
+            return
+
+        _pending.setdefault(trace_id, []).append(finished)
+        if _open_traces[trace_id] > 0:
+            return
+
+        # all spans of the trace are finished, export them together
+        del _open_traces[trace_id]
+        spans = _pending.pop(trace_id)
+
+    exporter.export(spans)
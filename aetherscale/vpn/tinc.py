@@ -9,6 +9,7 @@ import tempfile
 from typing import Optional
 
 from aetherscale import config
+from aetherscale import execution
 from aetherscale.services import ServiceManager
 
 
@@ -80,9 +81,13 @@ class TincVirtualNetwork(object):
 
     def gen_keypair(self):
         logging.debug('Generating key pair for tinc')
-        subprocess.run(
-            ['tincd', '-K', '-c', self._net_config_folder()],
-            stdin=subprocess.DEVNULL)
+        try:
+            execution.run_command(
+                ['tincd', '-K', '-c', self._net_config_folder()],
+                stdin=subprocess.DEVNULL)
+        except subprocess.TimeoutExpired:
+            raise VpnException(
+                f'Generating key pair for VPN "{self.netname}" timed out')
         logging.debug('Finished generating key pair')
 
     def _validate_netname(self, netname: str):
@@ -0,0 +1,236 @@
+"""Load generator for the AMQP path between client and broker
+
+Starts several hosts, each with its own connection, exclusive queue and
+ComputingHandler as in api.broker, and many concurrent clients that send
+a mix of list-vms, create-vm and stop-vm commands with
+client.ServerCommunication, optionally several at once per client.
+External programs are replaced by the shims of the lifecycle benchmark.
+
+By default an in-process stand-in replaces RabbitMQ, with --rabbitmq the
+hosts and clients connect to RABBITMQ_HOST:
+
+    python -m benchmarks.broker_load --hosts 20 --clients 50 --duration 30
+"""
+import argparse
+import collections
+import logging
+import random
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+from benchmarks import lifecycle
+
+DEFAULT_MIX = {'list-vms': 6, 'create-vm': 2, 'stop-vm': 2}
+
+
+class CommandStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.first_latencies: Dict[str, List[float]] = \
+            collections.defaultdict(list)
+        self.last_latencies: Dict[str, List[float]] = \
+            collections.defaultdict(list)
+        self.requests: Dict[str, int] = collections.Counter()
+        self.responses: Dict[str, int] = collections.Counter()
+        self.timeouts: Dict[str, int] = collections.Counter()
+
+    def record(self, command: str, arrivals: List[float]):
+        with self._lock:
+            self.requests[command] += 1
+            self.responses[command] += len(arrivals)
+
+            if arrivals:
+                self.first_latencies[command].append(min(arrivals))
+                self.last_latencies[command].append(max(arrivals))
+            else:
+                self.timeouts[command] += 1
+
+
+class Host:
+    """A broker host that consumes commands on its own thread"""
+
+    def __init__(self, connection_parameters):
+        from aetherscale.api import broker
+        import pika
+
+        self.handler = lifecycle.create_handler('memory')
+        self.connection = pika.BlockingConnection(connection_parameters)
+        self.channel = self.connection.channel()
+        queue_name = broker.declare_queues(self.channel)
+        self.consumer = broker.consume(
+            self.connection, self.channel, self.handler, queue_name)
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        self.channel.start_consuming()
+
+        if self.consumer:
+            self.consumer.shutdown()
+        self.connection.close()
+
+    def stop(self):
+        self.connection.add_callback_threadsafe(self.channel.stop_consuming)
+        self.thread.join()
+
+
+def build_request(command: str, vm_ids: List[str]) -> Dict[str, Any]:
+    if command == 'create-vm':
+        options: Dict[str, Any] = {
+            'image': lifecycle.IMAGE_NAME, 'public-ip': True}
+    elif command == 'stop-vm':
+        vm_id = random.choice(vm_ids) if vm_ids else 'missing'
+        options = {'vm-id': vm_id, 'kill': True}
+    else:
+        options = {}
+
+    return {'command': command, 'options': options}
+
+
+def run_client(
+        deadline: float, mix: Dict[str, int], stats: CommandStats,
+        vm_ids: List[str], pipeline: int):
+    from aetherscale.client import ServerCommunication
+
+    commands = list(mix.keys())
+    weights = list(mix.values())
+
+    with ServerCommunication() as communication:
+        while time.monotonic() < deadline:
+            requests = [
+                communication.send(build_request(command, vm_ids))
+                for command in random.choices(commands, weights, k=pipeline)
+            ]
+            communication.wait(requests)
+
+            for request in requests:
+                stats.record(request.command, request.reply_times)
+
+                if request.command != 'create-vm':
+                    continue
+
+                for response in request.responses:
+                    vm_id = response.get('response', {}).get('vm-id')
+                    if vm_id:
+                        vm_ids.append(vm_id)
+                        break
+
+
+def print_report(stats: CommandStats, duration: float, hosts: List[Host]):
+    from aetherscale.client import RESPONSE_TIMEOUT
+
+    requests = sum(stats.requests.values())
+    responses = sum(stats.responses.values())
+    timeouts = sum(stats.timeouts.values())
+
+    print(f'{requests / duration:.1f} requests/s, '
+          f'{(requests + responses) / duration:.1f} messages/s, '
+          f'{timeouts / max(requests, 1):.1%} without response in '
+          f'{RESPONSE_TIMEOUT} s')
+
+    print(f'{"command":<10} {"requests":>9} {"replies/req":>12} '
+          f'{"p50 ms":>9} {"p90 ms":>9} {"p99 ms":>9} {"last p99":>9} '
+          f'{"timeouts":>9}')
+    for command in sorted(stats.requests):
+        first = stats.first_latencies[command]
+        last = stats.last_latencies[command]
+
+        def ms(values: List[float], fraction: float) -> str:
+            if not values:
+                return '-'
+            return f'{lifecycle.percentile(values, fraction) * 1000:.1f}'
+
+        replies = stats.responses[command] / stats.requests[command]
+        print(f'{command:<10} {stats.requests[command]:>9} '
+              f'{replies:>12.1f} {ms(first, 0.5):>9} {ms(first, 0.9):>9} '
+              f'{ms(first, 0.99):>9} {ms(last, 0.99):>9} '
+              f'{stats.timeouts[command]:>9}')
+
+    vms_per_host = [len(host.handler.inventory) for host in hosts]
+    print(f'VMs per host: min {min(vms_per_host)}, max {max(vms_per_host)}')
+
+
+def parse_mix(mix: str) -> Dict[str, int]:
+    """Parse a mix like list-vms=6,create-vm=2,stop-vm=2"""
+    weights = {}
+    for part in mix.split(','):
+        command, weight = part.split('=')
+        weights[command.strip()] = int(weight)
+
+    return weights
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Generate load on the broker hosts')
+    parser.add_argument('--hosts', type=int, default=20)
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument(
+        '--duration', type=float, default=30,
+        help='Seconds during which clients send new requests')
+    parser.add_argument(
+        '--mix', type=parse_mix,
+        default=','.join(f'{c}={w}' for c, w in DEFAULT_MIX.items()),
+        help='Weights of the commands, e.g. list-vms=6,create-vm=2')
+    parser.add_argument(
+        '--pipeline', type=int, default=1,
+        help='Requests each client keeps in flight')
+    parser.add_argument(
+        '--latency', type=float, default=0, help='Seconds each shim sleeps')
+    parser.add_argument(
+        '--rabbitmq', action='store_true',
+        help='Connect to RABBITMQ_HOST instead of the in-process broker')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='aetherscale-load-') as tmp:
+        lifecycle.prepare_environment(Path(tmp), args.latency)
+
+        import pika
+        from aetherscale import config
+        from benchmarks.inprocess_amqp import InProcessBroker
+
+        # all hosts except one answer stop-vm with an error, which the
+        # broker logs with a traceback
+        logging.disable(logging.ERROR)
+
+        if args.rabbitmq:
+            parameters = pika.ConnectionParameters(host=config.RABBITMQ_HOST)
+            run_load(args, parameters)
+        else:
+            with InProcessBroker().patch_pika():
+                run_load(args, None)
+
+
+def run_load(args, parameters):
+    hosts = [Host(parameters) for _ in range(args.hosts)]
+
+    stats = CommandStats()
+    vm_ids: List[str] = []
+    start = time.monotonic()
+    deadline = start + args.duration
+
+    clients = [
+        threading.Thread(
+            target=run_client,
+            args=(deadline, args.mix, stats, vm_ids, args.pipeline))
+        for _ in range(args.clients)
+    ]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    duration = time.monotonic() - start
+
+    for host in hosts:
+        host.stop()
+
+    print(f'{args.hosts} hosts, {args.clients} clients, {duration:.1f} s')
+    print_report(stats, duration, hosts)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+from pathlib import Path
+import threading
+from typing import List, Optional
+
+from aetherscale.services import ServiceManager
+
+
+class MemoryServiceManager(ServiceManager):
+    """Keeps services in memory like the mock_service_manager fixture of the
+    tests, so that a benchmark only measures aetherscale itself"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.services = set()
+        self.started_services = set()
+        self.enabled_services = set()
+
+    def install_service(self, config_file: Path, service_name: str) -> bool:
+        with self._lock:
+            self.services.add(service_name)
+        return True
+
+    def install_simple_service(
+            self, command: str, service_name: str,
+            description: Optional[str] = None) -> bool:
+        with self._lock:
+            self.services.add(service_name)
+        return True
+
+    def uninstall_service(self, service_name: str) -> bool:
+        with self._lock:
+            self.services.discard(service_name)
+        return True
+
+    def start_service(self, service_name: str) -> bool:
+        with self._lock:
+            self.started_services.add(service_name)
+        return True
+
+    def stop_service(self, service_name: str) -> bool:
+        with self._lock:
+            self.started_services.discard(service_name)
+        return True
+
+    def restart_service(self, service_name: str) -> bool:
+        return True
+
+    def enable_service(self, service_name: str) -> bool:
+        with self._lock:
+            self.enabled_services.add(service_name)
+        return True
+
+    def disable_service(self, service_name: str) -> bool:
+        with self._lock:
+            self.enabled_services.discard(service_name)
+        return True
+
+    def service_is_running(self, service_name: str) -> bool:
+        with self._lock:
+            return service_name in self.started_services
+
+    def service_exists(self, service_name: str) -> bool:
+        with self._lock:
+            return service_name in self.services
+
+    def list_services(self) -> List[str]:
+        with self._lock:
+            return list(self.services)
@@ -0,0 +1,292 @@
+"""In-process stand-in for RabbitMQ
+
+Implements the part of pika's BlockingConnection that aetherscale's broker
+and client use: direct exchanges, named, exclusive and server-named queues,
+competing consumers with prefetch limits, acknowledgements, direct reply-to
+and timers. Like with pika, callbacks of a connection are only run by the
+thread that called start_consuming()."""
+from contextlib import contextmanager
+import copy
+import heapq
+import itertools
+import queue
+import threading
+import time
+import types
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set
+
+import pika
+
+DIRECT_REPLY_TO = 'amq.rabbitmq.reply-to'
+
+
+class _Consumer:
+    def __init__(
+            self, channel: 'Channel', callback: Callable, auto_ack: bool):
+        self.channel = channel
+        self.callback = callback
+        self.auto_ack = auto_ack
+        self.unacked = 0
+
+    def has_capacity(self) -> bool:
+        prefetch = self.channel.prefetch_count
+        return self.auto_ack or prefetch == 0 or self.unacked < prefetch
+
+
+class _Queue:
+    def __init__(self, name: str, owner: Optional['Connection']):
+        self.name = name
+        # exclusive queues are deleted with the connection that declared them
+        self.owner = owner
+        self.messages: List[Any] = []
+        self.consumers: List[_Consumer] = []
+        self.next_consumer = 0
+
+
+class InProcessBroker:
+    def __init__(self):
+        self._lock = threading.RLock()
+        # exchange name -> routing key -> names of bound queues
+        self._bindings: Dict[str, Dict[str, Set[str]]] = {}
+        self._queues: Dict[str, _Queue] = {}
+        self._names = itertools.count(1)
+
+    def connect(self, parameters: Any = None) -> 'Connection':
+        return Connection(self)
+
+    @contextmanager
+    def patch_pika(self) -> Iterator[None]:
+        """Let pika.BlockingConnection connect to this broker"""
+        original = pika.BlockingConnection
+        pika.BlockingConnection = self.connect
+        try:
+            yield
+        finally:
+            pika.BlockingConnection = original
+
+    def new_name(self, prefix: str) -> str:
+        return f'{prefix}.{next(self._names)}'
+
+    def declare_exchange(self, exchange: str):
+        with self._lock:
+            self._bindings.setdefault(exchange, {})
+
+    def declare_queue(
+            self, name: str, owner: Optional['Connection']) -> _Queue:
+        with self._lock:
+            if name not in self._queues:
+                self._queues[name] = _Queue(name, owner)
+
+            return self._queues[name]
+
+    def bind(self, exchange: str, queue_name: str, routing_key: str):
+        with self._lock:
+            self._bindings[exchange].setdefault(
+                routing_key, set()).add(queue_name)
+
+    def publish(self, exchange: str, routing_key: str, properties, body):
+        with self._lock:
+            if exchange == '':
+                # the default exchange routes to the queue of the same name
+                queue_names = {routing_key}
+            else:
+                queue_names = self._bindings.get(exchange, {}).get(
+                    routing_key, set())
+
+            for queue_name in queue_names:
+                target = self._queues.get(queue_name)
+                if target:
+                    target.messages.append((properties, body))
+                    self._dispatch(target)
+
+    def consume(self, queue_name: str, consumer: _Consumer):
+        with self._lock:
+            target = self._queues[queue_name]
+            target.consumers.append(consumer)
+            self._dispatch(target)
+
+    def acknowledge(self, queue_name: str, consumer: _Consumer):
+        with self._lock:
+            consumer.unacked -= 1
+            target = self._queues.get(queue_name)
+            if target:
+                self._dispatch(target)
+
+    def disconnect(self, connection: 'Connection'):
+        with self._lock:
+            for name, target in list(self._queues.items()):
+                target.consumers = [
+                    c for c in target.consumers
+                    if c.channel.connection is not connection]
+
+                if target.owner is connection:
+                    del self._queues[name]
+                    for bindings in self._bindings.values():
+                        for queue_names in bindings.values():
+                            queue_names.discard(name)
+                else:
+                    self._dispatch(target)
+
+    def message_count(self, queue_name: str) -> int:
+        with self._lock:
+            return len(self._queues[queue_name].messages)
+
+    def _dispatch(self, target: _Queue):
+        """Hand queued messages round-robin to consumers with free
+        prefetch capacity"""
+        while target.messages and target.consumers:
+            for _ in range(len(target.consumers)):
+                index = target.next_consumer % len(target.consumers)
+                target.next_consumer += 1
+                consumer = target.consumers[index]
+                if consumer.has_capacity():
+                    break
+            else:
+                return
+
+            properties, body = target.messages.pop(0)
+            consumer.channel.deliver(target.name, consumer, properties, body)
+
+
+class Channel:
+    def __init__(self, connection: 'Connection'):
+        self.connection = connection
+        self.broker = connection.broker
+        self.prefetch_count = 0
+
+        self._delivery_tags = itertools.count(1)
+        self._unacked: Dict[int, Any] = {}
+        self._consuming = False
+
+    def exchange_declare(self, exchange: str, exchange_type: str = 'direct'):
+        self.broker.declare_exchange(exchange)
+
+    def queue_declare(
+            self, queue: str, exclusive: bool = False, passive: bool = False):
+        if queue == '':
+            queue = self.broker.new_name('amq.gen')
+
+        self.broker.declare_queue(
+            queue, owner=self.connection if exclusive else None)
+
+        return types.SimpleNamespace(method=types.SimpleNamespace(
+            queue=queue, message_count=self.broker.message_count(queue)))
+
+    def queue_bind(self, exchange: str, queue: str, routing_key: str):
+        self.broker.bind(exchange, queue, routing_key)
+
+    def basic_qos(self, prefetch_count: int = 0):
+        self.prefetch_count = prefetch_count
+
+    def basic_consume(
+            self, queue: str, on_message_callback: Callable,
+            auto_ack: bool = False):
+        if queue == DIRECT_REPLY_TO:
+            queue = self.connection.reply_queue()
+
+        consumer = _Consumer(self, on_message_callback, auto_ack)
+        self.broker.consume(queue, consumer)
+
+    def basic_publish(
+            self, exchange: str, routing_key: str, body: bytes,
+            properties: Optional[pika.BasicProperties] = None):
+        if properties and properties.reply_to == DIRECT_REPLY_TO:
+            properties = copy.copy(properties)
+            properties.reply_to = self.connection.reply_queue()
+
+        self.broker.publish(exchange, routing_key, properties, body)
+
+    def basic_ack(self, delivery_tag: int):
+        queue_name, consumer = self._unacked.pop(delivery_tag)
+        self.broker.acknowledge(queue_name, consumer)
+
+    def deliver(
+            self, queue_name: str, consumer: _Consumer, properties, body):
+        """Called by the broker, runs the consumer's callback on the
+        consuming thread of this connection"""
+        delivery_tag = next(self._delivery_tags)
+        if not consumer.auto_ack:
+            consumer.unacked += 1
+            self._unacked[delivery_tag] = (queue_name, consumer)
+
+        method = types.SimpleNamespace(
+            delivery_tag=delivery_tag, routing_key=queue_name)
+        self.connection.add_callback_threadsafe(
+            lambda: consumer.callback(self, method, properties, body))
+
+    def start_consuming(self):
+        self._consuming = True
+        while self._consuming and not self.connection.closed:
+            self.connection.process_events()
+
+    def stop_consuming(self):
+        self._consuming = False
+
+
+class Connection:
+    def __init__(self, broker: InProcessBroker):
+        self.broker = broker
+        self.closed = False
+
+        self._events: queue.Queue = queue.Queue()
+        self._timers: List[Any] = []
+        self._timer_ids = itertools.count(1)
+        self._reply_queue: Optional[str] = None
+
+    def channel(self) -> Channel:
+        return Channel(self)
+
+    def reply_queue(self) -> str:
+        if not self._reply_queue:
+            self._reply_queue = self.broker.new_name(DIRECT_REPLY_TO)
+            self.broker.declare_queue(self._reply_queue, owner=self)
+
+        return self._reply_queue
+
+    def add_callback_threadsafe(self, callback: Callable[[], Any]):
+        self._events.put(callback)
+
+    def call_later(self, delay: float, callback: Callable[[], Any]) -> int:
+        timer_id = next(self._timer_ids)
+        heapq.heappush(
+            self._timers, (time.monotonic() + delay, timer_id, callback))
+        return timer_id
+
+    def remove_timeout(self, timer_id: int):
+        self._timers = [t for t in self._timers if t[1] != timer_id]
+        heapq.heapify(self._timers)
+
+    def process_events(self, time_limit: float = 0.1):
+        """Run due timers and wait for at most time_limit seconds for a
+        callback"""
+        now = time.monotonic()
+        while self._timers and self._timers[0][0] <= now:
+            _, _, callback = heapq.heappop(self._timers)
+            callback()
+
+        wait = time_limit
+        if self._timers:
+            wait = min(wait, max(self._timers[0][0] - now, 0))
+
+        try:
+            callback = self._events.get(timeout=wait)
+        except queue.Empty:
+            return
+
+        callback()
+
+    def process_data_events(self, time_limit: float = 0):
+        """Like process_events, but run all callbacks that are ready"""
+        self.process_events(time_limit)
+
+        while True:
+            try:
+                callback = self._events.get_nowait()
+            except queue.Empty:
+                return
+
+            callback()
+
+    def close(self):
+        self.closed = True
+        self.broker.disconnect(self)
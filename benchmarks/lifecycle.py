@@ -0,0 +1,275 @@
+"""Throughput and latency of the VM lifecycle in ComputingHandler
+
+External programs (qemu-img, guestmount, ip, tincd and systemctl) are
+replaced by the shims in benchmarks/shims, which only sleep for a
+configurable latency. All files are created in a temporary folder.
+
+    python -m benchmarks.lifecycle
+    python -m benchmarks.lifecycle --latency 0.05 --sizes 10 100
+    python -m benchmarks.lifecycle --save
+"""
+import argparse
+import concurrent.futures
+import json
+import math
+import os
+from pathlib import Path
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List
+
+BENCHMARK_FOLDER = Path(__file__).parent
+SHIM_FOLDER = BENCHMARK_FOLDER / 'shims'
+BASELINE_FILE = BENCHMARK_FOLDER / 'baselines.json'
+
+DEFAULT_SIZES = [10, 100, 1000]
+IMAGE_NAME = 'benchmark'
+# differences below this are noise, e.g. for operations that take
+# microseconds
+MIN_DIFFERENCE_MS = 1
+
+Results = Dict[str, Dict[str, Dict[str, float]]]
+
+
+def prepare_environment(work_dir: Path, latency: float):
+    """Point aetherscale to a temporary folder and to the shims
+
+    Must be called before aetherscale is imported, because its configuration
+    is read on import."""
+    home = work_dir / 'home'
+    base_images = work_dir / 'base_images'
+    user_images = work_dir / 'user_images'
+
+    (home / '.config/systemd/user').mkdir(parents=True)
+    base_images.mkdir()
+    user_images.mkdir()
+    (base_images / f'{IMAGE_NAME}.qcow2').touch()
+
+    os.environ['HOME'] = str(home)
+    os.environ['BASE_IMAGE_FOLDER'] = str(base_images)
+    os.environ['USER_IMAGE_FOLDER'] = str(user_images)
+    os.environ['PATH'] = f'{SHIM_FOLDER}{os.pathsep}{os.environ["PATH"]}'
+    os.environ['SHIM_STATE_DIR'] = str(work_dir / 'shim_state')
+    os.environ['SHIM_LATENCY'] = str(latency)
+    os.environ.setdefault('OVERLAY_POOL_SIZE', '0')
+
+
+def create_handler(service_manager_type: str):
+    from aetherscale.computing import ComputingHandler
+    from aetherscale import config
+    from aetherscale.qemu import image
+    from aetherscale import services
+
+    if service_manager_type == 'memory':
+        from benchmarks.fakes import MemoryServiceManager
+        service_manager = MemoryServiceManager()
+    else:
+        service_manager = services.SystemdServiceManager(
+            Path.home() / '.config/systemd/user')
+
+    overlay_pool = None
+    if config.OVERLAY_POOL_SIZE > 0:
+        overlay_pool = image.OverlayPool(
+            config.BASE_IMAGE_FOLDER, config.OVERLAY_POOL_SIZE)
+        overlay_pool.warm()
+
+    return ComputingHandler(
+        radvd=None, service_manager=service_manager,
+        overlay_pool=overlay_pool)
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """Nearest-rank percentile"""
+    ordered = sorted(values)
+    rank = max(math.ceil(fraction * len(ordered)), 1)
+    return ordered[rank - 1]
+
+
+def measure(
+        operation: Callable[[Any], Any], arguments: List[Any],
+        workers: int) -> Dict[str, float]:
+    latencies = []
+
+    def timed(argument):
+        start = time.perf_counter()
+        result = operation(argument)
+        latencies.append(time.perf_counter() - start)
+        return result
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(timed, arguments))
+    duration = time.perf_counter() - start
+
+    return {
+        'count': len(arguments),
+        'ops_per_second': round(len(arguments) / duration, 2),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+    }
+
+
+def run_lifecycle(
+        handler, size: int, options: Dict[str, Any], list_repeats: int,
+        workers: int) -> Dict[str, Dict[str, float]]:
+    vm_ids = []
+
+    def create(_):
+        responses = list(handler.create_vm(dict(options)))
+        vm_ids.append(responses[-1]['vm-id'])
+
+    def list_vms(_):
+        return list(handler.list_vms({}))
+
+    def stop(vm_id):
+        return list(handler.stop_vm({'vm-id': vm_id, 'kill': True}))
+
+    def delete(vm_id):
+        return list(handler.delete_vm({'vm-id': vm_id}))
+
+    results = {}
+    results['create'] = measure(create, list(range(size)), workers)
+    results['list'] = measure(list_vms, list(range(list_repeats)), workers)
+    results['stop'] = measure(stop, list(vm_ids), workers)
+    results['delete'] = measure(delete, list(vm_ids), workers)
+
+    return results
+
+
+def _slower(value: float, expected: float, tolerance: float) -> bool:
+    return value > expected * (1 + tolerance) + MIN_DIFFERENCE_MS
+
+
+def compare(results: Results, baseline: Results, tolerance: float) \
+        -> List[str]:
+    """Return a description of each result that is worse than the baseline
+    by more than the tolerance (e.g. 0.25 for 25 %)"""
+    regressions = []
+
+    for size, operations in results.items():
+        for operation, result in operations.items():
+            expected = baseline.get(size, {}).get(operation)
+            if not expected:
+                continue
+
+            for key in ['p50_ms', 'p99_ms']:
+                if _slower(result[key], expected[key], tolerance):
+                    regressions.append(
+                        f'{operation} at {size} VMs: {key} {result[key]} '
+                        f'(baseline {expected[key]})')
+
+            # compare throughput as time per operation
+            if _slower(1000 / result['ops_per_second'],
+                       1000 / expected['ops_per_second'], tolerance):
+                regressions.append(
+                    f'{operation} at {size} VMs: ops_per_second '
+                    f'{result["ops_per_second"]} '
+                    f'(baseline {expected["ops_per_second"]})')
+
+    return regressions
+
+
+def print_results(results: Results, baseline: Results):
+    print(f'{"VMs":>6} {"operation":<10} {"ops/s":>10} {"p50 ms":>10} '
+          f'{"p99 ms":>10} {"baseline p50":>13}')
+
+    for size, operations in results.items():
+        for operation, result in operations.items():
+            expected = baseline.get(size, {}).get(operation)
+            baseline_p50 = f'{expected["p50_ms"]:>13}' if expected else ''
+            print(f'{size:>6} {operation:<10} '
+                  f'{result["ops_per_second"]:>10} {result["p50_ms"]:>10} '
+                  f'{result["p99_ms"]:>10} {baseline_p50}')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the VM lifecycle of ComputingHandler')
+    parser.add_argument(
+        '--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+        help='Numbers of VMs to create, list, stop and delete')
+    parser.add_argument(
+        '--latency', type=float, default=0,
+        help='Seconds each shim sleeps, override single programs with '
+             'e.g. SHIM_LATENCY_QEMU_IMG')
+    parser.add_argument(
+        '--service-manager', choices=['systemctl', 'memory'],
+        default='systemctl',
+        help='"systemctl" runs the systemctl shim, "memory" keeps services '
+             'in memory')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--list-repeats', type=int, default=20)
+    parser.add_argument(
+        '--init-script', action='store_true',
+        help='Install an init-script into each VM with guestmount')
+    parser.add_argument(
+        '--vpn', action='store_true', help='Attach each VM to a VPN')
+    parser.add_argument('--baseline', type=Path, default=BASELINE_FILE)
+    parser.add_argument(
+        '--save', action='store_true',
+        help='Store the results as new baseline')
+    parser.add_argument(
+        '--tolerance', type=float, default=0.5,
+        help='Allowed slowdown compared to the baseline, 0.5 is 50 %%')
+    args = parser.parse_args()
+
+    settings = {
+        'latency': args.latency,
+        'service-manager': args.service_manager,
+        'workers': args.workers,
+        'list-repeats': args.list_repeats,
+        'init-script': args.init_script,
+        'vpn': args.vpn,
+        'latency-overrides': {
+            name: value for name, value in sorted(os.environ.items())
+            if name.startswith('SHIM_LATENCY_')
+        },
+    }
+
+    options: Dict[str, Any] = {'image': IMAGE_NAME, 'public-ip': True}
+    if args.init_script:
+        options['init-script'] = '#!/bin/sh\ntrue\n'
+        options['init-method'] = 'guestmount'
+    if args.vpn:
+        options['vpn'] = 'bench'
+
+    with tempfile.TemporaryDirectory(prefix='aetherscale-bench-') as tmp:
+        prepare_environment(Path(tmp), args.latency)
+        handler = create_handler(args.service_manager)
+
+        results: Results = {}
+        for size in args.sizes:
+            results[str(size)] = run_lifecycle(
+                handler, size, options, args.list_repeats, args.workers)
+
+    baseline: Results = {}
+    if args.baseline.is_file():
+        with open(args.baseline) as f:
+            stored = json.load(f)
+
+        if stored['settings'] == settings:
+            baseline = stored['results']
+        elif not args.save:
+            print(f'Baseline {args.baseline} was recorded with different '
+                  f'settings {stored["settings"]}, not comparing')
+
+    print_results(results, baseline)
+
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump({'settings': settings, 'results': results}, f, indent=2)
+            f.write('\n')
+        print(f'Stored results as baseline in {args.baseline}')
+        return
+
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f'Regression: {regression}')
+
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
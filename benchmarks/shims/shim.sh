@@ -0,0 +1,16 @@
+# Shared by all shims: sleep for the configured latency of a program.
+# SHIM_LATENCY_<PROGRAM> (e.g. SHIM_LATENCY_QEMU_IMG) overrides SHIM_LATENCY,
+# both are given in seconds.
+shim_sleep() {
+    eval "latency=\${SHIM_LATENCY_$1:-\${SHIM_LATENCY:-0}}"
+    if [ "$latency" != 0 ]; then
+        sleep "$latency"
+    fi
+}
+
+shim_last_argument() {
+    for argument in "$@"; do
+        last="$argument"
+    done
+    echo "$last"
+}
@@ -28,14 +28,14 @@ def create_vm(init_script: Path, comm: ServerCommunication) -> str:
         }
     }, response_expected=True)
 
-    if len(responses) != 1:
-        raise RuntimeError(
-            'Did not receive exactly one response, something went wrong')
+    if len(responses) == 0:
+        raise RuntimeError('Did not receive a response, something went wrong')
 
-    if responses[0]['execution-info']['status'] != 'success':
+    # the last response tells whether the VM was started
+    if responses[-1]['execution-info']['status'] != 'success':
         raise RuntimeError('Execution was not successful')
 
-    return responses[0]['response']['vm-id']
+    return responses[-1]['response']['vm-id']
 
 
 def get_vm_ips(vm_id: str, comm: ServerCommunication) -> List[str]:
@@ -1,7 +1,6 @@
 #!/usr/bin/env python
 
 import sys
-import time
 from typing import List
 
 from aetherscale.client import ServerCommunication
@@ -16,14 +15,14 @@ def create_rabbitmq_vm(comm: ServerCommunication) -> str:
         }
     }, response_expected=True)
 
-    if len(responses) != 1:
-        raise RuntimeError(
-            'Did not receive exactly one response, something went wrong')
+    if len(responses) == 0:
+        raise RuntimeError('Did not receive a response, something went wrong')
 
-    if responses[0]['execution-info']['status'] != 'success':
+    # the last response tells whether the VM was started
+    if responses[-1]['execution-info']['status'] != 'success':
         raise RuntimeError('Execution was not successful')
 
-    return responses[0]['response']['vm-id']
+    return responses[-1]['response']['vm-id']
 
 
 def get_vm_ips(vm_id: str, comm: ServerCommunication) -> List[str]:
@@ -78,11 +77,8 @@ def main():
             print(str(e), file=sys.stderr)
             sys.exit(1)
 
-    time.sleep(30)
-    # TODO: There seems to be a bug in ServerCommunication so that we can only
-    # exchange one message pair per context
-    # Probably related to the AMQ reply-to channel
-    with ServerCommunication() as comm:
+        # keep serving the connection while the VM boots
+        comm.connection.sleep(30)
         ips = get_vm_ips(vm_id, comm)
 
     ips = [f'http://{format_ip_for_url(ip)}:15672/' for ip in ips
@@ -30,6 +30,9 @@ setup(
         ],
     },
     install_requires=install_requires,
+    extras_require={
+        'dbus': ['jeepney'],
+    },
     version=version,
     description='Proof-of-concept for a small cloud computing platform',
     long_description=long_descr,
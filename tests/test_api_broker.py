@@ -0,0 +1,246 @@
+import json
+import pika.exceptions
+import threading
+from unittest import mock
+
+from aetherscale import capacity
+from aetherscale import config
+from aetherscale.api import broker
+from aetherscale.operations import OperationManager
+
+
+class FakeConnection:
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    def add_callback_threadsafe(self, callback):
+        with self.lock:
+            callback()
+
+
+def test_worker_pool_responds_and_acks():
+    handler = mock.MagicMock()
+    handler.stop_vm.return_value = [{'status': 'stopped', 'vm-id': 'abc'}]
+    channel = mock.MagicMock()
+    method = mock.MagicMock(delivery_tag=42)
+    properties = mock.MagicMock(reply_to='reply-queue', correlation_id='c1')
+
+    consumer = broker.WorkerPoolConsumer(FakeConnection(), handler, workers=2)
+    body = json.dumps({'command': 'stop-vm', 'options': {'vm-id': 'abc'}})
+    consumer.on_message(channel, method, properties, body.encode('utf-8'))
+    consumer.shutdown()
+
+    handler.stop_vm.assert_called_with({'vm-id': 'abc'})
+    channel.basic_ack.assert_called_once_with(delivery_tag=42)
+
+    response = json.loads(channel.basic_publish.call_args.kwargs['body'])
+    assert response['execution-info']['status'] == 'success'
+    assert response['response']['vm-id'] == 'abc'
+
+
+def test_invalid_messages_are_acked():
+    channel = mock.MagicMock()
+    method = mock.MagicMock(delivery_tag=1)
+
+    broker.callback(
+        channel, method, mock.MagicMock(), b'{"no-command": 1}',
+        mock.MagicMock())
+
+    channel.basic_ack.assert_called_once_with(delivery_tag=1)
+
+
+def test_ordering_key():
+    assert broker.ordering_key({'options': {'vm-id': 'abc'}}) == 'abc'
+    assert broker.ordering_key({'command': 'list-vms'}) is None
+
+
+def test_command_duration_is_recorded():
+    handler = mock.MagicMock()
+    handler.delete_vm.side_effect = RuntimeError('VM does not exist')
+    errors_before = broker.COMMAND_DURATION.count(
+        command='delete-vm', status='error')
+
+    broker.execute_command(
+        {'command': 'delete-vm', 'options': {'vm-id': 'abc'}},
+        handler, broker.noop_responder)
+
+    assert broker.COMMAND_DURATION.count(
+        command='delete-vm', status='error') == errors_before + 1
+    assert broker.COMMANDS_EXECUTING.value() == 0
+
+
+def test_declare_queues_binds_commands():
+    channel = mock.MagicMock()
+    channel.queue_declare.return_value.method.queue = 'amq.gen-host'
+
+    assert broker.declare_queues(channel) == 'amq.gen-host'
+
+    bindings = {
+        call.kwargs['routing_key']: call.kwargs['queue']
+        for call in channel.queue_bind.call_args_list}
+    assert bindings['list-vms'] == 'amq.gen-host'
+    assert bindings['create-vm'] == broker.COMPETING_QUEUE
+
+
+def test_commands_are_recorded_as_operations():
+    handler = mock.MagicMock()
+    handler.create_vm.return_value = iter([
+        {'status': 'allocating', 'vm-id': 'abc'},
+        {'status': 'starting', 'vm-id': 'abc'},
+    ])
+    operations = OperationManager(workers=1)
+    responses = []
+
+    broker.execute_command(
+        {'command': 'create-vm', 'options': {'image': 'ubuntu'}},
+        handler, responses.append, operations)
+
+    operation_id = responses[0]['execution-info']['operation-id']
+    assert responses[-1]['execution-info']['operation-id'] == operation_id
+
+    broker.execute_command(
+        {'command': 'operation-info',
+         'options': {'operation-id': operation_id}},
+        handler, responses.append, operations)
+
+    info = responses[-1]['response']
+    assert info['status'] == 'succeeded'
+    assert info['result'] == {'status': 'starting', 'vm-id': 'abc'}
+
+    operations.shutdown()
+
+
+def test_only_host_of_vm_records_operation():
+    handler = mock.MagicMock()
+    handler.has_vm.return_value = False
+    handler.stop_vm.side_effect = RuntimeError('VM does not exist')
+    operations = OperationManager(workers=1)
+    responses = []
+
+    broker.execute_command(
+        {'command': 'stop-vm', 'options': {'vm-id': 'abc'}},
+        handler, responses.append, operations)
+
+    assert 'operation-id' not in responses[0]['execution-info']
+    assert operations.recent() == []
+
+    operations.shutdown()
+
+
+def test_create_is_forwarded_to_host_with_capacity():
+    connection = mock.MagicMock()
+    forward_channel = connection.channel.return_value
+    forward_channel.is_closed = False
+    properties = mock.MagicMock(reply_to='reply-queue', correlation_id='c1')
+    scheduler = broker.CapacityScheduler(
+        connection, mock.MagicMock(), mock.MagicMock())
+    scheduler.table.update(capacity.Capacity(
+        host='idle', memory_free=65536, vcpus_free=64, disk_free=65536,
+        vms_running=0))
+    local = capacity.Capacity(
+        host=config.HOSTNAME, memory_free=4096, vcpus_free=4,
+        disk_free=65536, vms_running=5)
+    data = {'command': 'create-vm', 'options': {'image': 'ubuntu'}}
+    responses = []
+
+    with mock.patch('aetherscale.capacity.measure', return_value=local):
+        assert scheduler.schedule(properties, data, responses.append)
+
+        forward_channel.confirm_delivery.assert_called_once()
+        kwargs = forward_channel.basic_publish.call_args.kwargs
+        assert kwargs['routing_key'] == 'create-vm.idle'
+        assert kwargs['mandatory']
+        assert kwargs['properties'].correlation_id == 'c1'
+        assert json.loads(kwargs['body'])['target-host'] == 'idle'
+
+        # placed commands are executed by the receiving host
+        forwarded = json.loads(kwargs['body'])
+        assert not scheduler.schedule(
+            properties, forwarded, responses.append)
+
+        # commands without resources are not placed
+        assert not scheduler.schedule(
+            properties, {'command': 'list-vms'}, responses.append)
+
+    assert responses == []
+
+
+def test_undeliverable_create_is_placed_elsewhere():
+    connection = mock.MagicMock()
+    forward_channel = connection.channel.return_value
+    forward_channel.is_closed = False
+    scheduler = broker.CapacityScheduler(
+        connection, mock.MagicMock(), mock.MagicMock())
+    # the queue of the best host is gone, e.g. because the host died
+    scheduler.table.update(capacity.Capacity(
+        host='dead', memory_free=131072, vcpus_free=64, disk_free=65536,
+        vms_running=0))
+    scheduler.table.update(capacity.Capacity(
+        host='idle', memory_free=65536, vcpus_free=64, disk_free=65536,
+        vms_running=0))
+    local = capacity.Capacity(
+        host=config.HOSTNAME, memory_free=8192, vcpus_free=4,
+        disk_free=65536, vms_running=5)
+    data = {'command': 'create-vm', 'options': {'image': 'ubuntu'}}
+
+    def publish(routing_key, **kwargs):
+        if routing_key == 'create-vm.dead':
+            raise pika.exceptions.UnroutableError([])
+
+    forward_channel.basic_publish.side_effect = publish
+
+    with mock.patch('aetherscale.capacity.measure', return_value=local):
+        assert scheduler.schedule(mock.MagicMock(), data, lambda _: None)
+        assert forward_channel.basic_publish.call_args.kwargs[
+            'routing_key'] == 'create-vm.idle'
+
+        # without another host the command is executed locally
+        scheduler.table.update(capacity.Capacity(
+            host='dead', memory_free=131072, vcpus_free=64,
+            disk_free=65536, vms_running=0))
+        scheduler.table.remove('idle')
+        assert not scheduler.schedule(mock.MagicMock(), data, lambda _: None)
+
+    assert [host.host for host in scheduler.table.fresh()] == []
+
+
+def test_create_is_rejected_without_capacity():
+    scheduler = broker.CapacityScheduler(
+        mock.MagicMock(), mock.MagicMock(), mock.MagicMock())
+    local = capacity.Capacity(
+        host=config.HOSTNAME, memory_free=1024, vcpus_free=4,
+        disk_free=65536, vms_running=5)
+    data = {'command': 'create-vm', 'options': {'image': 'ubuntu'}}
+    responses = []
+
+    with mock.patch('aetherscale.capacity.measure', return_value=local):
+        assert scheduler.schedule(mock.MagicMock(), data, responses.append)
+
+    assert responses[0]['execution-info']['status'] == 'error'
+
+
+def test_queue_gauge_survives_closed_channel():
+    closed = mock.MagicMock(is_closed=False)
+    closed.queue_declare.side_effect = \
+        pika.exceptions.ChannelClosedByBroker(404, 'NOT_FOUND')
+    reopened = mock.MagicMock(is_closed=False)
+    reopened.queue_declare.return_value.method.message_count = 7
+    connection = mock.MagicMock()
+    connection.channel.side_effect = [closed, reopened]
+
+    broker.watch_queue_messages(connection, {'host': 'host-queue'})
+
+    # the broker closed the channel, the next update uses a new one
+    closed.is_closed = True
+    update = connection.call_later.call_args[0][1]
+    update()
+
+    assert broker.QUEUE_MESSAGES.value(queue='host') == 7
+    assert connection.call_later.call_count == 2
+
+    # without connection the gauge is not updated anymore
+    connection.channel.side_effect = \
+        pika.exceptions.AMQPConnectionError('connection lost')
+    reopened.is_closed = True
+    update()
+    assert connection.call_later.call_count == 2
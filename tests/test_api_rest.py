@@ -7,8 +7,14 @@ import aetherscale.api.rest
 
 @pytest.fixture
 def client():
-    with aetherscale.api.rest.app.test_client() as client:
-        return client
+    # the handler is cached, each test needs a new (mocked) one
+    aetherscale.api.rest.reset_handler()
+
+    with mock.patch('aetherscale.config.OPERATIONS_DB', ':memory:'), \
+            aetherscale.api.rest.app.test_client() as client:
+        yield client
+
+    aetherscale.api.rest.reset_handler()
 
 
 @mock.patch('aetherscale.api.rest.ComputingHandler')
@@ -22,6 +28,17 @@ def test_list_vms(handler, client):
     assert len(rv.json) == 1
 
 
+@mock.patch('aetherscale.api.rest.ComputingHandler')
+def test_handler_is_shared_by_requests(handler, client):
+    handler.return_value.list_vms.return_value = [[]]
+    handler.return_value.list_vpns.return_value = [[]]
+
+    client.get('/vm')
+    client.get('/vpn')
+
+    handler.assert_called_once()
+
+
 @mock.patch('aetherscale.api.rest.ComputingHandler')
 def test_show_vm_info(handler, client):
     handler.return_value.vm_info.return_value = [{'vm-id': 'abc123'}]
@@ -31,12 +48,103 @@ def test_show_vm_info(handler, client):
 
 @mock.patch('aetherscale.api.rest.ComputingHandler')
 def test_create_vm(handler, client):
-    client.post(
+    handler.return_value.create_vm.return_value = iter([
+        {'status': 'allocating', 'vm-id': 'abc123'},
+        {'status': 'starting', 'vm-id': 'abc123'},
+    ])
+
+    rv = client.post(
         '/vm', data=json.dumps({'image': 'dummy-image'}),
         content_type='application/json')
 
+    assert rv.status_code == 202
     handler.return_value.create_vm.assert_called_with({'image': 'dummy-image'})
 
+    # long-poll the operation until the VM was created
+    rv = client.get(rv.headers['Location'] + '?wait=5')
+    assert rv.json['status'] == 'succeeded'
+    assert rv.json['result'] == {'status': 'starting', 'vm-id': 'abc123'}
+
+
+@mock.patch('aetherscale.api.rest.ComputingHandler')
+def test_create_vm_failure(handler, client):
+    def failing_create_vm(options):
+        raise IOError('Image "dummy-image" does not exist')
+        yield
+
+    handler.return_value.create_vm.side_effect = failing_create_vm
+
+    rv = client.post(
+        '/vm', data=json.dumps({'image': 'dummy-image'}),
+        content_type='application/json')
+    rv = client.get(
+        f'/operations/{rv.json["operation-id"]}', query_string={'wait': 5})
+
+    assert rv.json['status'] == 'failed'
+    assert 'does not exist' in rv.json['error']
+
+
+@mock.patch('aetherscale.api.rest.ComputingHandler')
+def test_create_vm_without_image(handler, client):
+    rv = client.post(
+        '/vm', data=json.dumps({}), content_type='application/json')
+    assert rv.status_code == 400
+
+
+@mock.patch('aetherscale.api.rest.ComputingHandler')
+def test_create_vms(handler, client):
+    summary = {'status': 'finished', 'vm-ids': ['abc', 'def'], 'failed': []}
+    handler.return_value.create_vms.return_value = iter([summary])
+
+    rv = client.post(
+        '/vm/batch', data=json.dumps({'image': 'dummy-image', 'count': 2}),
+        content_type='application/json')
+    assert rv.status_code == 202
+
+    rv = client.get(rv.headers['Location'] + '?wait=5')
+    assert rv.json['result'] == summary
+
+
+@mock.patch('aetherscale.api.rest.ComputingHandler')
+def test_create_vms_with_invalid_count(handler, client):
+    rv = client.post(
+        '/vm/batch', data=json.dumps({'image': 'dummy-image', 'count': 0}),
+        content_type='application/json')
+
+    assert rv.status_code == 400
+    handler.return_value.create_vms.assert_not_called()
+
+
+@mock.patch('aetherscale.api.rest.ComputingHandler')
+def test_unknown_operation(handler, client):
+    assert client.get('/operations/unknown').status_code == 404
+
+
+@mock.patch('aetherscale.api.rest.ComputingHandler')
+def test_create_vm_streams_progress(handler, client):
+    handler.return_value.create_vm.return_value = iter([
+        {'status': 'allocating', 'vm-id': 'abc123'},
+        {'status': 'progress', 'vm-id': 'abc123', 'phase': 'image',
+         'duration': 0.1},
+        {'status': 'starting', 'vm-id': 'abc123'},
+    ])
+
+    rv = client.post(
+        '/vm', data=json.dumps({'image': 'dummy-image'}),
+        content_type='application/json',
+        headers={'Accept': 'text/event-stream'})
+
+    assert rv.mimetype == 'text/event-stream'
+    events = [
+        json.loads(line[len('data: '):])
+        for line in rv.get_data(as_text=True).splitlines()
+        if line.startswith('data: ')
+    ]
+    assert [event['status'] for event in events] == \
+        ['allocating', 'progress', 'starting']
+    handler.return_value.create_vm.assert_called_with(
+        {'image': 'dummy-image', 'report-progress': True})
+
 
 @mock.patch('aetherscale.api.rest.ComputingHandler')
 def test_delete_vm(handler, client):
@@ -76,3 +184,11 @@ def test_stop_vm(handler, client):
     # missing message must lead to error
     rv = client.patch('/vm/my-vm-id')
     assert rv.status_code == 400
+
+
+def test_metrics_endpoint(client):
+    rv = client.get('/metrics')
+
+    assert rv.status_code == 200
+    assert rv.content_type.startswith('text/plain')
+    assert '# TYPE aetherscale_vms gauge' in rv.get_data(as_text=True)
@@ -0,0 +1,77 @@
+import time
+from unittest import mock
+
+import pytest
+
+from aetherscale import capacity
+
+
+def host(name, memory_free=8192, vcpus_free=8, disk_free=10240, vms=0):
+    return capacity.Capacity(
+        host=name, memory_free=memory_free, vcpus_free=vcpus_free,
+        disk_free=disk_free, vms_running=vms)
+
+
+def test_place_spreads_vms():
+    requirement = capacity.Requirement(memory=2048, vcpus=1, disk=1024)
+    hosts = [
+        host('busy', memory_free=4096, vms=6),
+        host('idle', memory_free=16384),
+        host('small', memory_free=1024),
+    ]
+
+    assert capacity.place(hosts, requirement).host == 'idle'
+
+
+def test_place_without_fitting_host():
+    requirement = capacity.Requirement(memory=2048, vcpus=4, disk=1024)
+    hosts = [host('few-cpus', vcpus_free=2), host('no-disk', disk_free=0)]
+
+    assert capacity.place(hosts, requirement) is None
+
+
+def test_requirement_of_batch():
+    requirement = capacity.requirement(
+        'create-vms',
+        {'image': 'ubuntu', 'memory': 1024, 'vms': [{}, {'vcpus': 2}]})
+
+    assert requirement.memory == 2048
+    assert requirement.vcpus == 3
+
+    with pytest.raises(ValueError):
+        capacity.requirement('create-vm', {'image': 'ubuntu', 'memory': 'x'})
+
+
+def test_table_ignores_old_reports():
+    table = capacity.CapacityTable(max_age=10)
+    table.update(host('current'))
+    old = host('gone')
+    old.timestamp = time.time() - 60
+    table.update(old)
+
+    table.reserve('current', capacity.Requirement(1024, 1, 1024))
+
+    reports = table.fresh()
+    assert [report.host for report in reports] == ['current']
+    assert reports[0].memory_free == 8192 - 1024
+
+
+def test_report_roundtrip():
+    report = host('myhost', vms=3)
+    assert capacity.Capacity.from_dict(report.to_dict()) == report
+
+
+def test_measure_counts_committed_memory():
+    handler = mock.MagicMock()
+    handler.committed_resources.return_value = (6144, 3, 2)
+    memory = mock.Mock(available=64 * 1024 * capacity.MIB,
+                       total=8 * 1024 * capacity.MIB)
+
+    with mock.patch('psutil.virtual_memory', return_value=memory), \
+            mock.patch('psutil.cpu_count', return_value=2), \
+            mock.patch('aetherscale.config.VCPU_OVERCOMMIT', 2):
+        report = capacity.measure(handler)
+
+    assert report.memory_free == 2048
+    assert report.vcpus_free == 1
+    assert report.vms_running == 2
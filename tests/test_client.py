@@ -0,0 +1,264 @@
+import asyncio
+import json
+import threading
+import time
+from unittest import mock
+
+import pytest
+
+from aetherscale import client
+
+
+def success(response):
+    return {'execution-info': {'status': 'success'}, 'response': response}
+
+
+def error(reason):
+    return {'execution-info': {'status': 'error', 'reason': reason}}
+
+
+class FakeConnection:
+    """Answers each published request with the responses of a responder
+    function, delivered on the next call of process_data_events"""
+
+    def __init__(self, responder):
+        self.responder = responder
+        self.published = []
+
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._consumer = None
+
+    def channel(self):
+        return self
+
+    def basic_consume(self, queue, on_message_callback, auto_ack):
+        self._consumer = on_message_callback
+
+    def basic_publish(self, exchange, routing_key, properties, body):
+        data = json.loads(body)
+        self.published.append((data, properties))
+
+        for response in self.responder(data):
+            reply_properties = mock.Mock(
+                correlation_id=properties.correlation_id)
+            self.add_callback_threadsafe(
+                lambda p=reply_properties, r=response:
+                self._consumer(self, None, p, json.dumps(r)))
+
+    def add_callback_threadsafe(self, callback):
+        with self._lock:
+            self._callbacks.append(callback)
+
+    def process_data_events(self, time_limit=0):
+        with self._lock:
+            callbacks = self._callbacks
+            self._callbacks = []
+
+        if not callbacks:
+            time.sleep(min(time_limit, 0.01))
+
+        for callback in callbacks:
+            callback()
+
+    def close(self):
+        pass
+
+
+def communication(responder, **kwargs):
+    connection = FakeConnection(responder)
+    patch = mock.patch.object(
+        client.pika, 'BlockingConnection', return_value=connection)
+    patch.start()
+    try:
+        return client.ServerCommunication(**kwargs).__enter__(), connection
+    finally:
+        patch.stop()
+
+
+def test_create_vm_returns_after_final_response():
+    def responder(data):
+        return [
+            success({'status': 'allocating', 'vm-id': 'abc'}),
+            success({'status': 'starting', 'vm-id': 'abc'}),
+        ]
+
+    comm, connection = communication(responder, timeout=5)
+
+    start = time.monotonic()
+    responses = comm.send_msg(
+        {'command': 'create-vm', 'options': {}}, response_expected=True)
+
+    assert time.monotonic() - start < 1
+    assert [r['response']['status'] for r in responses] == \
+        ['allocating', 'starting']
+    assert connection.published[0][1].correlation_id
+    assert len(comm.pending) == 0
+
+
+def test_vm_command_waits_for_owning_host():
+    def responder(data):
+        return [
+            error('VM does not exist'),
+            success({'status': 'killed', 'vm-id': 'abc'}),
+            error('VM does not exist'),
+        ]
+
+    comm, _ = communication(responder, timeout=5, settle_time=5)
+
+    start = time.monotonic()
+    responses = comm.send_msg(
+        {'command': 'stop-vm', 'options': {'vm-id': 'abc'}},
+        response_expected=True)
+
+    assert time.monotonic() - start < 1
+    # the responses of other hosts arrived in the same batch
+    assert len(responses) == 3
+
+
+def test_vm_command_waits_for_slow_owning_host():
+    # all other hosts answer immediately that they do not run the VM
+    comm, connection = communication(
+        lambda data: [error('VM does not exist')] * 19,
+        timeout=5, settle_time=0.1)
+
+    request = comm.send({'command': 'delete-vm', 'options': {'vm-id': 'abc'}})
+    properties = connection.published[0][1]
+
+    def reply():
+        connection._consumer(
+            connection, None, properties,
+            json.dumps(success({'status': 'deleted', 'vm-id': 'abc'})))
+
+    # the host of the VM answers after the settle time
+    threading.Timer(
+        0.3, connection.add_callback_threadsafe, args=(reply,)).start()
+
+    start = time.monotonic()
+    comm.wait([request])
+
+    assert 0.3 <= time.monotonic() - start < 1
+    assert len(request.responses) == 20
+    assert request.responses[-1]['response']['status'] == 'deleted'
+
+
+def test_unknown_vm_waits_for_timeout():
+    comm, _ = communication(
+        lambda data: [error('VM does not exist')] * 3,
+        timeout=0.3, settle_time=0.05)
+
+    start = time.monotonic()
+    responses = comm.send_msg(
+        {'command': 'start-vm', 'options': {'vm-id': 'abc'}}, True)
+
+    assert time.monotonic() - start >= 0.3
+    assert len(responses) == 3
+
+
+def test_list_vms_settles_after_last_response():
+    def responder(data):
+        return [success([]), success([{'vm-id': 'abc'}])]
+
+    comm, _ = communication(responder, timeout=5, settle_time=0.05)
+
+    start = time.monotonic()
+    responses = comm.send_msg({'command': 'list-vms'}, response_expected=True)
+
+    assert time.monotonic() - start < 1
+    assert len(responses) == 2
+
+
+def test_expected_replies():
+    def responder(data):
+        return [success([]), success([])]
+
+    comm, _ = communication(responder, timeout=5, settle_time=5)
+
+    start = time.monotonic()
+    responses = comm.send_msg(
+        {'command': 'list-vms'}, response_expected=True, expected_replies=2)
+
+    assert time.monotonic() - start < 1
+    assert len(responses) == 2
+
+
+def test_timeout_without_responses():
+    comm, _ = communication(lambda data: [], timeout=0.1)
+
+    start = time.monotonic()
+    assert comm.send_msg({'command': 'list-vms'}, True) == []
+    assert 0.1 <= time.monotonic() - start < 1
+
+
+def test_no_response_expected():
+    comm, connection = communication(lambda data: [])
+
+    assert comm.send_msg({'command': 'delete-vm'}) == []
+    assert connection.published[0][1].reply_to is None
+
+
+def test_pipelined_requests_are_kept_apart():
+    def responder(data):
+        vm_id = data['options']['vm-id']
+        return [success({'status': 'deleted', 'vm-id': vm_id})]
+
+    comm, connection = communication(responder, timeout=5)
+
+    responses = comm.send_many([
+        {'command': 'delete-vm', 'options': {'vm-id': 'first'}},
+        {'command': 'delete-vm', 'options': {'vm-id': 'second'}},
+    ])
+
+    assert [r[0]['response']['vm-id'] for r in responses] == \
+        ['first', 'second']
+    correlation_ids = set(p.correlation_id for _, p in connection.published)
+    assert len(correlation_ids) == 2
+
+
+def test_late_responses_are_dropped():
+    comm, _ = communication(lambda data: [])
+
+    properties = mock.Mock(correlation_id='unknown')
+    comm.on_response(None, None, properties, json.dumps(success([])))
+
+    assert len(comm.pending) == 0
+
+
+@pytest.mark.parametrize('command,message,final', [
+    ('list-vms', success([]), True),
+    ('create-vm', success({'status': 'allocating'}), False),
+    ('create-vm', success({'status': 'starting'}), True),
+    ('create-vms', success({'status': 'starting'}), False),
+    ('create-vms', success({'status': 'finished'}), True),
+    ('stop-vm', success({'status': 'stopped'}), True),
+    ('stop-vm', error('VM does not exist'), False),
+    ('stop-vm', error('VM ID not specified'), True),
+    ('create-vm', error('Image not specified'), True),
+])
+def test_is_final_response(command, message, final):
+    assert client.is_final_response(command, message) == final
+
+
+def test_async_client():
+    def responder(data):
+        if data['command'] == 'list-vms':
+            return [success([{'vm-id': 'abc'}])]
+        else:
+            return [success({'status': 'starting', 'vm-id': 'abc'})]
+
+    connection = FakeConnection(responder)
+
+    async def run():
+        async with client.AsyncServerCommunication(
+                timeout=5, settle_time=0.05) as comm:
+            return await asyncio.gather(
+                comm.send_msg({'command': 'list-vms'}),
+                comm.send_msg({'command': 'start-vm',
+                               'options': {'vm-id': 'abc'}}))
+
+    with mock.patch.object(
+            client.pika, 'BlockingConnection', return_value=connection):
+        vms, started = asyncio.run(run())
+
+    assert vms[0]['response'] == [{'vm-id': 'abc'}]
+    assert started[0]['response']['status'] == 'starting'
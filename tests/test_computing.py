@@ -3,12 +3,14 @@ import os
 from pathlib import Path
 import pytest
 import subprocess
+import time
 from typing import Iterator
 from unittest import mock
 import uuid
 
 from aetherscale import computing
-from aetherscale.services import ServiceManager
+from aetherscale.operations import Operation
+from aetherscale.services import ServiceManager, ServiceException
 
 
 @contextmanager
@@ -97,3 +99,410 @@ def test_run_missing_base_image(tmppath, mock_service_manager: ServiceManager):
 def test_vm_id_systemd_unit():
     assert 'myvmid' == computing.vm_id_from_systemd_unit(
         computing.systemd_unit_name_for_vm('myvmid'))
+
+
+def test_list_vms_does_not_wait_for_hung_guest_agents(mock_service_manager):
+    def fetch_ips(vm_id, pool=None):
+        if vm_id == 'hungvm':
+            time.sleep(2)
+        return ['10.0.0.1']
+
+    with mock.patch('aetherscale.config.QGA_LIST_DEADLINE', 0.2), \
+            mock.patch('aetherscale.computing.fetch_guest_ip_addresses',
+                       side_effect=fetch_ips):
+        handler = computing.ComputingHandler(
+            radvd=mock.MagicMock(), service_manager=mock_service_manager)
+
+        start = time.monotonic()
+        infos = handler._fetch_ip_addresses(['fastvm', 'hungvm'])
+        assert time.monotonic() - start < 1
+
+        assert infos['fastvm']['ip-addresses'] == ['10.0.0.1']
+        assert 'hint' not in infos['fastvm']
+        assert infos['hungvm']['ip-addresses'] == []
+        assert 'hint' in infos['hungvm']
+
+
+def test_inventory_is_loaded_on_startup(mock_service_manager):
+    mock_service_manager.install_service(
+        Path('unused'), computing.systemd_unit_name_for_vm('existingvm'))
+    mock_service_manager.install_service(Path('unused'), 'other.service')
+
+    handler = computing.ComputingHandler(
+        radvd=mock.MagicMock(), service_manager=mock_service_manager)
+
+    assert list(handler.inventory.keys()) == ['existingvm']
+
+    with mock.patch.object(mock_service_manager, 'service_is_running') \
+            as service_is_running:
+        vm_info = list(handler.vm_info({'vm-id': 'existingvm'}))[0]
+        list_results = list(handler.list_vms({}))[0]
+
+        # reading VM state must not ask the service manager
+        service_is_running.assert_not_called()
+
+    assert vm_info['status'] == 'stopped'
+    assert list_results == [{'vm-id': 'existingvm'}]
+
+    with pytest.raises(RuntimeError):
+        list(handler.vm_info({'vm-id': 'missingvm'}))
+
+
+def test_inventory_is_updated_on_process_exit(mock_service_manager):
+    mock_service_manager.install_service(
+        Path('unused'), computing.systemd_unit_name_for_vm('existingvm'))
+    handler = computing.ComputingHandler(
+        radvd=mock.MagicMock(), service_manager=mock_service_manager)
+    handler.inventory['existingvm'].status = 'running'
+
+    handler._on_qemu_close('existingvm')
+
+    vm_info = list(handler.vm_info({'vm-id': 'existingvm'}))[0]
+    assert vm_info['status'] == 'stopped'
+
+
+def wait_until(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_unwatched_vm_falls_back_to_service_manager(mock_service_manager):
+    # units from before QEMU events were used have no events socket
+    vm_ids = [f'noevents{uuid.uuid4().hex[:8]}' for _ in range(2)]
+    unit_names = [computing.systemd_unit_name_for_vm(vm) for vm in vm_ids]
+    for unit_name in unit_names:
+        mock_service_manager.install_service(Path('unused'), unit_name)
+
+    handler = computing.ComputingHandler(
+        radvd=mock.MagicMock(), service_manager=mock_service_manager,
+        watch_qemu_events=True)
+    handler.qemu_connections = mock.MagicMock()
+    handler.qemu_events.connect_timeout = 0.1
+    vm_id = vm_ids[0]
+
+    try:
+        for vm in vm_ids:
+            list(handler.start_vm({'vm-id': vm}))
+        wait_until(lambda: all(
+            handler.inventory[vm].stale for vm in vm_ids))
+
+        with mock.patch.object(
+                mock_service_manager, 'running_services',
+                wraps=mock_service_manager.running_services) \
+                as running_services:
+            list(handler.list_vms({}))
+
+        # all stale VMs are checked at once
+        running_services.assert_called_once()
+        assert handler.inventory[vm_id].status == 'running'
+
+        list(handler.stop_vm({'vm-id': vm_id}))
+        assert handler.inventory[vm_id].status == 'stopping'
+        # the VM process exits after the graceful shutdown
+        mock_service_manager.stop_service(unit_names[0])
+
+        assert list(handler.vm_info({'vm-id': vm_id}))[0]['status'] \
+            == 'stopped'
+        response = list(handler.start_vm({'vm-id': vm_id}))[0]
+        assert 'hint' not in response
+        wait_until(lambda: handler.inventory[vm_id].stale)
+
+        # the VM process exits without a shutdown through aetherscale
+        mock_service_manager.stop_service(unit_names[0])
+        assert list(handler.vm_info({'vm-id': vm_id}))[0]['status'] \
+            == 'stopped'
+    finally:
+        handler.qemu_events.stop()
+
+
+def test_running_vm_status_is_not_checked(mock_service_manager):
+    mock_service_manager.install_service(
+        Path('unused'), computing.systemd_unit_name_for_vm('existingvm'))
+    handler = computing.ComputingHandler(
+        radvd=mock.MagicMock(), service_manager=mock_service_manager)
+    handler.inventory['existingvm'].status = 'running'
+
+    with mock.patch.object(mock_service_manager, 'running_services') \
+            as running_services:
+        list(handler.list_vms({}))
+        list(handler.vm_info({'vm-id': 'existingvm'}))
+
+    running_services.assert_not_called()
+
+
+def test_unknown_service_state_keeps_status(mock_service_manager):
+    mock_service_manager.install_service(
+        Path('unused'), computing.systemd_unit_name_for_vm('slowvm'))
+    handler = computing.ComputingHandler(
+        radvd=mock.MagicMock(), service_manager=mock_service_manager)
+    handler.inventory['slowvm'].status = 'stopping'
+
+    with mock.patch.object(
+            mock_service_manager, 'service_is_running',
+            side_effect=ServiceException('timed out')):
+        vm_info = list(handler.vm_info({'vm-id': 'slowvm'}))[0]
+
+    assert vm_info['status'] == 'stopping'
+
+
+def test_cloud_init_does_not_mount_image(tmppath, mock_service_manager):
+    with mock.patch('aetherscale.config.BASE_IMAGE_FOLDER', tmppath), \
+            mock.patch('aetherscale.config.USER_IMAGE_FOLDER', tmppath), \
+            mock.patch('aetherscale.qemu.image.guestmount') as guestmount:
+
+        handler = computing.ComputingHandler(
+            radvd=mock.MagicMock(), service_manager=mock_service_manager)
+
+        with base_image(tmppath) as img:
+            results = list(handler.create_vm({
+                'image': img.stem,
+                'init-script': '#!/bin/sh\necho hello',
+                'init-method': 'cloud-init',
+            }))
+            vm_id = results[0]['vm-id']
+
+            guestmount.assert_not_called()
+            assert (computing.seed_directory_path(vm_id) / 'user-data') \
+                .is_file()
+
+            list(handler.delete_vm({'vm-id': vm_id}))
+
+
+def test_public_ip_uses_pooled_tap_device(tmppath, mock_service_manager):
+    tap_pool = mock.MagicMock()
+    tap_pool.acquire.return_value = 'aetap-unittest'
+    (tmppath / 'vpn').mkdir()
+
+    with mock.patch('aetherscale.config.BASE_IMAGE_FOLDER', tmppath), \
+            mock.patch('aetherscale.config.USER_IMAGE_FOLDER', tmppath), \
+            mock.patch('aetherscale.config.AETHERSCALE_CONFIG_DIR', tmppath):
+        handler = computing.ComputingHandler(
+            radvd=mock.MagicMock(), service_manager=mock_service_manager,
+            tap_pool=tap_pool)
+
+        with base_image(tmppath) as img:
+            results = list(handler.create_vm(
+                {'image': img.stem, 'public-ip': True}))
+            vm_id = results[-1]['vm-id']
+
+            # pooled devices must survive a restart of the VM
+            resource_folder = tmppath / 'vm' / vm_id
+            assert (resource_folder / 'aetap-unittest-setup.sh').is_file()
+            assert not (resource_folder / 'aetap-unittest-teardown.sh').exists()
+
+            list(handler.delete_vm({'vm-id': vm_id}))
+
+    tap_pool.acquire.assert_called_once_with('br0')
+    tap_pool.release.assert_called_once_with('aetap-unittest')
+
+
+def test_failed_creation_is_discarded(tmppath, mock_service_manager):
+    tap_pool = mock.MagicMock()
+    tap_pool.acquire.return_value = 'aetap-unittest'
+
+    with mock.patch('aetherscale.config.BASE_IMAGE_FOLDER', tmppath), \
+            mock.patch('aetherscale.config.USER_IMAGE_FOLDER', tmppath), \
+            mock.patch('aetherscale.config.AETHERSCALE_CONFIG_DIR', tmppath):
+        handler = computing.ComputingHandler(
+            radvd=mock.MagicMock(), service_manager=mock_service_manager,
+            tap_pool=tap_pool)
+
+        with base_image(tmppath) as img, \
+                mock.patch('aetherscale.qemu.runtime.QemuStartupConfig',
+                           side_effect=RuntimeError('broken config')):
+            messages = handler.create_vm(
+                {'image': img.stem, 'public-ip': True})
+            vm_id = next(messages)['vm-id']
+
+            with pytest.raises(RuntimeError):
+                list(messages)
+
+            assert not computing.user_image_path(vm_id).exists()
+            assert not (tmppath / 'vm' / vm_id).exists()
+
+    tap_pool.release.assert_called_once_with('aetap-unittest')
+
+
+def test_create_vm_reports_progress(tmppath, mock_service_manager):
+    with mock.patch('aetherscale.config.BASE_IMAGE_FOLDER', tmppath), \
+            mock.patch('aetherscale.config.USER_IMAGE_FOLDER', tmppath):
+
+        handler = computing.ComputingHandler(
+            radvd=mock.MagicMock(), service_manager=mock_service_manager)
+
+        with base_image(tmppath) as img:
+            results = list(handler.create_vm(
+                {'image': img.stem, 'report-progress': True}))
+            vm_id = results[0]['vm-id']
+
+            progress = [r for r in results if r['status'] == 'progress']
+            phases = [r['phase'] for r in progress]
+            assert phases == ['image', 'unit-install', 'start']
+            assert all(r['duration'] >= 0 for r in progress)
+
+            assert results[-1]['status'] == 'starting'
+            assert set(results[-1]['phases'].keys()) == set(phases)
+
+            list(handler.delete_vm({'vm-id': vm_id}))
+
+
+def test_vpns_are_reloaded_when_folder_changes(tmppath, mock_service_manager):
+    with mock.patch('aetherscale.config.AETHERSCALE_CONFIG_DIR', tmppath):
+        handler = computing.ComputingHandler(
+            radvd=mock.MagicMock(), service_manager=mock_service_manager)
+
+        # no VPN folder exists before the first VPN is created
+        assert list(handler.list_vpns({})) == [[]]
+
+        tinc_folder = tmppath / 'vpn' / 'myvpn' / 'tinc'
+        tinc_folder.mkdir(parents=True)
+        with open(tinc_folder / 'tinc.conf', 'w') as f:
+            f.write('Name = myhost\nPort = 50123\n')
+
+        with mock.patch.object(
+                handler, '_load_existing_vpns',
+                wraps=handler._load_existing_vpns) as load:
+            assert list(handler.list_vpns({})) == [['myvpn']]
+            assert list(handler.vpn_info({'vpn-name': 'myvpn'}))
+            load.assert_called_once()
+
+
+def test_interrupted_creation_is_discarded(tmppath, mock_service_manager):
+    tap_pool = mock.MagicMock()
+    tap_pool.acquire.return_value = 'aetap-unittest'
+    (tmppath / 'vpn').mkdir()
+
+    with mock.patch('aetherscale.config.BASE_IMAGE_FOLDER', tmppath), \
+            mock.patch('aetherscale.config.USER_IMAGE_FOLDER', tmppath), \
+            mock.patch('aetherscale.config.AETHERSCALE_CONFIG_DIR', tmppath):
+        handler = computing.ComputingHandler(
+            radvd=mock.MagicMock(), service_manager=mock_service_manager,
+            tap_pool=tap_pool)
+
+        with base_image(tmppath) as img:
+            # stop after the unit was installed, before the VM was started
+            results = handler.create_vm({'image': img.stem, 'public-ip': True})
+            messages = [next(results)]
+            with mock.patch.object(mock_service_manager, 'start_service',
+                                   side_effect=KeyboardInterrupt):
+                with pytest.raises(KeyboardInterrupt):
+                    list(results)
+
+            vm_id = messages[0]['vm-id']
+            unit_name = computing.systemd_unit_name_for_vm(vm_id)
+            assert mock_service_manager.service_exists(unit_name)
+
+            restarted = computing.ComputingHandler(
+                radvd=mock.MagicMock(), service_manager=mock_service_manager,
+                tap_pool=tap_pool)
+            operation = Operation(
+                operation_id='op', command='create-vm',
+                options={'image': img.stem}, status='running',
+                messages=messages)
+
+            assert not restarted.recover_operation(operation)
+
+    assert not mock_service_manager.service_exists(unit_name)
+    assert not (tmppath / f'{vm_id}.qcow2').exists()
+    assert not (tmppath / 'vm' / vm_id).exists()
+    assert not restarted.has_vm(vm_id)
+    tap_pool.release.assert_called_once_with('aetap-unittest')
+
+
+def test_started_vm_is_kept_on_recovery(mock_service_manager):
+    handler = computing.ComputingHandler(
+        radvd=mock.MagicMock(), service_manager=mock_service_manager)
+    operation = Operation(
+        operation_id='op', command='create-vm', status='running',
+        messages=[
+            {'status': 'allocating', 'vm-id': 'abc'},
+            {'status': 'starting', 'vm-id': 'abc'},
+        ])
+
+    with mock.patch.object(handler, 'discard_vm') as discard_vm:
+        assert handler.recover_operation(operation)
+
+    discard_vm.assert_not_called()
+
+
+def test_create_vms_installs_units_once(tmppath, mock_service_manager):
+    with mock.patch('aetherscale.config.BASE_IMAGE_FOLDER', tmppath), \
+            mock.patch('aetherscale.config.USER_IMAGE_FOLDER', tmppath):
+        handler = computing.ComputingHandler(
+            radvd=mock.MagicMock(), service_manager=mock_service_manager)
+
+        with base_image(tmppath) as img, \
+                mock.patch.object(
+                    mock_service_manager, 'install_services',
+                    wraps=mock_service_manager.install_services) as install:
+            results = list(handler.create_vms({
+                'image': img.stem,
+                'vms': [{}, {}, {'image': 'some-missing-image'}],
+            }))
+
+            summary = results[-1]
+            assert summary['status'] == 'finished'
+            assert len(summary['vm-ids']) == 2
+            assert len(summary['failed']) == 1
+            install.assert_called_once()
+
+            started = [r for r in results if r['status'] == 'starting']
+            assert set(r['vm-id'] for r in started) == set(summary['vm-ids'])
+            assert all('image' in r['phases'] for r in started)
+
+            for vm_id in summary['vm-ids']:
+                unit_name = computing.systemd_unit_name_for_vm(vm_id)
+                assert mock_service_manager.service_is_running(unit_name)
+                assert handler.has_vm(vm_id)
+
+            failed_vm, = summary['failed']
+            assert not handler.has_vm(failed_vm)
+            assert not mock_service_manager.service_exists(
+                computing.systemd_unit_name_for_vm(failed_vm))
+
+            for vm_id in summary['vm-ids']:
+                list(handler.delete_vm({'vm-id': vm_id}))
+
+
+@pytest.mark.parametrize('options', [
+    {'image': 'ubuntu'},
+    {'image': 'ubuntu', 'count': 0},
+    {'image': 'ubuntu', 'count': 'many'},
+    {'count': 2},
+    {'vms': 'ubuntu'},
+])
+def test_invalid_batch_specs(options):
+    with pytest.raises(ValueError):
+        computing.batch_specs(options)
+
+
+def test_batch_specs_override_shared_options():
+    specs = computing.batch_specs(
+        {'image': 'ubuntu', 'public-ip': True,
+         'vms': [{}, {'image': 'debian'}]})
+
+    assert specs == [
+        {'image': 'ubuntu', 'public-ip': True},
+        {'image': 'debian', 'public-ip': True},
+    ]
+
+
+@pytest.mark.parametrize('cmdline,resources', [
+    (['qemu-system-x86_64', '-m', '2048', '-smp', '2'],
+     {'memory': 2048, 'vcpus': 2}),
+    (['qemu-system-x86_64', '-m', '4G', '-smp', 'cpus=4,sockets=1'],
+     {'memory': 4096, 'vcpus': 4}),
+    (['qemu-system-x86_64', '-nographic'], {}),
+    (None, {}),
+])
+def test_qemu_resources(cmdline, resources):
+    assert computing.qemu_resources(cmdline) == resources
+
+
+def test_vm_resources():
+    assert computing.vm_resources({'memory': '2048', 'vcpus': 2}) == (2048, 2)
+
+    with pytest.raises(ValueError):
+        computing.vm_resources({'memory': 0})
@@ -0,0 +1,35 @@
+import threading
+import time
+
+from aetherscale.concurrency import KeyedExecutor
+
+
+def test_same_key_runs_in_order():
+    executor = KeyedExecutor(max_workers=4)
+    results = []
+
+    def task(i):
+        def run():
+            # later tasks would finish first if they ran in parallel
+            time.sleep(0.01 * (5 - i))
+            results.append(i)
+        return run
+
+    for i in range(5):
+        executor.submit('vm-a', task(i))
+
+    executor.shutdown()
+    assert results == [0, 1, 2, 3, 4]
+
+
+def test_different_keys_run_in_parallel():
+    executor = KeyedExecutor(max_workers=2)
+    barrier = threading.Barrier(2, timeout=1)
+
+    # both tasks only finish if they are executed at the same time
+    executor.submit('vm-a', barrier.wait)
+    executor.submit('vm-b', barrier.wait)
+
+    executor.shutdown()
+    assert not barrier.broken
+    assert executor.in_flight == 0
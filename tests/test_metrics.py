@@ -0,0 +1,58 @@
+import urllib.request
+
+from aetherscale import metrics
+
+
+def test_counter_and_gauge_exposition():
+    registry = metrics.Registry()
+    requests = registry.register(
+        metrics.Counter('unittest_requests', 'Requests', ['method']))
+    vms = registry.register(
+        metrics.Gauge('unittest_vms', 'VMs', ['state']))
+
+    requests.inc(method='get')
+    requests.inc(2, method='get')
+    vms.set_function(lambda: {('running',): 3})
+
+    text = registry.expose()
+    assert '# TYPE unittest_requests counter' in text
+    assert 'unittest_requests_total{method="get"} 3' in text
+    assert 'unittest_vms{state="running"} 3' in text
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = metrics.Histogram(
+        'unittest_duration_seconds', 'Duration', buckets=[0.1, 1])
+
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(5)
+
+    lines = histogram.expose()
+    assert 'unittest_duration_seconds_bucket{le="0.1"} 1' in lines
+    assert 'unittest_duration_seconds_bucket{le="1"} 2' in lines
+    assert 'unittest_duration_seconds_bucket{le="+Inf"} 3' in lines
+    assert 'unittest_duration_seconds_count 3' in lines
+    assert 'unittest_duration_seconds_sum 5.55' in lines
+
+
+def test_label_values_are_escaped():
+    counter = metrics.Counter('unittest_escaped', 'Escaped', ['path'])
+    counter.inc(path='a"b\\c')
+
+    assert 'unittest_escaped_total{path="a\\"b\\\\c"} 1' in counter.expose()
+
+
+def test_metrics_http_server():
+    registry = metrics.Registry()
+    registry.register(metrics.Gauge('unittest_up', 'Up')).set(1)
+
+    server = metrics.start_http_server(0, host='127.0.0.1', registry=registry)
+    try:
+        port = server.server_address[1]
+        with urllib.request.urlopen(f'http://127.0.0.1:{port}/metrics') as r:
+            assert r.headers['Content-Type'] == metrics.CONTENT_TYPE
+            assert 'unittest_up 1' in r.read().decode('utf-8')
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -1,6 +1,10 @@
+import errno
+import socket
+import time
 from unittest import mock
 import pytest
 
+from aetherscale import netlink
 from aetherscale import networking
 
 
@@ -47,12 +51,29 @@ def test_iproute2_networking_scripts():
 
     assert 'link add unittestbr0 type bridge' in setup_script
     assert 'set eth0 master unittestbr0' in setup_script
-    assert 'addr add 10.0.0.2/24 dev unittestbr0' in setup_script
+    assert 'addr replace 10.0.0.2/24 dev unittestbr0' in setup_script
     assert 'tuntap add dev tap0' in setup_script
 
     assert 'link del unittestbr0' in teardown_script
     assert 'link del tap0' in teardown_script
-    assert 'addr add 10.0.0.2/24 dev eth0' in teardown_script
+    assert 'addr replace 10.0.0.2/24 dev eth0' in teardown_script
+
+
+def test_iproute2_scripts_run_single_ip_batch():
+    iproute = networking.Iproute2Network()
+    iproute.tap_device('unittesttap0', 'myuser', 'unittestbr0')
+    setup_script = iproute.setup_script()
+    teardown_script = iproute.teardown_script()
+
+    for script in [setup_script, teardown_script]:
+        assert script.count('sudo') == 1
+        assert 'ip -force -batch -' in script
+
+    # devices are only created or deleted depending on their existence
+    assert '[ -e /sys/class/net/unittesttap0 ] || ' \
+        "echo 'tuntap add dev unittesttap0" in setup_script
+    assert '[ ! -e /sys/class/net/unittesttap0 ] || ' \
+        "echo 'link del unittesttap0'" in teardown_script
 
 
 @mock.patch('aetherscale.execution.run_command_chain')
@@ -64,3 +85,164 @@ def test_iproute2_networking_direct_execution(command_chain):
 
     bridge_command = ['sudo', 'ip', 'link', 'add', 'unittestbr0', 'type', 'bridge']
     assert bridge_command in command_chain.call_args[0][0]
+
+
+class FakeRtnlSocket:
+    def __init__(self, links):
+        self.existing_links = links
+        self.queued = []
+        self.commits = 0
+        self.sock = mock.MagicMock()
+        # raised by link_changes() one after another
+        self.errors = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    def links(self):
+        return dict(self.existing_links)
+
+    def link_changes(self):
+        if self.errors:
+            raise self.errors.pop(0)
+
+        time.sleep(0.01)
+        raise socket.timeout
+
+    def addresses(self, index):
+        return []
+
+    def queue(self, message):
+        self.queued.append(message)
+
+    def commit(self):
+        self.commits += 1
+
+
+def test_netlink_link_table():
+    with netlink.RtnlSocket() as rtnl:
+        assert 'lo' in rtnl.links()
+
+
+def test_netlink_networking_batches_requests():
+    links = {'lo': 1, 'eth0': 2, 'unittestbr0': 3}
+    rtnl = FakeRtnlSocket(links)
+
+    with mock.patch('aetherscale.netlink.RtnlSocket', return_value=rtnl), \
+            mock.patch.object(networking.link_index, 'exists',
+                              side_effect=links.__contains__):
+        network = networking.NetlinkNetwork()
+        network.bridged_network(
+            'unittestbr0', 'eth0', '10.0.0.2/24', '10.0.0.1')
+
+        # existing bridge is not re-created
+        assert ['sudo', 'ip', 'link', 'add', 'unittestbr0', 'type', 'bridge'] \
+            not in network.creation_commands
+        # scripts for systemd units are still available
+        assert 'addr replace 10.0.0.2/24 dev unittestbr0' \
+            in network.setup_script()
+
+        assert network.setup()
+
+    message_types = [message.msg_type for message in rtnl.queued]
+    assert message_types == [
+        netlink.RTM_NEWLINK, netlink.RTM_NEWLINK,
+        netlink.RTM_NEWADDR, netlink.RTM_NEWROUTE,
+    ]
+    # each address flush applies the preceding requests, the rest is sent
+    # in a final batch
+    assert rtnl.commits == 3
+
+
+def test_netlink_networking_rejects_unknown_device():
+    rtnl = FakeRtnlSocket({'lo': 1})
+
+    with mock.patch('aetherscale.netlink.RtnlSocket', return_value=rtnl):
+        network = networking.NetlinkNetwork()
+        network.creation_commands.append(
+            ['sudo', 'ip', 'addr', 'add', '10.0.0.2/24', 'dev', 'missing0'])
+
+        assert not network.setup()
+
+
+def test_netlink_attributes_roundtrip():
+    data = netlink.pack_attr(netlink.IFLA_IFNAME, b'br0\0') \
+        + netlink.pack_attr(netlink.IFLA_MASTER, b'\x02\0\0\0')
+
+    attrs = netlink.unpack_attrs(data)
+    assert attrs[netlink.IFLA_IFNAME] == b'br0\0'
+    assert attrs[netlink.IFLA_MASTER] == b'\x02\0\0\0'
+
+
+def test_link_index_without_monitor(tmppath):
+    index = networking.LinkIndex(tmppath)
+    assert not index.exists('tap0')
+
+    (tmppath / 'tap0').mkdir()
+    assert index.exists('tap0')
+
+
+def test_link_index_follows_notifications():
+    index = networking.LinkIndex()
+    index.start_monitor()
+
+    try:
+        assert index.exists('lo')
+        assert not index.exists('unittesttap0')
+
+        # only the cached table can answer this
+        index._apply_changes([(netlink.RTM_NEWLINK, 'unittesttap0')])
+        assert index.exists('unittesttap0')
+
+        index._apply_changes([(netlink.RTM_DELLINK, 'unittesttap0')])
+        assert not index.exists('unittesttap0')
+    finally:
+        index.stop_monitor()
+
+
+def test_link_index_falls_back_when_monitor_fails(tmppath):
+    rtnl = FakeRtnlSocket({})
+    rtnl.errors = [
+        OSError(errno.ENOBUFS, 'No buffer space available'),
+        OSError(errno.EBADF, 'Bad file descriptor'),
+    ]
+    index = networking.LinkIndex(tmppath)
+
+    with mock.patch('aetherscale.netlink.RtnlSocket', return_value=rtnl):
+        index.start_monitor()
+
+    for _ in range(100):
+        if index._monitor is None:
+            break
+        time.sleep(0.01)
+    assert index._monitor is None
+
+    # changes are seen although no notification arrives anymore
+    (tmppath / 'tap0').mkdir()
+    assert index.exists('tap0')
+
+
+def test_tap_pool_hands_out_spare_devices(tmppath):
+    (tmppath / 'br0').mkdir()
+    for device in ['aetap-aaaaaaaa', 'aetap-bbbbbbbb', 'pub-vmid']:
+        (tmppath / device).mkdir()
+        (tmppath / device / 'master').symlink_to('../br0')
+
+    pool = networking.TapPool(2, 'myuser', sysfs_path=tmppath)
+    pool.reserve(['aetap-aaaaaaaa'])
+
+    with mock.patch.object(pool, 'refill') as refill, \
+            mock.patch('aetherscale.networking.delete_device') as delete:
+        assert pool.acquire('br0') == 'aetap-bbbbbbbb'
+        assert pool.acquire('br0') is None
+        refill.assert_called_with('br0')
+
+        # returned devices are kept as long as the pool is not full
+        pool.release('aetap-bbbbbbbb')
+        delete.assert_not_called()
+        assert pool.acquire('br0') == 'aetap-bbbbbbbb'
+
+    pool.shutdown()
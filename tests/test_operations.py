@@ -0,0 +1,130 @@
+import threading
+
+from aetherscale.operations import \
+    OperationManager, OperationStore, INTERRUPTED_ERROR
+
+
+def test_operation_succeeds():
+    manager = OperationManager(workers=2)
+
+    operation = manager.submit(
+        'create-vm', {}, iter([{'step': 1}, {'step': 2}]))
+    assert not operation.done
+
+    operation = manager.wait(operation.operation_id, timeout=5)
+    assert operation.status == 'succeeded'
+    assert operation.to_dict()['result'] == {'step': 2}
+    assert operation.finished is not None
+
+    manager.shutdown()
+
+
+def test_operation_fails():
+    def failing():
+        yield {'status': 'allocating'}
+        raise ValueError('Image not specified')
+
+    manager = OperationManager(workers=1)
+
+    operation = manager.submit('create-vm', {}, failing())
+    operation = manager.wait(operation.operation_id, timeout=5)
+
+    assert operation.status == 'failed'
+    assert operation.error == 'Image not specified'
+    assert operation.messages == [{'status': 'allocating'}]
+
+    manager.shutdown()
+
+
+def test_wait_returns_after_timeout():
+    started = threading.Event()
+    release = threading.Event()
+
+    def blocking():
+        started.set()
+        release.wait()
+        yield {}
+
+    manager = OperationManager(workers=1)
+    running = manager.submit('create-vm', {}, blocking())
+    # waits for the only worker
+    queued = manager.submit('create-vm', {}, iter([{}]))
+
+    assert started.wait(timeout=5)
+    assert manager.wait(running.operation_id, timeout=0.05).status == \
+        'running'
+    assert manager.get(queued.operation_id).status == 'queued'
+
+    release.set()
+    assert manager.wait(queued.operation_id, timeout=5).status == \
+        'succeeded'
+
+    manager.shutdown()
+
+
+def test_only_recent_operations_are_kept():
+    manager = OperationManager(workers=1, history=2)
+
+    ids = [
+        manager.submit('list-vms', {}, iter([])).operation_id
+        for _ in range(3)
+    ]
+    for operation_id in ids[1:]:
+        manager.wait(operation_id, timeout=5)
+
+    manager.shutdown()
+
+    operation_ids = set()
+    for operation_id in ids:
+        try:
+            manager.get(operation_id)
+            operation_ids.add(operation_id)
+        except KeyError:
+            pass
+
+    assert operation_ids == set(ids[1:])
+
+
+def test_operations_survive_restart(tmp_path):
+    db = str(tmp_path / 'operations.sqlite')
+
+    manager = OperationManager(workers=1, store=OperationStore(db))
+    finished = manager.submit('delete-vm', {'vm-id': 'abc'}, iter([{}]))
+    manager.wait(finished.operation_id, timeout=5)
+
+    # an operation that was running when the daemon stopped
+    results = manager.execute(
+        manager.create('create-vm', {'image': 'ubuntu'}),
+        iter([{'status': 'allocating', 'vm-id': 'abc'}, {}]))
+    interrupted = next(results)
+    interrupted_id = manager.recent(1)[0].operation_id
+    manager.shutdown()
+
+    recovered = []
+    restarted = OperationManager(workers=1, store=OperationStore(db))
+    restarted.recover(lambda operation: recovered.append(operation))
+
+    assert interrupted == {'status': 'allocating', 'vm-id': 'abc'}
+    assert [operation.operation_id for operation in recovered] == \
+        [interrupted_id]
+    assert recovered[0].options == {'image': 'ubuntu'}
+    assert recovered[0].messages == [interrupted]
+
+    operation = restarted.get(interrupted_id)
+    assert operation.status == 'failed'
+    assert operation.error == INTERRUPTED_ERROR
+    assert restarted.get(finished.operation_id).status == 'succeeded'
+
+    restarted.shutdown()
+
+
+def test_recovery_only_of_own_source(tmp_path):
+    db = str(tmp_path / 'operations.sqlite')
+
+    broker = OperationManager(1, OperationStore(db, source='broker'))
+    operation = broker.create('create-vm', {})
+
+    rest = OperationManager(1, OperationStore(db, source='rest'))
+    rest.recover(lambda operation: True)
+
+    assert rest.get(operation.operation_id).status == 'queued'
@@ -1,3 +1,4 @@
+import asyncio
 import contextlib
 import json
 from pathlib import Path
@@ -5,9 +6,12 @@ import pytest
 import socket
 import tempfile
 import threading
+import time
 import uuid
 
-from aetherscale.qemu.runtime import QemuMonitor, QemuProtocol
+from aetherscale.qemu.runtime import \
+    QemuMonitor, QemuProtocol, QemuConnectionPool, AsyncQemuMonitor, \
+    QemuEventListener
 
 
 class MockQemuServer:
@@ -21,18 +25,33 @@ class MockQemuServer:
         self._socket_file = socket_file
         self.received_executes = []
         self.protocol = protocol
+        self.events_before_response = []
+        self._conn = None
 
     def __enter__(self):
         self._sock.bind(self._socket_file)
+        self._sock.listen()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self._sock.close()
 
     def listen(self):
-        self._sock.listen()
+        while True:
+            try:
+                conn, addr = self._sock.accept()
+            except OSError:
+                # listening socket was closed
+                return
+
+            self._conn = conn
+            self._handle_connection(conn)
+
+    def disconnect(self):
+        """Close the current client connection from the server side"""
+        self._conn.shutdown(socket.SHUT_RDWR)
 
-        conn, addr = self._sock.accept()
+    def _handle_connection(self, conn):
         filelike = conn.makefile('rb')
 
         if self.protocol == QemuProtocol.QMP:
@@ -43,10 +62,13 @@ class MockQemuServer:
                 msg = self._recv_message(filelike)
                 self.received_executes.append(msg['execute'])
 
+                for event in self.events_before_response:
+                    self._send_message(event, conn)
+
                 # for now always return with OK status
                 response = self._build_response(msg)
                 self._send_message(response, conn)
-        except json.JSONDecodeError:
+        except (json.JSONDecodeError, OSError):
             conn.close()
 
     def _build_response(self, message):
@@ -54,7 +76,11 @@ class MockQemuServer:
             if message['execute'] == 'guest-sync':
                 return {'return': message['arguments']['id']}
 
-        return self.mock_ok_response
+        response = dict(self.mock_ok_response)
+        if 'id' in message:
+            response['id'] = message['id']
+
+        return response
 
     def _send_message(self, message, conn):
         msg_with_newline = json.dumps(message) + '\r\n'
@@ -62,7 +88,8 @@ class MockQemuServer:
 
     def _recv_message(self, filelike):
         line = filelike.readline()
-        return json.loads(line.decode('utf-8'))
+        # guest agent clients send a flush byte before their first message
+        return json.loads(line.lstrip(b'\xff').decode('utf-8'))
 
 
 @contextlib.contextmanager
@@ -93,3 +120,151 @@ def test_timeout(timeout):
         with timeout(1):  # if function does not finish after 1s, error-out
             with pytest.raises(socket.timeout):
                 QemuMonitor(sock_file, QemuProtocol.QMP, timeout=0.1)
+
+
+def test_skips_events_when_waiting_for_response():
+    sock_file = Path(tempfile.gettempdir()) / str(uuid.uuid4())
+
+    with run_mock_qemu_server(str(sock_file), QemuProtocol.QMP) as mock_server:
+        monitor = QemuMonitor(sock_file, QemuProtocol.QMP)
+        mock_server.events_before_response = [{
+            'event': 'POWERDOWN',
+            'timestamp': {'seconds': 1, 'microseconds': 0},
+        }]
+
+        assert monitor.execute('system_powerdown') == {'return': {}}
+
+
+def test_guest_agent_sync():
+    sock_file = Path(tempfile.gettempdir()) / str(uuid.uuid4())
+
+    with run_mock_qemu_server(str(sock_file), QemuProtocol.QGA) as mock_server:
+        QemuMonitor(sock_file, QemuProtocol.QGA, timeout=1)
+        assert mock_server.received_executes == ['guest-sync']
+
+
+def test_pool_reuses_negotiated_connection():
+    sock_file = Path(tempfile.gettempdir()) / str(uuid.uuid4())
+    pool = QemuConnectionPool()
+
+    with run_mock_qemu_server(str(sock_file), QemuProtocol.QMP) as mock_server:
+        pool.execute(sock_file, QemuProtocol.QMP, 'query-status')
+        pool.execute(sock_file, QemuProtocol.QMP, 'query-status')
+
+        assert mock_server.received_executes == \
+            ['qmp_capabilities', 'query-status', 'query-status']
+
+        pool.close_all()
+
+
+def test_pool_reconnects_after_eof():
+    sock_file = Path(tempfile.gettempdir()) / str(uuid.uuid4())
+    pool = QemuConnectionPool()
+
+    with run_mock_qemu_server(str(sock_file), QemuProtocol.QMP) as mock_server:
+        pool.execute(sock_file, QemuProtocol.QMP, 'query-status', timeout=1)
+        mock_server.disconnect()
+
+        result = pool.execute(
+            sock_file, QemuProtocol.QMP, 'query-status', timeout=1)
+
+        assert result == {'return': {}}
+        assert mock_server.received_executes.count('qmp_capabilities') == 2
+
+        pool.close(sock_file)
+
+
+def test_async_client_dispatches_events_and_replies():
+    sock_file = Path(tempfile.gettempdir()) / str(uuid.uuid4())
+    shutdown_event = {
+        'event': 'SHUTDOWN',
+        'data': {'guest': True, 'reason': 'guest-shutdown'},
+        'timestamp': {'seconds': 1, 'microseconds': 0},
+    }
+
+    async def run_client():
+        monitor = AsyncQemuMonitor(sock_file)
+        await monitor.connect()
+
+        events = []
+        monitor.subscribe(events.append)
+
+        reply = await monitor.execute('system_powerdown')
+        await monitor.close()
+
+        return reply, events
+
+    with run_mock_qemu_server(str(sock_file), QemuProtocol.QMP) as mock_server:
+        mock_server.events_before_response = [shutdown_event]
+        reply, events = asyncio.run(run_client())
+
+        assert reply['return'] == {}
+        assert events == [shutdown_event]
+
+
+def test_event_listener_multiplexes_vms():
+    sock_files = {
+        vm_id: Path(tempfile.gettempdir()) / str(uuid.uuid4())
+        for vm_id in ['vma', 'vmb']
+    }
+    received = []
+
+    listener = QemuEventListener(
+        on_event=lambda vm_id, event: received.append((vm_id, event['event'])))
+
+    with run_mock_qemu_server(str(sock_files['vma']), QemuProtocol.QMP) \
+            as server_a, \
+            run_mock_qemu_server(str(sock_files['vmb']), QemuProtocol.QMP) \
+            as server_b:
+        server_a.events_before_response = [{'event': 'STOP'}]
+        server_b.events_before_response = [{'event': 'POWERDOWN'}]
+
+        for vm_id, sock_file in sock_files.items():
+            listener.watch(vm_id, sock_file)
+
+        for vm_id in sock_files.keys():
+            # connection is established asynchronously, wait for it
+            for _ in range(50):
+                try:
+                    listener.execute(vm_id, 'query-status', timeout=1)
+                    break
+                except Exception:
+                    time.sleep(0.02)
+
+        listener.stop()
+
+    assert ('vma', 'STOP') in received
+    assert ('vmb', 'POWERDOWN') in received
+
+
+def test_event_listener_gives_up_on_broken_socket(caplog):
+    sock_file = Path(tempfile.gettempdir()) / str(uuid.uuid4())
+    connections = []
+
+    def serve_garbage(sock):
+        while True:
+            try:
+                conn, _ = sock.accept()
+            except OSError:
+                return
+
+            connections.append(conn)
+            conn.sendall(b'not a QMP greeting\n')
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.bind(str(sock_file))
+        sock.listen()
+        threading.Thread(
+            target=serve_garbage, args=(sock,), daemon=True).start()
+
+        listener = QemuEventListener(
+            on_event=lambda vm_id, event: None, connect_timeout=0.2)
+        listener.watch('vm', sock_file)
+        time.sleep(0.5)
+        listener.stop()
+
+    for conn in connections:
+        conn.close()
+
+    assert len(connections) > 1
+    assert 'Could not connect to event socket of VM "vm"' in caplog.text
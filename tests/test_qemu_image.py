@@ -1,5 +1,9 @@
+import fcntl
 import os
 import pytest
+import struct
+import subprocess
+import threading
 
 from aetherscale.qemu import image
 from aetherscale.qemu.exceptions import QemuException
@@ -24,3 +28,58 @@ def test_mount_invalid_image(tmppath):
     with pytest.raises(QemuException):
         with image.guestmount(imagepath):
             pass
+
+
+def test_overlay_pool_hands_out_prepared_overlays(tmppath):
+    base_image = tmppath / 'base.qcow2'
+    subprocess.run(
+        ['qemu-img', 'create', '-f', 'qcow2', str(base_image), '1G'])
+
+    pool = image.OverlayPool(tmppath, size=2)
+    pool.warm()
+    # wait for the background refill
+    pool.shutdown()
+
+    prepared = list((tmppath / image.OVERLAY_POOL_FOLDER / 'base').iterdir())
+    assert len(prepared) == 2
+
+    user_image = tmppath / 'user.qcow2'
+    assert pool.acquire('base', user_image)
+    assert user_image.is_file()
+    assert user_image not in prepared
+
+    # pool without images for the requested base image
+    assert not pool.acquire('other', tmppath / 'other.qcow2')
+
+
+def test_create_seed_directory(tmppath):
+    seed_dir = tmppath / 'seed'
+    image.create_seed_directory('myvmid', '#!/bin/sh\necho hello', seed_dir)
+
+    with open(seed_dir / 'meta-data') as f:
+        assert 'instance-id: myvmid' in f.read()
+    with open(seed_dir / 'user-data') as f:
+        assert f.read().startswith('#!/bin/sh')
+
+
+def test_wait_for_write_lock(tmppath):
+    imagepath = tmppath / 'image.qcow2'
+    imagepath.touch()
+
+    assert not image.image_is_locked(imagepath)
+    # must return immediately if nobody holds a lock
+    image.wait_for_write_lock(imagepath, timeout=0.1)
+
+    # hold a lock on some bytes like QEMU does
+    fd = os.open(imagepath, os.O_RDWR)
+    lock = struct.pack(
+        image.FLOCK_FORMAT, fcntl.F_RDLCK, os.SEEK_SET, 100, 1, 0)
+    fcntl.fcntl(fd, fcntl.F_OFD_SETLK, lock)
+    assert image.image_is_locked(imagepath)
+
+    with pytest.raises(TimeoutError):
+        image.wait_for_write_lock(imagepath, timeout=0.1)
+
+    # lock gets released while we are waiting
+    threading.Timer(0.1, os.close, args=[fd]).start()
+    image.wait_for_write_lock(imagepath, timeout=2)
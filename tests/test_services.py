@@ -1,8 +1,13 @@
 from pathlib import Path
+import subprocess
 import tempfile
 from unittest import mock
 
-from aetherscale.services import SystemdServiceManager
+import pytest
+
+from aetherscale.services import \
+    SystemdServiceManager, DbusServiceManager, SystemdBus, DbusException, \
+    ServiceException
 
 
 def test_systemd_creates_file(tmppath: Path):
@@ -40,3 +45,121 @@ def test_systemd_calls_system_binary(subprocess_run, tmppath):
         function('test.service')
         assert 'systemctl' in subprocess_run.call_args[0][0]
         assert keyword in subprocess_run.call_args[0][0]
+
+
+@mock.patch('subprocess.run')
+def test_systemd_state_check_timeout(subprocess_run, tmppath):
+    subprocess_run.side_effect = subprocess.TimeoutExpired('systemctl', 1)
+    systemd = SystemdServiceManager(tmppath)
+
+    with pytest.raises(ServiceException):
+        systemd.service_is_running('test.service')
+
+
+@mock.patch('subprocess.run')
+def test_systemd_checks_many_states_with_single_call(subprocess_run, tmppath):
+    subprocess_run.return_value.stdout = 'active\ninactive\nactive\n'
+    systemd = SystemdServiceManager(tmppath)
+
+    running = systemd.running_services(['a.service', 'b.service', 'c.service'])
+
+    assert running == {'a.service', 'c.service'}
+    subprocess_run.assert_called_once()
+
+
+class FakeSystemdBus(SystemdBus):
+    def __init__(self, job_polls: int = 0):
+        self.calls = []
+        self.active_units = set()
+        # number of polls until a job is finished
+        self.job_polls = job_polls
+        self._jobs = {}
+
+    def call(self, path, interface, method, signature='', args=()):
+        self.calls.append(method)
+
+        if method in ('StartUnit', 'StopUnit', 'RestartUnit'):
+            job_path = f'/org/freedesktop/systemd1/job/{len(self.calls)}'
+            self._jobs[job_path] = [self.job_polls, method, args[0]]
+            if self.job_polls == 0:
+                self._finish_job(job_path)
+            return (job_path,)
+        elif method == 'GetUnit':
+            if args[0] not in self.active_units:
+                raise DbusException('NoSuchUnit')
+            return (f'/org/freedesktop/systemd1/unit/{args[0]}',)
+        elif method == 'Get' and path in self._jobs:
+            self._jobs[path][0] -= 1
+            if self._jobs[path][0] <= 0:
+                self._finish_job(path)
+            return (('s', 'running'),)
+        elif method == 'Get' and '/job/' in path:
+            raise DbusException('UnknownObject')
+        elif method == 'Get':
+            return (('s', 'active'),)
+
+        return ()
+
+    def _finish_job(self, job_path):
+        _, method, unit = self._jobs.pop(job_path)
+        if method == 'StopUnit':
+            self.active_units.discard(unit)
+        else:
+            self.active_units.add(unit)
+
+
+@mock.patch('subprocess.run')
+def test_systemd_starts_batch_with_single_call(subprocess_run, tmppath):
+    subprocess_run.return_value.returncode = 0
+    systemd = SystemdServiceManager(tmppath)
+    names = [f'vm-{i}.service' for i in range(3)]
+
+    assert systemd.start_services(names)
+    assert systemd.enable_services(names)
+
+    commands = [call[0][0] for call in subprocess_run.call_args_list]
+    assert len(commands) == 2
+    assert 'start' in commands[0] and 'enable' in commands[1]
+    assert all(set(names).issubset(command) for command in commands)
+
+
+def test_dbus_installs_batch_with_single_reload(tmppath: Path):
+    bus = FakeSystemdBus()
+    systemd = DbusServiceManager(tmppath, bus=bus)
+
+    with tempfile.NamedTemporaryFile('wt') as f:
+        f.write('[Unit]')
+        f.flush()
+
+        services = [(Path(f.name), f'vm-{i}.service') for i in range(10)]
+        assert systemd.install_services(services)
+
+    assert bus.calls == ['Reload']
+    assert systemd.service_exists('vm-3.service')
+
+    bus.calls.clear()
+    systemd.enable_services([name for _, name in services])
+    assert bus.calls == ['EnableUnitFiles', 'Reload']
+
+
+def test_dbus_service_state(tmppath: Path):
+    bus = FakeSystemdBus()
+    systemd = DbusServiceManager(tmppath, bus=bus)
+
+    assert not systemd.service_is_running('test.service')
+    assert systemd.start_service('test.service')
+    assert systemd.service_is_running('test.service')
+
+
+def test_dbus_waits_for_jobs(tmppath: Path):
+    bus = FakeSystemdBus(job_polls=3)
+    systemd = DbusServiceManager(tmppath, bus=bus)
+
+    assert systemd.start_service('test.service')
+    assert systemd.service_is_running('test.service')
+
+    # the unit must be stopped once stop_service returns, e.g. before the
+    # image of a VM is deleted
+    assert systemd.stop_service('test.service')
+    assert not systemd.service_is_running('test.service')
+    assert bus.calls.count('Get') >= 6
@@ -0,0 +1,114 @@
+import asyncio
+import signal
+import threading
+import time
+
+import pytest
+
+from aetherscale import timing
+
+
+def test_no_deadline_keeps_default_timeout():
+    assert timing.current_deadline() is None
+    assert timing.remaining_timeout() is None
+    assert timing.remaining_timeout(3) == 3
+
+
+def test_nested_deadline_ends_with_parent():
+    with timing.deadline(0.5):
+        with timing.deadline(10) as inner:
+            assert inner.remaining() <= 0.5
+            assert timing.remaining_timeout(0.1) == 0.1
+
+        with timing.deadline(0.2):
+            assert timing.remaining_timeout() <= 0.2
+
+        assert timing.remaining_timeout() > 0.2
+
+
+def test_sleep_raises_on_expiry():
+    with timing.deadline(0.1) as deadline:
+        start = time.monotonic()
+        with pytest.raises(TimeoutError):
+            while True:
+                deadline.sleep(0.05)
+
+        assert time.monotonic() - start < 0.5
+
+
+def test_cancel_wakes_up_other_thread():
+    with timing.deadline(None) as deadline:
+        threading.Timer(0.05, deadline.cancel).start()
+
+        start = time.monotonic()
+        with pytest.raises(timing.OperationCancelled):
+            deadline.sleep(5)
+
+        assert time.monotonic() - start < 1
+
+
+def test_remaining_timeout_does_not_raise():
+    with timing.deadline(0.01):
+        time.sleep(0.02)
+        assert timing.remaining_timeout(5) == timing.MIN_TIMEOUT
+
+    with timing.deadline(None) as deadline:
+        deadline.cancel()
+        assert timing.remaining_timeout() == timing.MIN_TIMEOUT
+
+
+def test_unlimited_deadline_without_default():
+    with timing.deadline(None):
+        assert timing.remaining_timeout() is None
+        assert timing.remaining_timeout(3) == 3
+
+
+def test_deadlines_are_local_to_threads():
+    seen_in_thread = []
+
+    with timing.deadline(1):
+        t = threading.Thread(
+            target=lambda: seen_in_thread.append(timing.current_deadline()))
+        t.start()
+        t.join()
+
+    assert seen_in_thread == [None]
+
+
+def test_deadlines_are_visible_in_asyncio_tasks():
+    async def remaining():
+        return timing.remaining_timeout()
+
+    async def main():
+        with timing.deadline(1):
+            return await asyncio.create_task(remaining())
+
+    assert 0 < asyncio.run(main()) <= 1
+
+
+def test_signal_timeout_is_reset():
+    with pytest.raises(TimeoutError):
+        with timing.timeout(0.05):
+            time.sleep(1)
+
+    with timing.timeout(0.05):
+        pass
+
+    # the alarm must not fire after the block finished
+    time.sleep(0.1)
+    assert signal.getitimer(signal.ITIMER_REAL) == (0.0, 0.0)
+
+
+def test_phase_timer_sums_repeated_phases():
+    timer = timing.PhaseTimer()
+
+    for _ in range(2):
+        with timer.phase('sleep'):
+            time.sleep(0.01)
+
+    with pytest.raises(ValueError):
+        with timer.phase('failing'):
+            raise ValueError
+
+    assert timer.durations['sleep'] >= 0.02
+    assert list(timer.summary().keys()) == ['sleep', 'failing']
@@ -0,0 +1,100 @@
+import json
+import subprocess
+import sys
+
+import pytest
+
+from aetherscale import execution
+from aetherscale import tracing
+
+
+class ListExporter(tracing.SpanExporter):
+    def __init__(self):
+        self.traces = []
+
+    def export(self, spans):
+        self.traces.append(spans)
+
+
+@pytest.fixture
+def exporter():
+    exporter = ListExporter()
+    tracing.set_exporter(exporter)
+    yield exporter
+    tracing.set_exporter(None)
+
+
+def test_spans_of_a_trace_are_exported_together(exporter):
+    with tracing.span('root') as root:
+        with tracing.span('child', key='value') as child:
+            pass
+
+        assert exporter.traces == []
+
+    assert len(exporter.traces) == 1
+    spans = {span.name: span for span in exporter.traces[0]}
+    assert spans['child'].parent_span_id == root.span_id
+    assert spans['child'].trace_id == root.trace_id
+    assert spans['child'].attributes == {'key': 'value'}
+    assert child.duration >= 0
+
+
+def test_failed_span_records_error(exporter):
+    with pytest.raises(ValueError):
+        with tracing.span('failing'):
+            raise ValueError('broken')
+
+    assert exporter.traces[0][0].error == 'broken'
+
+
+def test_command_span_contains_exit_code_and_stderr(exporter):
+    script = 'import sys; sys.stderr.write("x" * 5000); sys.exit(3)'
+    result = execution.run_command([sys.executable, '-c', script])
+
+    assert result.returncode == 3
+    span = exporter.traces[0][0]
+    assert span.name == f'exec {execution.program_name([sys.executable])}'
+    assert span.attributes['process.exit_code'] == 3
+    assert span.attributes['process.stderr_tail'] == \
+        'x' * execution.STDERR_TAIL_LENGTH
+    assert span.error is not None
+
+
+def test_probe_failure_is_not_logged(exporter, caplog):
+    result = execution.run_command(['false'], check_exit=False)
+
+    assert result.returncode == 1
+    assert exporter.traces[0][0].error is None
+    assert 'failed with exit code' not in caplog.text
+
+
+def test_command_timeout(exporter):
+    with pytest.raises(subprocess.TimeoutExpired):
+        execution.run_command(['sleep', '5'], timeout=0.1)
+
+    assert exporter.traces[0][0].attributes['process.timeout'] == 0.1
+    assert execution.SUBPROCESS_TIMEOUTS.value(program='sleep') >= 1
+
+
+def test_trace_file_is_otlp_json(tmppath):
+    trace_file = tmppath / 'traces.jsonl'
+    tracing.set_exporter(tracing.FileExporter(trace_file))
+
+    try:
+        with tracing.span('root', count=2, ratio=0.5, args=['a', 'b']):
+            pass
+    finally:
+        tracing.set_exporter(None)
+
+    lines = trace_file.read_text().splitlines()
+    document = json.loads(lines[0])
+    span = document['resourceSpans'][0]['scopeSpans'][0]['spans'][0]
+
+    assert span['name'] == 'root'
+    assert len(span['traceId']) == 32 and len(span['spanId']) == 16
+    assert int(span['endTimeUnixNano']) >= int(span['startTimeUnixNano'])
+    attributes = {a['key']: a['value'] for a in span['attributes']}
+    assert attributes['count'] == {'intValue': '2'}
+    assert attributes['ratio'] == {'doubleValue': 0.5}
+    assert attributes['args']['arrayValue']['values'][0] == \
+        {'stringValue': 'a'}